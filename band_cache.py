@@ -0,0 +1,133 @@
+import os
+import hashlib
+from osgeo import gdal
+import helper
+
+
+# -------------------------------------------------------------#
+#   波段缓存：
+#   jp2解码及重采样至10m网格后的波段保存为分块ZSTD压缩的GeoTiff（<缓存文件夹>/<键>.tif），
+#   键由产品名（.SAFE）、波段文件、输出网格（范围及分辨率）和重采样方法计算，
+#   同一产品以不同的植被指数、坐标系或矢量重新处理时直接读取缓存，不再解码jp2。
+#   缓存总大小超过上限时按最近使用时间（命中时更新文件修改时间）删除最久未使用的文件。
+#   处理过程中VRT直接引用缓存文件，因此只在一批产品全部处理完成后由主进程清理（evict_cache），
+#   批次进行中缓存可能暂时超过上限；同一缓存文件夹不能同时被多个批次使用。
+# -------------------------------------------------------------#
+# 缓存文件的创建参数配置名，见helper.TIFF_PROFILES
+CACHE_PROFILE = 'zstd'
+
+
+def get_product_id(band_path):
+    """
+    从波段文件路径中获取产品名（.SAFE文件夹名）
+
+    :param band_path: 波段文件路径（本地路径或/vsizip/路径）
+    :return: 产品名，路径中没有.SAFE文件夹时为波段文件路径
+    """
+    for part in reversed(band_path.replace('\\', '/').split('/')):
+        if part.endswith('.SAFE'):
+            return part
+    return band_path
+
+
+def get_cache_key(band_path, bounds, x_res=10, y_res=10, resample_alg='bilinear'):
+    """
+    计算缓存键
+
+    :param band_path: 波段文件路径
+    :param bounds: 输出范围(minX, minY, maxX, maxY)，None为整个图幅
+    :param x_res: 输出网格的x方向分辨率
+    :param y_res: 输出网格的y方向分辨率
+    :param resample_alg: 重采样方法
+    :return: 缓存键
+    """
+    grid = 'full' if bounds is None else ','.join('{:.3f}'.format(value) for value in bounds)
+    key = '|'.join([get_product_id(band_path), os.path.basename(band_path), grid, str(x_res), str(y_res),
+                    resample_alg])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_cached_band(cache_path, band_path, bounds=None, resample_alg='bilinear', x_res=10, y_res=10):
+    """
+    获取缓存的波段：优先使用整个图幅的缓存（VRT只引用其中的窗口），其次使用相同范围的缓存，
+    都不存在时解码并重采样至输出网格后写入缓存
+
+    :param cache_path: 缓存文件夹
+    :param band_path: 波段文件路径
+    :param bounds: 输出范围(minX, minY, maxX, maxY)，None为整个图幅
+    :param resample_alg: 重采样方法
+    :param x_res: 输出网格的x方向分辨率
+    :param y_res: 输出网格的y方向分辨率
+    :return: 缓存文件路径
+    """
+    keys = [get_cache_key(band_path, None, x_res, y_res, resample_alg)]
+    if bounds is not None:
+        keys.append(get_cache_key(band_path, bounds, x_res, y_res, resample_alg))
+    for key in keys:
+        cached_path = os.path.join(cache_path, key + '.tif')
+        if os.path.exists(cached_path):
+            # 更新最近使用时间
+            os.utime(cached_path)
+            return cached_path
+
+    cached_path = os.path.join(cache_path, keys[-1] + '.tif')
+    temp_path = os.path.join(cache_path, keys[-1] + '.{}.tmp'.format(os.getpid()))
+    band_vrt = helper.build_stack_vrt([band_path], temp_path + '.vrt', x_res=x_res, y_res=y_res,
+                                      resample_alg=resample_alg, output_bounds=bounds)
+    dataset = gdal.Open(band_vrt)
+    driver_name, options = helper.get_tiff_profile(CACHE_PROFILE, dataset.GetRasterBand(1).DataType)
+    del dataset
+    gdal.Translate(temp_path, band_vrt, format=driver_name, creationOptions=options)
+    os.remove(band_vrt)
+    # 写入完成后再重命名，其他进程不会读取到未写完的缓存文件
+    os.replace(temp_path, cached_path)
+    return cached_path
+
+
+def get_cached_bands(cache_path, band_path_list, bounds=None, resample_alg='bilinear'):
+    """
+    获取多个波段的缓存，不清理缓存（见evict_cache）
+
+    :param cache_path: 缓存文件夹
+    :param band_path_list: 波段文件路径列表
+    :param bounds: 输出范围(minX, minY, maxX, maxY)，None为整个图幅
+    :param resample_alg: 重采样方法
+    :return: 缓存文件路径列表
+    """
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path, exist_ok=True)
+    return [get_cached_band(cache_path, band_path, bounds, resample_alg) for band_path in band_path_list]
+
+
+def evict_cache(cache_path, max_bytes, keep=()):
+    """
+    按最近使用时间删除最久未使用的缓存文件，直至缓存总大小不超过max_bytes。
+    删除的文件可能正被VRT引用，因此只在没有产品正在处理时（一批产品全部完成后）调用
+
+    :param cache_path: 缓存文件夹
+    :param max_bytes: 缓存总大小的上限（字节）
+    :param keep: 正在使用、不能删除的缓存文件路径
+    """
+    entries = []
+    for file_name in os.listdir(cache_path):
+        if file_name.endswith('.tif'):
+            file_path = os.path.join(cache_path, file_name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                # 已被其他进程删除
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_path))
+    total = sum(entry[1] for entry in entries)
+    keep = set(os.path.abspath(path) for path in keep)
+    for mtime, size, file_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(file_path) in keep:
+            continue
+        try:
+            os.remove(file_path)
+        except OSError:
+            # 其他进程正在读取（Windows）或已删除
+            continue
+        total -= size
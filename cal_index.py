@@ -1,8 +1,133 @@
-import helper
+import re
 import numpy as np
+from osgeo import gdal
+import helper
+
+# numexpr为可选依赖：安装后使用多线程、分块缓存的numexpr计算植被指数表达式，否则使用numpy计算
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+
+# -------------------------------------------------------------#
+#   植被指数注册表：
+#   植被指数以波段名表达式的形式定义，例如 "(B08 - B04) / (B08 + B04)"，
+#   值域为None表示不截断。新的植被指数只需在注册表中添加表达式，
+#   或通过处理参数CUSTOM_INDICES传入，无需编写新的计算函数。
+#   表达式按float32计算；分母为0等产生的非有限值输出NaN。
+# -------------------------------------------------------------#
+INDEX_REGISTRY = {'ndvi': ('(B08 - B04) / (B08 + B04)', (-1.0, 1.0)),
+                  'ndre': ('(B08 - B8A) / (B08 + B8A)', None),
+                  'osavi': ('(B08 - B04) / (B08 + B04 + 0.16)', None),
+                  'lci': ('(B08 - B8A) / (B08 + B04)', None),
+                  'gndvi': ('(B08 - B03) / (B08 + B03)', None),
+                  'reci': ('B08 / B04 - 1.0', None),
+                  'ndmi': ('(B08 - B11) / (B08 + B11)', None),
+                  'ndwi': ('(B03 - B08) / (B03 + B08)', None),
+                  # 以下指数的常数按L2A反射率量化值（反射率 * 10000）换算
+                  'evi': ('2.5 * (B08 - B04) / (B08 + 6.0 * B04 - 7.5 * B02 + 10000.0)', None),
+                  'savi': ('1.5 * (B08 - B04) / (B08 + B04 + 5000.0)', None),
+                  'nbr': ('(B08 - B12) / (B08 + B12)', None)}
+
+# 真彩色快视图所需的波段
+QUICK_IMG_BANDS = ['B02', 'B03', 'B04']
+
+# numpy计算表达式时可用的函数，与numexpr支持的函数保持一致
+NUMPY_FUNCTIONS = {'where': np.where, 'sqrt': np.sqrt, 'abs': np.abs, 'log': np.log, 'exp': np.exp,
+                   'sin': np.sin, 'cos': np.cos, 'arctan2': np.arctan2}
+
+
+def get_expression_bands(expression):
+    """
+    获取植被指数表达式中引用的波段名
+
+    :param expression: 植被指数表达式
+    :return: 按波段顺序排列的波段名列表
+    """
+    names = set(re.findall(r'\b(B\d{2}|B8A)\b', expression))
+    return [band_name for band_name in helper.BAND_ORDER if band_name in names]
+
+
+def check_index_expression(index_name, expression):
+    """
+    检查植被指数表达式：语法正确且只引用可堆叠的波段
+
+    :param index_name: 植被指数名
+    :param expression: 植被指数表达式
+    """
+    try:
+        compile(expression, index_name, 'eval')
+    except SyntaxError:
+        raise ValueError("ERROR!!! Expression of index {} not correctly defined: {}".format(index_name, expression))
+    for band_name in set(re.findall(r'\bB\w+\b', expression)):
+        if band_name not in helper.BAND_RESOLUTION:
+            raise ValueError("ERROR!!! Band {} of index {} is not supported".format(band_name, index_name))
+    if not get_expression_bands(expression):
+        raise ValueError("ERROR!!! Expression of index {} uses no band: {}".format(index_name, expression))
+
+
+def evaluate_index(expression, bands, value_range=None):
+    """
+    计算植被指数表达式
+
+    :param expression: 植被指数表达式
+    :param bands: {波段名: float32数组}，可以是整景影像，也可以是影像中的一块
+    :param value_range: 值域(最小值, 最大值)，None表示不截断
+    :return: float32植被指数数组，非有限值为NaN
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if ne is not None:
+            result = ne.evaluate(expression, local_dict=bands)
+        else:
+            result = eval(expression, {'__builtins__': {}}, dict(NUMPY_FUNCTIONS, **bands))
+    result = np.asarray(result, dtype=np.float32)
+    if result.ndim == 0:
+        # 表达式只包含常数时扩展为块的大小
+        result = np.full(next(iter(bands.values())).shape, result, dtype=np.float32)
+    result[~np.isfinite(result)] = np.nan
+    if value_range is not None:
+        np.clip(result, value_range[0], value_range[1], out=result)
+    return result
+
+
+def set_index_threads(threads):
+    """
+    设置numexpr计算植被指数表达式的线程数
+
+    :param threads: 线程数
+    """
+    if ne is not None:
+        ne.set_num_threads(threads)
+
+
+def get_band_dict(img_data, band_names, required_bands):
+    """
+    从影像矩阵中取出需要的波段，转换为float32
+
+    :param img_data: 输入影像矩阵
+    :param band_names: 输入影像矩阵中各波段对应的波段名
+    :param required_bands: 需要的波段名
+    :return: {波段名: float32数组}
+    """
+    return {band_name: img_data[band_names.index(band_name)].astype(np.float32) for band_name in required_bands}
+
+
+def cal_index_array(index_name, img_data, band_names=helper.STACK_BANDS):
+    """
+    按注册表计算整景影像的植被指数
 
+    :param index_name: 植被指数名
+    :param img_data: 输入影像矩阵
+    :param band_names: 输入影像矩阵中各波段对应的波段名
+    :return: float32植被指数数组
+    """
+    expression, value_range = INDEX_REGISTRY[index_name]
+    bands = get_band_dict(img_data, band_names, get_expression_bands(expression))
+    return evaluate_index(expression, bands, value_range)
 
-def cal_ndvi(img_data, geotrans, proj, out_path):
+
+def cal_ndvi(img_data, geotrans, proj, out_path, band_names=helper.STACK_BANDS):
     """
     归一化差值植被指数 NDVI = (NIR - R) / (NIR + R)
     NDVI 是最常用的植被指数。可以用来表征地面植被密集程度和植物的叶绿素含量。NDVI 数值为 -1 到 1，
@@ -13,22 +138,13 @@ def cal_ndvi(img_data, geotrans, proj, out_path):
     :param geotrans: 输入影像仿射系数
     :param proj: 输入影像坐标系
     :param out_path: 输出影像存储路径
+    :param band_names: 输入影像矩阵中各波段对应的波段名
     """
-    red_arr = img_data[2, :, :]
-    nir_arr = img_data[3, :, :]
-
-    denominator = np.array(nir_arr + red_arr, dtype=np.float32)
-    numerator = np.array(nir_arr - red_arr, dtype=np.float32)
-    nodata = np.full((nir_arr.shape[0], nir_arr.shape[1]), -999, dtype=np.float32)
-    ndvi = np.true_divide(numerator, denominator, out=nodata, where=denominator != 0.0)
-    # print(np.min(ndvi), np.max(ndvi))
-    ndvi[ndvi == -999.0] = None
-    ndvi[ndvi <= -1.0] = -1.0
-    ndvi[ndvi >= 1.0] = 1.0
+    ndvi = cal_index_array('ndvi', img_data, band_names)
     helper.write_tiff(ndvi, geotrans, proj, out_path)
 
 
-def cal_ndre(img_data, geotrans, proj, out_path):
+def cal_ndre(img_data, geotrans, proj, out_path, band_names=helper.STACK_BANDS):
     """
     归一化差异红边植被指数 NDRE = (NIR – RED EDGE) / (NIR + RED EDGE)
     在高植被区 NDVI 灵敏度较低，也就是 NDVI 的“饱和”现象。为了应对 NDVI 的这个缺陷，就引入了 NDRE。
@@ -39,21 +155,13 @@ def cal_ndre(img_data, geotrans, proj, out_path):
     :param geotrans: 输入影像仿射系数
     :param proj: 输入影像坐标系
     :param out_path: 输出影像存储路径
+    :param band_names: 输入影像矩阵中各波段对应的波段名
     """
-    redEdge_arr = img_data[4, :, :]
-    nir_arr = img_data[3, :, :]
-
-    denominator = np.array(nir_arr + redEdge_arr, dtype=np.float32)
-    numerator = np.array(nir_arr - redEdge_arr, dtype=np.float32)
-    nodata = np.full((nir_arr.shape[0], nir_arr.shape[1]), -999, dtype=np.float32)
-    ndre = np.true_divide(numerator, denominator, out=nodata, where=denominator != 0.0)
-    ndre[ndre == -999.0] = None
-    # ndre[ndre <= -1.0] = -1.0
-    # ndre[ndre >= 1.0] = 1.0
+    ndre = cal_index_array('ndre', img_data, band_names)
     helper.write_tiff(ndre, geotrans, proj, out_path)
 
 
-def cal_osavi(img_data, geotrans, proj, out_path):
+def cal_osavi(img_data, geotrans, proj, out_path, band_names=helper.STACK_BANDS):
     """
     优化土壤调整植被指数 NDRE = (NIR – RED) / (NIR + RED + 0.16)
     OSAVI 主要在 NDVI 的基础上将土壤因素纳入考量，在植被生长初期、密度不高的时候，
@@ -63,21 +171,13 @@ def cal_osavi(img_data, geotrans, proj, out_path):
     :param geotrans: 输入影像仿射系数
     :param proj: 输入影像坐标系
     :param out_path: 输出影像存储路径
+    :param band_names: 输入影像矩阵中各波段对应的波段名
     """
-    red_arr = img_data[2, :, :]
-    nir_arr = img_data[3, :, :]
-
-    denominator = np.array(nir_arr + red_arr + 0.16, dtype=np.float32)
-    numerator = np.array(nir_arr - red_arr, dtype=np.float32)
-    nodata = np.full((nir_arr.shape[0], nir_arr.shape[1]), -999, dtype=np.float32)
-    osavi = np.true_divide(numerator, denominator, out=nodata, where=denominator != 0.0)
-    osavi[osavi == -999.0] = None
-    # osavi[osavi <= -1.0] = -1.0
-    # osavi[osavi >= 1.0] = 1.0
+    osavi = cal_index_array('osavi', img_data, band_names)
     helper.write_tiff(osavi, geotrans, proj, out_path)
 
 
-def cal_lci(img_data, geotrans, proj, out_path):
+def cal_lci(img_data, geotrans, proj, out_path, band_names=helper.STACK_BANDS):
     """
     叶面叶绿素指数 LCI = (NIR – RED EDGE) / (NIR + RED)
     LCI 对于判断植物的叶子的叶绿素和含氮量有较好的效果，而相比之下 NDVI 通常用于判断整个冠层的叶绿素和含氮量。
@@ -86,22 +186,13 @@ def cal_lci(img_data, geotrans, proj, out_path):
     :param geotrans: 输入影像仿射系数
     :param proj: 输入影像坐标系
     :param out_path: 输出影像存储路径
+    :param band_names: 输入影像矩阵中各波段对应的波段名
     """
-    red_arr = img_data[2, :, :]
-    nir_arr = img_data[3, :, :]
-    redEdge_arr = img_data[4, :, :]
-
-    denominator = np.array(nir_arr + red_arr, dtype=np.float32)
-    numerator = np.array(nir_arr - redEdge_arr, dtype=np.float32)
-    nodata = np.full((nir_arr.shape[0], nir_arr.shape[1]), -999, dtype=np.float32)
-    lci = np.true_divide(numerator, denominator, out=nodata, where=denominator != 0.0)
-    lci[lci == -999.0] = None
-    # lci[lci <= -1.0] = -1.0
-    # lci[lci >= 1.0] = 1.0
+    lci = cal_index_array('lci', img_data, band_names)
     helper.write_tiff(lci, geotrans, proj, out_path)
 
 
-def cal_gndvi(img_data, geotrans, proj, out_path):
+def cal_gndvi(img_data, geotrans, proj, out_path, band_names=helper.STACK_BANDS):
     """
     绿色归一化差异植被指数 GNDVI = (NIR – GREEN) / (NIR + GREEN)
     GNDVI 相比 NDVI 能更稳定地探测植被，因此 GDNVI 也经常用于植被覆盖监测、植被和作物健康度调查中。
@@ -110,21 +201,13 @@ def cal_gndvi(img_data, geotrans, proj, out_path):
     :param geotrans: 输入影像仿射系数
     :param proj: 输入影像坐标系
     :param out_path: 输出影像存储路径
+    :param band_names: 输入影像矩阵中各波段对应的波段名
     """
-    green_arr = img_data[1, :, :]
-    nir_arr = img_data[3, :, :]
-
-    denominator = np.array(nir_arr + green_arr, dtype=np.float32)
-    numerator = np.array(nir_arr - green_arr, dtype=np.float32)
-    nodata = np.full((nir_arr.shape[0], nir_arr.shape[1]), -999, dtype=np.float32)
-    gndvi = np.true_divide(numerator, denominator, out=nodata, where=denominator != 0.0)
-    gndvi[gndvi == -999.0] = None
-    # lci[lci <= -1.0] = -1.0
-    # lci[lci >= 1.0] = 1.0
+    gndvi = cal_index_array('gndvi', img_data, band_names)
     helper.write_tiff(gndvi, geotrans, proj, out_path)
 
 
-def cal_reci(img_data, geotrans, proj, out_path):
+def cal_reci(img_data, geotrans, proj, out_path, band_names=helper.STACK_BANDS):
     """
     红边叶绿素植被指数 RECI = (NIR – RED) - 1
     ReCI 植被指数对受氮滋养的叶子中的叶绿素含量有反应。ReCI 显示了冠层的光合活性。
@@ -135,21 +218,13 @@ def cal_reci(img_data, geotrans, proj, out_path):
     :param geotrans: 输入影像仿射系数
     :param proj: 输入影像坐标系
     :param out_path: 输出影像存储路径
+    :param band_names: 输入影像矩阵中各波段对应的波段名
     """
-    red_arr = img_data[2, :, :]
-    nir_arr = img_data[3, :, :]
-
-    denominator = np.array(red_arr, dtype=np.float32)
-    numerator = np.array(nir_arr, dtype=np.float32)
-    nodata = np.full((nir_arr.shape[0], nir_arr.shape[1]), -999, dtype=np.float32)
-    reci = np.true_divide(numerator, denominator, out=nodata, where=denominator != 0.0) - 1.0
-    reci[reci == -999.0] = None
-    # reci[reci <= -1.0] = -1.0
-    # reci[reci >= 1.0] = 1.0
+    reci = cal_index_array('reci', img_data, band_names)
     helper.write_tiff(reci, geotrans, proj, out_path)
 
 
-def cal_ndmi(img_data, geotrans, proj, out_path):
+def cal_ndmi(img_data, geotrans, proj, out_path, band_names=helper.STACK_BANDS):
     """
     归一化差值水分指数 NDMI = (NIR - SWIR1) / (NIR + SWIR1)
     NDMI 通过计算近红外与短波红外之间的差异来定量化反映植被冠层的水分含量情况。
@@ -161,20 +236,13 @@ def cal_ndmi(img_data, geotrans, proj, out_path):
     :param geotrans: 输入影像仿射系数
     :param proj: 输入影像坐标系
     :param out_path: 输出影像存储路径
+    :param band_names: 输入影像矩阵中各波段对应的波段名
     """
-    nir_arr = img_data[3, :, :]
-    swir1_arr = img_data[5, :, :]
-
-    denominator = np.array(nir_arr + swir1_arr, dtype=np.float32)
-    numerator = np.array(nir_arr - swir1_arr, dtype=np.float32)
-    nodata = np.full((nir_arr.shape[0], nir_arr.shape[1]), -999, dtype=np.float32)
-    ndmi = np.true_divide(numerator, denominator, out=nodata, where=denominator != 0.0)
-    # print(np.min(ndmi), np.max(ndmi))
-    ndmi[ndmi == -999.0] = None
+    ndmi = cal_index_array('ndmi', img_data, band_names)
     helper.write_tiff(ndmi, geotrans, proj, out_path)
 
 
-def cal_ndwi(img_data, geotrans, proj, out_path):
+def cal_ndwi(img_data, geotrans, proj, out_path, band_names=helper.STACK_BANDS):
     """
     计算归一化水体指数 NDWI = (GREEN - NIR) / (GREEN + NIR)
     NDWI 利用绿光波段和近红外波段的差异比值来增强水体信息，并减弱植被、土壤、建筑物等地物的信息。
@@ -185,14 +253,162 @@ def cal_ndwi(img_data, geotrans, proj, out_path):
     :param geotrans: 输入影像仿射系数
     :param proj: 输入影像坐标系
     :param out_path: 输出影像存储路径
+    :param band_names: 输入影像矩阵中各波段对应的波段名
     """
-    green_arr = img_data[1, :, :]
-    nir_arr = img_data[3, :, :]
-
-    denominator = np.array(green_arr + nir_arr, dtype=np.float32)
-    numerator = np.array(green_arr - nir_arr, dtype=np.float32)
-    nodata = np.full((green_arr.shape[0], green_arr.shape[1]), -999, dtype=np.float32)
-    ndwi = np.true_divide(numerator, denominator, out=nodata, where=denominator != 0.0)
-    # print(np.min(ndwi), np.max(ndwi))
-    ndwi[ndwi == -999.0] = None
+    ndwi = cal_index_array('ndwi', img_data, band_names)
     helper.write_tiff(ndwi, geotrans, proj, out_path)
+
+
+def get_indices(params):
+    """
+    根据处理参数获取需要计算的植被指数：注册表中CAL_<指数名>为True的指数，以及CUSTOM_INDICES中自定义的指数。
+    CUSTOM_INDICES为{指数名: 表达式}或{指数名: (表达式, (最小值, 最大值))}
+
+    :param params: 数据处理参数
+    :return: {植被指数名: (表达式, 值域)}
+    """
+    indices = {}
+    for index_name in INDEX_REGISTRY:
+        if params.get('CAL_' + index_name.upper()):
+            indices[index_name] = INDEX_REGISTRY[index_name]
+    custom_indices = params.get('CUSTOM_INDICES') or {}
+    for index_name in custom_indices:
+        index_define = custom_indices[index_name]
+        if isinstance(index_define, str):
+            index_define = (index_define, None)
+        check_index_expression(index_name, index_define[0])
+        indices[index_name] = (index_define[0], index_define[1])
+    return indices
+
+
+def resolve_bands(indices, quick_img=False, extra_bands=()):
+    """
+    根据需要计算的植被指数及是否生成快视图，确定需要解码、重采样和堆叠的最少波段
+
+    :param indices: 需要计算的植被指数{植被指数名: (表达式, 值域)}
+    :param quick_img: 是否生成真彩色快视图
+    :param extra_bands: 额外需要堆叠的波段
+    :return: 按堆叠顺序排列的波段名列表
+    """
+    required_bands = set(extra_bands)
+    for index_name in indices:
+        required_bands.update(get_expression_bands(indices[index_name][0]))
+    if quick_img:
+        required_bands.update(QUICK_IMG_BANDS)
+    return [band_name for band_name in helper.BAND_ORDER if band_name in required_bands]
+
+
+def get_stack_bands(indices, quick_img=False, stack_all_bands=False):
+    """
+    波段叠加影像的波段：植被指数及快视图需要的最少波段（stack_all_bands时为全部波段），
+    未计算任何指数和快视图时为全部波段
+
+    :param indices: 需要计算的植被指数{植被指数名: (表达式, 值域)}
+    :param quick_img: 是否生成真彩色快视图
+    :param stack_all_bands: 是否堆叠全部波段
+    :return: 按堆叠顺序排列的波段名列表
+    """
+    band_names = resolve_bands(indices, quick_img, helper.STACK_BANDS if stack_all_bands else ())
+    return band_names or list(helper.STACK_BANDS)
+
+
+def cal_indices(stack_path, out_prefix, indices, band_names=helper.STACK_BANDS, block_size=1024, profile=None,
+                stack_out=None, mask_path=None, zone_path=None, zone_values=None):
+    """
+    单次遍历、按块计算多个植被指数：每次只读取一个块所需的波段，计算全部需要的指数后写入各输出影像，
+    内存占用只与块大小有关，与整景影像大小无关。输出影像路径为 out_prefix + '_ndvi.tif' 等。
+    设置stack_out时在同一次遍历中将读取的全部波段写出为多波段影像，输入影像（例如重投影、裁剪的
+    虚拟影像）只读取一次。
+    设置mask_path时同时按块读取与输入影像网格一致的云掩膜（非0为无效像元，见helper.create_cloud_mask），
+    植被指数只对有效像元计算，无效像元在波段叠加输出中置为0、在植被指数输出中置为NaN，并写入无效值；
+    整块均为无效像元且不输出波段叠加时不读取该块的波段。
+    设置zone_path时同时按块读取与输入影像网格一致的地块编号影像（见zonal_stats.rasterize_features），
+    将地块内有效像元的编号及指数值收集到zone_values中，用于计算地块统计量
+
+    :param stack_path: 波段叠加影像路径（tif或vrt）
+    :param out_prefix: 输出影像路径前缀
+    :param indices: 需要计算的植被指数{植被指数名: (表达式, 值域)}
+    :param band_names: 波段叠加影像中各波段对应的波段名
+    :param block_size: 块的边长（像元）
+    :param profile: 输出影像的创建参数配置名，见helper.TIFF_PROFILES
+    :param stack_out: 波段叠加影像的输出路径，默认不输出
+    :param mask_path: 与输入影像网格一致的云掩膜路径，默认不掩膜
+    :param zone_path: 与输入影像网格一致的地块编号影像路径，默认不统计
+    :param zone_values: 收集地块像元的字典{植被指数名: [(地块编号数组, 指数值数组), ...]}
+    """
+    if not indices and stack_out is None:
+        return
+    dataset = gdal.Open(stack_path)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    geotrans = dataset.GetGeoTransform()
+    proj = dataset.GetProjection()
+
+    # 全部指数所需的波段，每个块只读取一次
+    index_bands = resolve_bands(indices)
+    required_bands = index_bands
+    out_datasets = {}
+    for index_name in indices:
+        out_path = out_prefix + '_' + index_name + '.tif'
+        out_datasets[index_name] = helper.create_tiff(out_path, width, height, 1, gdal.GDT_Float32, geotrans, proj,
+                                                      profile)
+        if mask_path is not None:
+            out_datasets[index_name].GetRasterBand(1).SetNoDataValue(float('nan'))
+    stack_dataset = None
+    if stack_out is not None:
+        # 输出全部波段时每个块读取全部波段
+        required_bands = band_names
+        stack_dataset = helper.create_tiff(stack_out, width, height, len(band_names),
+                                           dataset.GetRasterBand(1).DataType, geotrans, proj, profile)
+        for i, band_name in enumerate(band_names):
+            stack_dataset.GetRasterBand(i + 1).SetDescription(band_name)
+            if mask_path is not None:
+                stack_dataset.GetRasterBand(i + 1).SetNoDataValue(0)
+    mask_dataset = None
+    if mask_path is not None:
+        mask_dataset = gdal.Open(mask_path)
+    zone_dataset = None
+    if zone_path is not None:
+        zone_dataset = gdal.Open(zone_path)
+
+    for xoff, yoff, xsize, ysize in helper.iter_blocks(width, height, block_size):
+        valid = None
+        if mask_dataset is not None:
+            valid = mask_dataset.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize) == 0
+            if stack_dataset is None and not valid.any():
+                # 整块被云覆盖，不读取波段，植被指数均为无效值
+                for index_name in indices:
+                    out_datasets[index_name].GetRasterBand(1).WriteArray(
+                        np.full((ysize, xsize), np.nan, dtype=np.float32), xoff, yoff)
+                continue
+        if zone_dataset is not None:
+            labels = zone_dataset.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+        bands = {}
+        for band_name in required_bands:
+            band_index = band_names.index(band_name) + 1
+            band_block = dataset.GetRasterBand(band_index).ReadAsArray(xoff, yoff, xsize, ysize)
+            if valid is not None:
+                band_block[~valid] = 0
+            if stack_dataset is not None:
+                stack_dataset.GetRasterBand(band_index).WriteArray(band_block, xoff, yoff)
+            if band_name in index_bands:
+                # 有掩膜时只保留有效像元参与计算
+                bands[band_name] = (band_block if valid is None else band_block[valid]).astype(np.float32)
+        for index_name in indices:
+            expression, value_range = indices[index_name]
+            if valid is None:
+                index_block = evaluate_index(expression, bands, value_range)
+            else:
+                index_block = np.full((ysize, xsize), np.nan, dtype=np.float32)
+                index_block[valid] = evaluate_index(expression, bands, value_range)
+            out_datasets[index_name].GetRasterBand(1).WriteArray(index_block, xoff, yoff)
+            if zone_dataset is not None:
+                # 地块内的有效像元
+                zone_pixels = (labels > 0) & np.isfinite(index_block)
+                zone_values.setdefault(index_name, []).append((labels[zone_pixels], index_block[zone_pixels]))
+
+    for index_name in indices:
+        helper.finish_tiff(out_datasets.pop(index_name), out_prefix + '_' + index_name + '.tif', profile)
+    if stack_dataset is not None:
+        helper.finish_tiff(stack_dataset, stack_out, profile)
+    del dataset, mask_dataset, zone_dataset
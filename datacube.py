@@ -0,0 +1,240 @@
+import os
+import re
+import numpy as np
+from osgeo import gdal, gdal_array, osr
+import helper
+
+# PyTables为可选依赖：安装后可以将各日期的植被指数追加到按图幅组织的HDF5时间序列数据立方体中
+try:
+    import tables
+except ImportError:
+    tables = None
+
+
+# -------------------------------------------------------------#
+#   时间序列数据立方体：
+#   每个MGRS图幅一个HDF5文件（<图幅>_cube.h5），每个植被指数（或波段）为一个
+#   时间×行×列的可扩展数组，按(8, 256, 256)分块并压缩，既可以按空间范围读取某一日期，
+#   也可以一次读取一个像元的时间序列；/time表记录各时间下标对应的产品编号及日期，时间轴按成像时间排序。
+#   HDF5文件不能被多个进程同时写入，因此在一批产品处理完成后由主进程逐景追加本批次处理的产品。
+# -------------------------------------------------------------#
+# 时间、行、列方向的分块大小
+CUBE_CHUNK = (8, 256, 256)
+# 输出文件名中的产品编号（图幅_成像时间）
+IDENTIFIER_PATTERN = re.compile(r'^(T\d{2}[A-Z]{3}_\d{8}T\d{6})_')
+
+
+def get_cube_filters():
+    """
+    数据立方体的压缩参数：Blosc（ZSTD）压缩，字节重排
+
+    :return: PyTables压缩参数
+    """
+    return tables.Filters(complevel=5, complib='blosc:zstd', shuffle=True)
+
+
+def is_same_projection(projection, other_projection):
+    """
+    判断两个坐标系（WKT）是否相同，同一坐标系的WKT写法可能不同，因此按坐标系比较而不是比较字符串
+
+    :param projection: 坐标系（WKT）
+    :param other_projection: 坐标系（WKT）
+    :return: 是否相同
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(projection)
+    other_srs = osr.SpatialReference()
+    other_srs.ImportFromWkt(other_projection)
+    return bool(srs.IsSame(other_srs))
+
+
+def open_cube(cube_path, width, height, geotrans, proj):
+    """
+    打开（不存在时创建）图幅的数据立方体
+
+    :param cube_path: 数据立方体文件路径
+    :param width: 栅格矩阵的列数
+    :param height: 栅格矩阵的行数
+    :param geotrans: 仿射变换参数
+    :param proj: 坐标系（WKT），与已有数据立方体的网格或坐标系不一致时抛出ValueError
+    :return: 打开的PyTables文件
+    """
+    if tables is None:
+        raise ValueError("ERROR!!! Writing datacubes requires PyTables")
+    cube = tables.open_file(cube_path, mode='a')
+    attrs = cube.root._v_attrs
+    if '/time' not in cube:
+        attrs.width = width
+        attrs.height = height
+        attrs.geotransform = tuple(geotrans)
+        attrs.projection = proj
+        cube.create_table('/', 'time', {'identifier': tables.StringCol(32, pos=0),
+                                        'date': tables.StringCol(8, pos=1)})
+    elif (attrs.width, attrs.height, tuple(attrs.geotransform)) != (width, height, tuple(geotrans)):
+        cube.close()
+        raise ValueError("ERROR!!! The grid does not match the datacube " + cube_path)
+    elif not is_same_projection(attrs.projection, proj):
+        cube.close()
+        raise ValueError("ERROR!!! The projection does not match the datacube " + cube_path)
+    return cube
+
+
+def get_time_key(img_identifier):
+    """
+    时间轴的排序键：成像时间（例如20220825T030519），相同时再按编号排序
+
+    :param img_identifier: Sentinel-2文件的编号，例如T50TLK_20220825T030519
+    :return: 排序键
+    """
+    return img_identifier.split('_')[1], img_identifier
+
+
+def get_time_index(cube, img_identifier, block_size=1024):
+    """
+    获取产品在数据立方体中的时间下标。时间轴按成像时间排序：新产品按成像时间插入，
+    通常晚于已有产品而追加到末尾；早于已有产品时（例如补充处理的历史产品），其后的时间步依次后移一步
+
+    :param cube: open_cube返回的PyTables文件
+    :param img_identifier: Sentinel-2文件的编号，例如T50TLK_20220825T030519
+    :param block_size: 后移时间步时按块读写的块边长（像元）
+    :return: 时间下标
+    """
+    time_table = cube.root.time
+    identifiers = [identifier.decode() for identifier in time_table.col('identifier')]
+    if img_identifier in identifiers:
+        # 重新处理的产品覆盖原时间步
+        return identifiers.index(img_identifier)
+    key = get_time_key(img_identifier)
+    t = sum(1 for identifier in identifiers if get_time_key(identifier) < key)
+    rows = time_table.read()
+    time_table.append([(img_identifier, img_identifier.split('_')[1][:8])])
+    if t < len(rows):
+        # 插入新行：第t行及其后的各行后移一行
+        time_table.modify_rows(start=t + 1, rows=rows[t:])
+        time_table.modify_rows(start=t, rows=[(img_identifier, img_identifier.split('_')[1][:8])])
+    time_table.flush()
+    attrs = cube.root._v_attrs
+    for array in cube.list_nodes('/', classname='EArray'):
+        # 扩展的时间步填充默认值（植被指数为NaN）
+        array.truncate(time_table.nrows)
+        if t < len(rows):
+            # 按空间块将第t步及其后的时间步后移一步，再将第t步置为默认值（新产品未输出的变量保持默认值）
+            for xoff, yoff, xsize, ysize in helper.iter_blocks(attrs.width, attrs.height, block_size):
+                # 从末尾开始每次移动CUBE_CHUNK[0]个时间步，内存只与块大小有关
+                for end in range(len(rows), t, -CUBE_CHUNK[0]):
+                    start = max(t, end - CUBE_CHUNK[0])
+                    array[start + 1:end + 1, yoff:yoff + ysize, xoff:xoff + xsize] = \
+                        array[start:end, yoff:yoff + ysize, xoff:xoff + xsize]
+                array[t:t + 1, yoff:yoff + ysize, xoff:xoff + xsize] = np.full((1, ysize, xsize), array.atom.dflt,
+                                                                               dtype=array.atom.dtype)
+    return t
+
+
+def get_cube_array(cube, name, dtype):
+    """
+    获取（不存在时创建）数据立方体中的变量数组
+
+    :param cube: open_cube返回的PyTables文件
+    :param name: 变量名，例如ndvi、B04
+    :param dtype: 数据类型
+    :return: 时间×行×列的可扩展数组
+    """
+    if '/' + name in cube:
+        return cube.get_node('/', name)
+    attrs = cube.root._v_attrs
+    dtype = np.dtype(dtype)
+    atom = tables.Atom.from_dtype(dtype, dflt=np.nan if dtype.kind == 'f' else 0)
+    array = cube.create_earray('/', name, atom, shape=(0, attrs.height, attrs.width),
+                               chunkshape=(CUBE_CHUNK[0], min(CUBE_CHUNK[1], attrs.height),
+                                           min(CUBE_CHUNK[2], attrs.width)),
+                               filters=get_cube_filters())
+    array.truncate(cube.root.time.nrows)
+    return array
+
+
+def append_tiff(cube, t, name, tif_path, band_index=1, block_size=1024):
+    """
+    按块将tif影像的一个波段写入数据立方体的一个时间步
+
+    :param cube: open_cube返回的PyTables文件
+    :param t: 时间下标
+    :param name: 变量名
+    :param tif_path: 输入影像路径
+    :param band_index: 波段序号（从1开始）
+    :param block_size: 块的边长（像元）
+    """
+    dataset = gdal.Open(tif_path)
+    band = dataset.GetRasterBand(band_index)
+    array = get_cube_array(cube, name, gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    for xoff, yoff, xsize, ysize in helper.iter_blocks(dataset.RasterXSize, dataset.RasterYSize, block_size):
+        array[t, yoff:yoff + ysize, xoff:xoff + xsize] = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    del dataset
+
+
+def get_output_identifiers(output_paths):
+    """
+    从输出文件路径中获取产品编号
+
+    :param output_paths: 输出文件路径，例如<输出文件夹>/T50TLK_20220825T030519_ndvi.tif
+    :return: 产品编号集合，例如{'T50TLK_20220825T030519'}
+    """
+    identifiers = set()
+    for output_path in output_paths:
+        match = IDENTIFIER_PATTERN.match(os.path.basename(output_path))
+        if match:
+            identifiers.add(match.group(1))
+    return identifiers
+
+
+def update_cubes(output_path, identifiers, indices, bands=False, block_size=1024):
+    """
+    将本批次处理的各产品的植被指数（及波段叠加的各波段）写入所属图幅的数据立方体<图幅>_cube.h5，
+    只读取这些产品的输出文件，不扫描输出文件夹中的历史产品；时间轴按成像时间排序（见get_time_index），
+    已写入的产品覆盖原时间步
+
+    :param output_path: 输出文件夹
+    :param identifiers: 本批次处理的产品编号，例如T50TLK_20220825T030519
+    :param indices: 需要追加的植被指数名
+    :param bands: 是否追加波段叠加（<编号>_merge.tif）的各波段，变量名为波段描述（例如B04）
+    :param block_size: 块的边长（像元）
+    """
+    names = list(indices) + (['merge'] if bands else [])
+    if not names:
+        return
+
+    # 按日期顺序写入，同一批次的产品依次追加到时间轴末尾
+    for img_identifier in sorted(identifiers, key=get_time_key):
+        cube_path = os.path.join(output_path, img_identifier.split('_')[0] + "_cube.h5")
+        tif_paths = {}
+        for name in names:
+            tif_path = os.path.join(output_path, img_identifier + '_' + name + '.tif')
+            if os.path.exists(tif_path):
+                tif_paths[name] = tif_path
+        if not tif_paths:
+            continue
+        dataset = gdal.Open(tif_paths[list(tif_paths)[0]])
+        grid = (dataset.RasterXSize, dataset.RasterYSize, dataset.GetGeoTransform(), dataset.GetProjection())
+        band_names = []
+        if 'merge' in tif_paths:
+            merge_dataset = gdal.Open(tif_paths['merge'])
+            band_names = [merge_dataset.GetRasterBand(i + 1).GetDescription() or 'band%d' % (i + 1)
+                          for i in range(merge_dataset.RasterCount)]
+            del merge_dataset
+        del dataset
+        try:
+            cube = open_cube(cube_path, *grid)
+        except ValueError as e:
+            # 网格或坐标系不一致（例如按研究区窗口输出）的产品不追加
+            print(e)
+            continue
+        try:
+            t = get_time_index(cube, img_identifier, block_size)
+            for name in tif_paths:
+                if name == 'merge':
+                    for i, band_name in enumerate(band_names):
+                        append_tiff(cube, t, band_name, tif_paths[name], i + 1, block_size)
+                else:
+                    append_tiff(cube, t, name, tif_paths[name], 1, block_size)
+        finally:
+            cube.close()
+        print("{} has been appended to {}".format(img_identifier, cube_path))
@@ -0,0 +1,114 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+import local_hub
+import sentinel2_download as s2d
+
+
+# -------------------------------------------------------------#
+#   下载流程测试：
+#   在本地模拟的数据中心（local_hub）上运行s2_download，每个产品第一次下载请求返回503、
+#   第二次只返回一半数据后断开，检查重试、断点续传、MD5校验、离线产品及重新运行时跳过已下载的产品。
+#   运行：python -m unittest download_test
+# -------------------------------------------------------------#
+PRODUCT_NAMES = ['S2A_MSIL2A_20220815T030519_N0400_R075_T50TLK_20220815T080000',
+                 'S2B_MSIL2A_20220820T030519_N0400_R075_T50TLK_20220820T080000',
+                 'S2A_MSIL2A_20220825T030519_N0400_R075_T50TLK_20220825T080000']
+OFFLINE_NAME = PRODUCT_NAMES[2]
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.work_path, 'hub')
+        self.save_dir = os.path.join(self.work_path, 'download')
+        os.makedirs(self.data_path)
+        for i, name in enumerate(PRODUCT_NAMES):
+            with open(os.path.join(self.data_path, name + '.zip'), 'wb') as f:
+                # 大于下载时每次写入的字节数，断开前已写入部分数据
+                f.write(os.urandom(3 * s2d.DOWNLOAD_CHUNK_SIZE + i * 1000))
+        self.server, api_url = local_hub.serve_hub(self.data_path, offline=[OFFLINE_NAME], failures=1,
+                                                   truncations=1)
+        self.params = {'USER_NAME': 'user',
+                       'PASSWORD': 'password',
+                       'FOOTPRINT': 'POLYGON((115.5 40.2, 116.0 40.2, 116.0 40.5, 115.5 40.5, 115.5 40.2))',
+                       'START_DATE': '20220801',
+                       'END_DATE': '20220901',
+                       'PRODUCT_TYPE': 'S2MSI2A',
+                       'CLOUD_COVER_PERCENTAGE': 30,
+                       'SAVE_DIR': self.save_dir,
+                       'API_URL': api_url,
+                       'WORKERS': 2,
+                       'RETRIES': 3,
+                       'RETRY_DELAY': 0.01}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_path, ignore_errors=True)
+
+    def get_md5(self, file_path):
+        with open(file_path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def test_download(self):
+        not_downloaded = s2d.s2_download(self.params)
+
+        # 离线产品不下载
+        self.assertEqual([record['title'] for record in not_downloaded.values()], [OFFLINE_NAME])
+        self.assertEqual(list(not_downloaded.values())[0]['status'], 'offline')
+        self.assertFalse(os.path.exists(os.path.join(self.save_dir, OFFLINE_NAME + '.zip')))
+
+        # 元数据一次批量请求获取
+        self.assertEqual(self.server.requests.count('/odata/v1/Products'), 1)
+
+        with open(os.path.join(self.save_dir, s2d.DOWNLOAD_LEDGER_NAME)) as f:
+            ledger = json.load(f)
+        for name in PRODUCT_NAMES[:2]:
+            zip_path = os.path.join(self.save_dir, name + '.zip')
+            # 下载完成、校验和一致，没有遗留的未完成文件
+            self.assertTrue(os.path.exists(zip_path))
+            self.assertFalse(os.path.exists(zip_path + '.incomplete'))
+            self.assertEqual(self.get_md5(zip_path), self.get_md5(os.path.join(self.data_path, name + '.zip')))
+            record = [record for record in ledger.values() if record['title'] == name][0]
+            self.assertEqual(record['status'], 'downloaded')
+            # 503、断开后续传、完成
+            self.assertEqual(record['attempts'], 3)
+        # 断开后从已下载的一半继续，而不是重新下载
+        self.assertEqual(len(self.server.ranges), 2)
+        self.assertTrue(all(start > 0 for product_id, start in self.server.ranges))
+
+        # 重新运行时跳过已下载的产品，不再发送下载请求
+        self.server.requests.clear()
+        not_downloaded = s2d.s2_download(self.params)
+        self.assertEqual([record['title'] for record in not_downloaded.values()], [OFFLINE_NAME])
+        self.assertFalse([path for path in self.server.requests if path.endswith('/$value')])
+
+    def test_stale_incomplete_file(self):
+        # 其他版本遗留的、比产品大的未完成文件：删除后重新下载，而不是每次重试都请求超出文件大小的Range
+        os.makedirs(self.save_dir)
+        name = PRODUCT_NAMES[0]
+        with open(os.path.join(self.save_dir, name + '.zip.incomplete'), 'wb') as f:
+            f.write(os.urandom(4 * s2d.DOWNLOAD_CHUNK_SIZE))
+        s2d.s2_download(self.params)
+        zip_path = os.path.join(self.save_dir, name + '.zip')
+        self.assertEqual(self.get_md5(zip_path), self.get_md5(os.path.join(self.data_path, name + '.zip')))
+
+    def test_metadata_failure(self):
+        # 一个产品的元数据请求失败不影响其他产品，失败的产品记录在下载记录中
+        self.server.shutdown()
+        self.server.server_close()
+        self.server, self.params['API_URL'] = local_hub.serve_hub(self.data_path, broken_metadata=[PRODUCT_NAMES[1]])
+        not_downloaded = s2d.s2_download(self.params)
+        self.assertEqual(sorted(record['title'] for record in not_downloaded.values()), PRODUCT_NAMES[1:2])
+        self.assertEqual(list(not_downloaded.values())[0]['status'], 'failed')
+        self.assertTrue(os.path.exists(os.path.join(self.save_dir, PRODUCT_NAMES[0] + '.zip')))
+        self.assertTrue(os.path.exists(os.path.join(self.save_dir, PRODUCT_NAMES[2] + '.zip')))
+
+
+if __name__ == "__main__":
+    unittest.main()
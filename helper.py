@@ -1,13 +1,26 @@
 import os
 import zipfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from osgeo import gdal, ogr, osr, gdalconst
+from osgeo import gdal, ogr, osr, gdalconst, gdal_array
 
 
 # Sen2cor.bat文件所在路径，用于大气校正
 sen2cor_path = r"E:\PycharmProjects\sentinel2_processing\Sen2Cor-02.11.00-win64\L2A_Process.bat"
 
+# 波段叠加的波段名及顺序：可见波段、NIR、RE、SWIR1和SWIR2（波段2、3、4、8、8A、11、12）
+STACK_BANDS = ["B02", "B03", "B04", "B08", "B8A", "B11", "B12"]
+# 各波段的原始分辨率
+BAND_RESOLUTION = {"B02": "10m", "B03": "10m", "B04": "10m", "B08": "10m",
+                   "B05": "20m", "B06": "20m", "B07": "20m", "B8A": "20m", "B11": "20m", "B12": "20m"}
+# 按需堆叠波段时的波段顺序
+BAND_ORDER = ["B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B11", "B12"]
+# 场景分类图（SCL）中作为无效值掩膜的类别：0无数据、8中概率云、9高概率云（类别说明见remove_cloud_shp）
+SCL_MASK_CLASSES = [0, 8, 9]
+# 云概率（MSK_CLDPRB，0-100）文件名
+CLDPRB_FILE_NAME = "MSK_CLDPRB_20m.jp2"
+
 
 def unzip_file(zip_file_name, unzip_path, mode='rb'):
     """
@@ -40,6 +53,58 @@ def unzip_file(zip_file_name, unzip_path, mode='rb'):
     return namelist[0]
 
 
+def get_zip_safe_path(zip_file_name):
+    """
+    不解压.zip文件，直接获取其中.SAFE目录的GDAL虚拟文件路径（/vsizip/）。
+    GDAL可以通过该路径直接读取.zip文件中的jp2波段及MTD元数据XML。
+
+    :param zip_file_name: Sentinel-2 .zip文件路径
+    :return: .SAFE目录的/vsizip/路径
+    """
+    zip_fn = zipfile.ZipFile(zip_file_name)
+    namelist = zip_fn.namelist()
+    zip_fn.close()
+    # .zip文件的第一个成员即.SAFE目录（或其下的文件）
+    safe_name = namelist[0].split('/')[0]
+    safe_path = '/vsizip/' + zip_file_name.replace('\\', '/') + '/' + safe_name
+    return safe_path
+
+
+def is_vsi_path(file_path):
+    """
+    判断路径是否为GDAL虚拟文件路径（如/vsizip/）
+
+    :param file_path: 文件路径
+    :return: 是否为虚拟文件路径
+    """
+    return file_path.startswith('/vsi')
+
+
+def list_dir(dir_path):
+    """
+    列出文件夹下的文件名，同时支持本地路径与GDAL虚拟文件路径
+
+    :param dir_path: 文件夹路径
+    :return: 文件名列表
+    """
+    if is_vsi_path(dir_path):
+        return gdal.ReadDir(dir_path) or []
+    return os.listdir(dir_path)
+
+
+def join_path(dir_path, *names):
+    """
+    拼接路径，GDAL虚拟文件路径统一使用'/'作为分隔符
+
+    :param dir_path: 文件夹路径
+    :param names: 需要拼接的子路径
+    :return: 拼接后的路径
+    """
+    if is_vsi_path(dir_path):
+        return '/'.join((dir_path,) + names)
+    return os.path.join(dir_path, *names)
+
+
 # -------------------------------------------------------------#
 #   Sentinel-2产品解压后为SAFE格式，SAFE文件包含以下几个内容：
 #   一个manifest.safe文件，其中包含 XML 格式的一般产品信息
@@ -57,12 +122,12 @@ def print_s2_info(file_path):
         the file path to be printed.
     """
     xml_path = ''
-    for xml_file in os.listdir(file_path):
+    for xml_file in list_dir(file_path):
         # 判断是否是.SAFE文件
         if 'MSIL2A' in xml_file:
-            xml_path = file_path + os.sep + 'MTD_MSIL2A.xml'
+            xml_path = join_path(file_path, 'MTD_MSIL2A.xml')
         elif 'MSIL1C' in xml_file:
-            xml_path = file_path + os.sep + 'MTD_MSIL1C.xml'
+            xml_path = join_path(file_path, 'MTD_MSIL1C.xml')
     root_ds = gdal.Open(xml_path)
     ds_list = root_ds.GetSubDatasets()  # 获取子数据集。该数据以数据集形式存储且以子数据集形式组织
     for i in range(len(ds_list)):
@@ -83,12 +148,56 @@ def get_image_name(image_directory):
     :param image_directory: jp2数据地址
     :return: 存储地址
     """
-    file = image_directory + '\\R10m'
-    names = os.listdir(file)[0]
+    file = join_path(image_directory, 'R10m')
+    names = sorted(list_dir(file))[0]
     img_name = names[:22]
     return img_name
 
 
+def get_img_data_path(safe_path):
+    """
+    获取.SAFE文件中IMG_DATA文件夹的路径，同时支持解压后的本地路径与/vsizip/路径
+
+    :param safe_path: .SAFE文件路径
+    :return: IMG_DATA文件夹路径
+    """
+    IMG_DATA_path = ""
+    if is_vsi_path(safe_path):
+        # .zip内无法遍历目录树，按SAFE标准结构GRANULE/<granule>/IMG_DATA拼接
+        granule_path = join_path(safe_path, 'GRANULE')
+        granule_name = [name for name in list_dir(granule_path) if not name.startswith('.')][0]
+        IMG_DATA_path = join_path(granule_path, granule_name, 'IMG_DATA')
+    else:
+        # 检索解压目录下的所有子文件夹，找到IMG_DATA文件夹
+        for root, _, _ in os.walk(safe_path):
+            if root.endswith("IMG_DATA"):
+                IMG_DATA_path = root
+    return IMG_DATA_path
+
+
+def get_band_path(img_data_path, img_identifier, band_name, resolution):
+    """
+    拼接单个波段jp2文件的路径，例如 IMG_DATA/R10m/T50TLK_20220825T030519_B04_10m.jp2
+
+    :param img_data_path: IMG_DATA文件夹路径
+    :param img_identifier: Sentinel-2文件的编号
+    :param band_name: 波段名，例如B04
+    :param resolution: 分辨率，例如10m
+    :return: jp2文件路径
+    """
+    return join_path(img_data_path, 'R' + resolution, '%s_%s_%s.jp2' % (img_identifier, band_name, resolution))
+
+
+def get_qi_data_path(img_data_path):
+    """
+    获取与IMG_DATA文件夹同级的QI_DATA文件夹路径（云概率等质量数据）
+
+    :param img_data_path: IMG_DATA文件夹路径
+    :return: QI_DATA文件夹路径
+    """
+    return join_path(os.path.dirname(img_data_path.rstrip('/\\')), 'QI_DATA')
+
+
 # -------------------------------------------------------------#
 #   数据格式转换：
 #   所需要的图像数据储存在IMG_DATA文件夹里，该文件夹内有三个子文件夹，
@@ -188,7 +297,180 @@ def read_img(filename):
     return im_proj, im_geotrans, im_data, im_width, im_height
 
 
-def write_tiff(img_arr, geomatrix, projection, path):
+def read_img_parallel(filename, threads=1, band_list=None, max_size=None):
+    """
+    多线程读图像文件：各波段由单独的线程读取（jp2解码、重采样），GDAL在读取时释放GIL。
+    GDAL数据集对象不能跨线程共享，因此每个线程单独打开数据集。
+    设置max_size时按缩小后的尺寸读取（ReadAsArray的buf_xsize/buf_ysize），GDAL自动使用影像金字塔，
+    jp2数据直接解码较低的小波分辨率级别，不需要解码全分辨率影像。
+
+    :param filename: 输入影像路径
+    :param threads: 读取线程数
+    :param band_list: 需要读取的波段序号列表（从1开始），默认读取全部波段
+    :param max_size: 输出数组的最大边长（像元），默认按原始分辨率读取
+    :return: 输入影像的坐标系、仿射变换参数、影像数组、栅格矩阵的列数、栅格矩阵的行数
+    """
+    dataset = gdal.Open(filename)  # 打开文件
+
+    im_width = dataset.RasterXSize  # 栅格矩阵的列数
+    im_height = dataset.RasterYSize  # 栅格矩阵的行数
+    im_bands = dataset.RasterCount  # 波段数
+    im_geotrans = dataset.GetGeoTransform()  # 仿射矩阵，左上角像素的大地坐标和像素分辨率
+    im_proj = dataset.GetProjection()  # 地图投影信息，字符串表示
+    im_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dataset.GetRasterBand(1).DataType)
+    del dataset
+
+    if band_list is None:
+        band_list = list(range(1, im_bands + 1))
+    # 缩小读取时的输出尺寸及对应的仿射变换参数
+    buf_width, buf_height = im_width, im_height
+    if max_size is not None and max(im_width, im_height) > max_size:
+        scale = max(im_width, im_height) / float(max_size)
+        buf_width = max(1, int(round(im_width / scale)))
+        buf_height = max(1, int(round(im_height / scale)))
+        im_geotrans = (im_geotrans[0], im_geotrans[1] * im_width / buf_width, im_geotrans[2],
+                       im_geotrans[3], im_geotrans[4], im_geotrans[5] * im_height / buf_height)
+
+    # 预先分配多波段数组，各线程直接写入对应波段
+    im_data = np.empty((len(band_list), buf_height, buf_width), dtype=im_dtype)
+
+    def read_band(i):
+        band_dataset = gdal.Open(filename)
+        band_dataset.GetRasterBand(band_list[i]).ReadAsArray(0, 0, im_width, im_height, buf_width, buf_height,
+                                                            buf_obj=im_data[i],
+                                                            resample_alg=gdal.GRIORA_Average)
+        del band_dataset
+
+    threads = max(1, min(threads, len(band_list)))
+    if threads == 1:
+        for i in range(len(band_list)):
+            read_band(i)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # list()用于等待全部线程结束，并抛出线程中的异常
+            list(executor.map(read_band, range(len(band_list))))
+
+    if len(band_list) == 1:
+        im_data = im_data[0]
+    return im_proj, im_geotrans, im_data, buf_width, buf_height
+
+
+def set_gdal_threads(threads, band_threads=1):
+    """
+    设置GDAL内部线程数（GDAL_NUM_THREADS，用于jp2解码、重投影等），
+    与按波段并行的线程数相协调，避免线程总数超过分配给当前进程的CPU核数
+
+    :param threads: 分配给当前进程的线程总数
+    :param band_threads: 按波段并行读取的线程数
+    :return: GDAL内部线程数
+    """
+    gdal_threads = max(1, threads // max(1, band_threads))
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(gdal_threads))
+    return gdal_threads
+
+
+# -------------------------------------------------------------#
+#   GeoTiff创建参数配置：
+#   None   - 条带存储、不压缩（默认，与原有输出一致）
+#   tiled  - 分块存储、不压缩
+#   deflate/zstd - 分块存储、DEFLATE/ZSTD无损压缩（带预测器），多线程压缩
+#   cog    - 云优化GeoTiff（COG），ZSTD压缩并生成内部金字塔
+#   多线程压缩的线程数与GDAL_NUM_THREADS一致；文件超过4GB时自动使用BIGTIFF。
+# -------------------------------------------------------------#
+TIFF_PROFILES = {None: ('GTiff', []),
+                 'tiled': ('GTiff', ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER']),
+                 'deflate': ('GTiff', ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER',
+                                       'COMPRESS=DEFLATE', 'ZLEVEL=6']),
+                 'zstd': ('GTiff', ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER',
+                                    'COMPRESS=ZSTD', 'ZSTD_LEVEL=9']),
+                 'cog': ('COG', ['BLOCKSIZE=512', 'BIGTIFF=IF_SAFER', 'COMPRESS=ZSTD', 'LEVEL=9',
+                                 'PREDICTOR=YES', 'OVERVIEWS=AUTO'])}
+
+
+def get_tiff_profile(profile, datatype):
+    """
+    获取GeoTiff创建参数
+
+    :param profile: 创建参数配置名，见TIFF_PROFILES
+    :param datatype: GDAL数据类型，用于选择压缩预测器（整型为2，浮点型为3）
+    :return: (GDAL驱动名, 创建参数列表)
+    """
+    if profile not in TIFF_PROFILES:
+        raise ValueError("ERROR!!! TIFF profile {} not correctly defined".format(profile))
+    driver_name, options = TIFF_PROFILES[profile]
+    options = list(options)
+    if any(option.startswith('COMPRESS=') for option in options):
+        options.append('NUM_THREADS=' + gdal.GetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS'))
+        if driver_name == 'GTiff':
+            if datatype in (gdal.GDT_Float32, gdal.GDT_Float64):
+                options.append('PREDICTOR=3')
+            else:
+                options.append('PREDICTOR=2')
+    return driver_name, options
+
+
+def create_tiff(path, width, height, bands, datatype, geomatrix, projection, profile=None):
+    """
+    创建空的GeoTiff文件，用于按块写入数据。写入完成后调用finish_tiff关闭。
+    COG格式只能整体复制生成，因此先按块写入不压缩的临时文件，关闭时再转换为COG
+
+    :param path: 输出影像路径
+    :param width: 栅格矩阵的列数
+    :param height: 栅格矩阵的行数
+    :param bands: 波段数
+    :param datatype: GDAL数据类型，例如gdal.GDT_Float32
+    :param geomatrix: 仿射变换参数
+    :param projection: 坐标系
+    :param profile: 创建参数配置名，见TIFF_PROFILES
+    :return: 打开的GDAL数据集
+    """
+    driver_name, options = get_tiff_profile(profile, datatype)
+    if driver_name == 'COG':
+        path = path + '.tmp.tif'
+        driver_name, options = get_tiff_profile('tiled', datatype)
+    driver = gdal.GetDriverByName(driver_name)
+    dataset = driver.Create(path, int(width), int(height), int(bands), datatype, options=options)
+    dataset.SetGeoTransform(geomatrix)  # 写入仿射变换参数
+    dataset.SetProjection(projection)  # 写入投影
+    return dataset
+
+
+def finish_tiff(dataset, path, profile=None):
+    """
+    关闭create_tiff创建的GeoTiff文件，COG格式时由临时文件一次性转换为COG
+
+    :param dataset: create_tiff返回的GDAL数据集
+    :param path: 输出影像路径
+    :param profile: 创建参数配置名，见TIFF_PROFILES
+    """
+    driver_name, options = get_tiff_profile(profile, dataset.GetRasterBand(1).DataType)
+    dataset.FlushCache()
+    if driver_name == 'COG':
+        tmp_path = dataset.GetDescription()
+        gdal.GetDriverByName('COG').CreateCopy(path, dataset, options=options)
+        del dataset
+        gdal.GetDriverByName('GTiff').Delete(tmp_path)
+    else:
+        del dataset
+
+
+def iter_blocks(width, height, block_size=1024):
+    """
+    将栅格按块划分，依次返回每个块的窗口
+
+    :param width: 栅格矩阵的列数
+    :param height: 栅格矩阵的行数
+    :param block_size: 块的边长（像元）
+    :return: 生成器，每次返回(xoff, yoff, xsize, ysize)
+    """
+    for yoff in range(0, height, block_size):
+        ysize = min(block_size, height - yoff)
+        for xoff in range(0, width, block_size):
+            xsize = min(block_size, width - xoff)
+            yield xoff, yoff, xsize, ysize
+
+
+def write_tiff(img_arr, geomatrix, projection, path, profile=None):
     """
     遥感影像的存储，写入GeoTiff文件
 
@@ -196,6 +478,7 @@ def write_tiff(img_arr, geomatrix, projection, path):
     :param geomatrix: 输入影像仿射变换参数
     :param projection: 输入影像坐标系
     :param path: 输出影像路径
+    :param profile: 创建参数配置名，见TIFF_PROFILES
     """
     #     img_bands, img_height, img_width = img_arr.shape
     if 'int8' in img_arr.dtype.name:
@@ -205,47 +488,277 @@ def write_tiff(img_arr, geomatrix, projection, path):
     else:
         datatype = gdal.GDT_Float32
 
-    if len(img_arr.shape) == 3:
-        img_bands, img_height, img_width = img_arr.shape
-        driver = gdal.GetDriverByName("GTiff")
-        dataset = driver.Create(path, int(img_width), int(img_height), int(img_bands), datatype)
-        #     print(path, int(img_width), int(img_height), int(img_bands), datatype)
-        if (dataset is not None) and (geomatrix != '') and (projection != ''):
-            dataset.SetGeoTransform(geomatrix)  # 写入仿射变换参数
-            dataset.SetProjection(projection)  # 写入投影
-        for i in range(img_bands):
-            dataset.GetRasterBand(i + 1).WriteArray(img_arr[i])
-        del dataset
+    if len(img_arr.shape) == 2:
+        img_arr = img_arr[np.newaxis, :, :]
+    img_bands, img_height, img_width = img_arr.shape
 
-    elif len(img_arr.shape) == 2:
-        # img_arr = np.array([img_arr])
-        img_height, img_width = img_arr.shape
-        img_bands = 1
-        # 创建文件
-        driver = gdal.GetDriverByName("GTiff")
-        dataset = driver.Create(path, int(img_width), int(img_height), int(img_bands), datatype)
-        #     print(path, int(img_width), int(img_height), int(img_bands), datatype)
-        if dataset is not None:
-            dataset.SetGeoTransform(geomatrix)  # 写入仿射变换参数
-            dataset.SetProjection(projection)  # 写入投影
-        dataset.GetRasterBand(1).WriteArray(img_arr)
-        del dataset
+    driver_name, options = get_tiff_profile(profile, datatype)
+    if driver_name == 'COG':
+        # COG只能整体复制生成：数组先写入内存数据集，再一次性写出COG
+        driver = gdal.GetDriverByName("MEM")
+        dataset = driver.Create('', int(img_width), int(img_height), int(img_bands), datatype)
+    else:
+        driver = gdal.GetDriverByName(driver_name)
+        dataset = driver.Create(path, int(img_width), int(img_height), int(img_bands), datatype, options=options)
+    if (dataset is not None) and (geomatrix != '') and (projection != ''):
+        dataset.SetGeoTransform(geomatrix)  # 写入仿射变换参数
+        dataset.SetProjection(projection)  # 写入投影
+    for i in range(img_bands):
+        dataset.GetRasterBand(i + 1).WriteArray(img_arr[i])
+    if driver_name == 'COG':
+        gdal.GetDriverByName('COG').CreateCopy(path, dataset, options=options)
+    del dataset
 
 
-def merge_tif(tif_path_list, output_tif):
+def merge_tif(tif_path_list, output_tif, band_names=None, block_size=1024, profile=None):
     """
-    波段叠合，将多个不同波段的的TIF文件合为一个多波段TIF文件
+    波段叠合，将多个不同波段的的TIF文件合为一个多波段TIF文件。
+    各输入影像只打开一次，按块直接写入预先创建的多波段输出影像，内存占用只与块大小有关
 
-    :param tif_path_list: 输入影像列表
+    :param tif_path_list: 输入影像列表（各影像的行列数、坐标系需一致）
     :param output_tif: 输出保存影像
+    :param band_names: 各波段的波段名，写入波段描述
+    :param block_size: 块的边长（像元）
+    :param profile: 输出影像的创建参数配置名，见TIFF_PROFILES
     """
-    global geotrans, proj
-    arr_list = []
-    for tif_path in tif_path_list:
-        proj, geotrans, data, row, column = read_img(tif_path)
-        arr_list.append(data)
-    all_arr = np.array(arr_list)
-    write_tiff(all_arr, geotrans, proj, output_tif)
+    # 以第一景影像的地理信息及数据类型创建输出影像
+    dataset = gdal.Open(tif_path_list[0])
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    datatype = dataset.GetRasterBand(1).DataType
+    out_dataset = create_tiff(output_tif, width, height, len(tif_path_list), datatype,
+                              dataset.GetGeoTransform(), dataset.GetProjection(), profile)
+    del dataset
+
+    for i, tif_path in enumerate(tif_path_list):
+        dataset = gdal.Open(tif_path)
+        in_band = dataset.GetRasterBand(1)
+        out_band = out_dataset.GetRasterBand(i + 1)
+        for xoff, yoff, xsize, ysize in iter_blocks(width, height, block_size):
+            out_band.WriteArray(in_band.ReadAsArray(xoff, yoff, xsize, ysize), xoff, yoff)
+        if band_names is not None:
+            out_band.SetDescription(band_names[i])
+        del in_band, dataset
+    finish_tiff(out_dataset, output_tif, profile)
+
+
+# -------------------------------------------------------------#
+#   虚拟波段叠加：
+#   直接引用各波段的jp2数据构建VRT，不生成中间tif文件。
+#   20m波段在读取时按双线性插值重采样至10m网格。
+# -------------------------------------------------------------#
+def build_stack_vrt(jp2_path_list, vrt_path, band_names=None, x_res=10, y_res=10, resample_alg='bilinear',
+                    output_bounds=None):
+    """
+    构建虚拟波段叠加（VRT），每个输入文件作为VRT的一个波段。
+    设置output_bounds时VRT只包含该范围，读取时只解码jp2中与该范围相交的部分
+
+    :param jp2_path_list: 输入波段文件列表（jp2或tif，本地路径或/vsizip/路径）
+    :param vrt_path: 输出VRT文件路径
+    :param band_names: 各波段的波段名，写入波段描述
+    :param x_res: 输出网格的x方向分辨率
+    :param y_res: 输出网格的y方向分辨率
+    :param resample_alg: 低分辨率波段的重采样方法
+    :param output_bounds: 输出范围(minX, minY, maxX, maxY)，默认为输入文件的全部范围
+    :return: VRT文件路径
+    """
+    vrt_options = gdal.BuildVRTOptions(separate=True,
+                                       resolution='user',
+                                       xRes=x_res,
+                                       yRes=y_res,
+                                       resampleAlg=resample_alg,
+                                       outputBounds=output_bounds)
+    vrt_dataset = gdal.BuildVRT(vrt_path, jp2_path_list, options=vrt_options)
+    if band_names is not None:
+        for i, band_name in enumerate(band_names):
+            vrt_dataset.GetRasterBand(i + 1).SetDescription(band_name)
+    vrt_dataset.FlushCache()
+    del vrt_dataset
+    return vrt_path
+
+
+# -------------------------------------------------------------#
+#   研究区优先（AOI）：
+#   将矢量范围转换到影像坐标系，外扩重采样所需的边距并对齐到输出网格，
+#   波段叠加只引用该窗口，后续步骤只处理研究区范围内的数据。
+#   地块分散时按代价模型将各要素的窗口合并为若干读取窗口：
+#   两个窗口合并后增加的像元数小于单个窗口的固定开销时合并，否则分别读取。
+# -------------------------------------------------------------#
+def get_feature_extents(shp_path, projection):
+    """
+    计算矢量文件各要素转换到指定坐标系后的范围
+
+    :param shp_path: 矢量文件路径
+    :param projection: 目标坐标系（WKT）
+    :return: 各要素的范围[(minX, minY, maxX, maxY), ...]
+    """
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromWkt(projection)
+    dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    shp_dataset = ogr.Open(shp_path)
+    layer = shp_dataset.GetLayer(0)
+    src_srs = layer.GetSpatialRef()
+    transform = None
+    if src_srs is not None:
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src_srs, dst_srs)
+
+    extents = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform is not None:
+            # 逐个要素转换坐标，避免只转换外包矩形四个角点时低估范围
+            geometry.Transform(transform)
+        min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+        extents.append((min_x, min_y, max_x, max_y))
+    del shp_dataset
+    return extents
+
+
+def get_shp_extent(shp_path, projection):
+    """
+    计算矢量文件全部要素转换到指定坐标系后的范围
+
+    :param shp_path: 矢量文件路径
+    :param projection: 目标坐标系（WKT）
+    :return: 范围(minX, minY, maxX, maxY)，矢量文件没有要素时返回None
+    """
+    extents = get_feature_extents(shp_path, projection)
+    if not extents:
+        return None
+    extents = np.array(extents)
+    return (extents[:, 0].min(), extents[:, 1].min(), extents[:, 2].max(), extents[:, 3].max())
+
+
+def get_raster_bounds(raster_path):
+    """
+    读取影像的仿射变换参数、坐标系及范围
+
+    :param raster_path: 影像路径（jp2或tif，本地路径或/vsizip/路径）
+    :return: 仿射变换参数、坐标系（WKT）、范围(minX, minY, maxX, maxY)
+    """
+    dataset = gdal.Open(raster_path)
+    geotrans = dataset.GetGeoTransform()
+    projection = dataset.GetProjection()
+    bounds = (geotrans[0], geotrans[3] + geotrans[5] * dataset.RasterYSize,
+              geotrans[0] + geotrans[1] * dataset.RasterXSize, geotrans[3])
+    del dataset
+    return geotrans, projection, bounds
+
+
+def align_bounds(extent, geotrans, raster_bounds, x_res=10, y_res=10, margin=60):
+    """
+    范围外扩边距后按影像左上角对齐到输出网格，并限制在影像范围内
+
+    :param extent: 范围(minX, minY, maxX, maxY)
+    :param geotrans: 影像的仿射变换参数
+    :param raster_bounds: 影像范围(minX, minY, maxX, maxY)
+    :param x_res: 输出网格的x方向分辨率
+    :param y_res: 输出网格的y方向分辨率
+    :param margin: 外扩的边距（坐标单位），保证边缘像元重采样及裁剪时有足够的邻域
+    :return: 范围(minX, minY, maxX, maxY)，与影像不相交时返回None
+    """
+    min_x = geotrans[0] + np.floor((extent[0] - margin - geotrans[0]) / x_res) * x_res
+    max_x = geotrans[0] + np.ceil((extent[2] + margin - geotrans[0]) / x_res) * x_res
+    max_y = geotrans[3] - np.floor((geotrans[3] - extent[3] - margin) / y_res) * y_res
+    min_y = geotrans[3] - np.ceil((geotrans[3] - extent[1] + margin) / y_res) * y_res
+    bounds = (max(min_x, raster_bounds[0]), max(min_y, raster_bounds[1]),
+              min(max_x, raster_bounds[2]), min(max_y, raster_bounds[3]))
+    if bounds[0] >= bounds[2] or bounds[1] >= bounds[3]:
+        return None
+    return tuple(float(v) for v in bounds)
+
+
+def get_aoi_bounds(shp_path, raster_path, x_res=10, y_res=10, margin=60):
+    """
+    计算研究区在影像中的读取范围：矢量范围外扩边距后对齐到影像网格，并限制在影像范围内
+
+    :param shp_path: 矢量文件路径
+    :param raster_path: 参考影像路径（jp2或tif，本地路径或/vsizip/路径）
+    :param x_res: 输出网格的x方向分辨率
+    :param y_res: 输出网格的y方向分辨率
+    :param margin: 外扩的边距（坐标单位），保证边缘像元重采样及裁剪时有足够的邻域
+    :return: 范围(minX, minY, maxX, maxY)，研究区与影像不相交时返回None
+    """
+    geotrans, projection, raster_bounds = get_raster_bounds(raster_path)
+    extent = get_shp_extent(shp_path, projection)
+    if extent is None:
+        return None
+    return align_bounds(extent, geotrans, raster_bounds, x_res, y_res, margin)
+
+
+def coalesce_windows(windows, x_res=10, y_res=10, overhead=65536):
+    """
+    按代价模型合并读取窗口：读取一个窗口的代价为其像元数加上固定开销，
+    两个窗口的外包矩形比分别读取增加的像元数不超过固定开销时合并为一个窗口；
+    相交的窗口无论代价都合并，合并后的窗口互不重叠，每个像元（及每个要素）只属于一个窗口
+
+    :param windows: 窗口范围列表[(minX, minY, maxX, maxY), ...]
+    :param x_res: 输出网格的x方向分辨率
+    :param y_res: 输出网格的y方向分辨率
+    :param overhead: 每个窗口的固定开销（像元数），包括打开数据集、解码窗口边缘的jp2码块等
+    :return: 合并后的窗口范围列表（互不重叠）
+    """
+    def area(w):
+        return (w[..., 2] - w[..., 0]) * (w[..., 3] - w[..., 1]) / (x_res * y_res)
+
+    windows = np.array(windows, dtype=np.float64).reshape(-1, 4)
+    while True:
+        pending = list(windows)
+        merged = []
+        while pending:
+            window = pending.pop()
+            while pending:
+                others = np.array(pending)
+                union = np.column_stack([np.minimum(others[:, 0], window[0]), np.minimum(others[:, 1], window[1]),
+                                         np.maximum(others[:, 2], window[2]), np.maximum(others[:, 3], window[3])])
+                # 合并后增加的像元数
+                extra = area(union) - area(others) - area(window)
+                # 相交的窗口必须合并，否则重叠部分的像元会在两个窗口中重复输出及统计
+                overlap = ((np.minimum(others[:, 2], window[2]) > np.maximum(others[:, 0], window[0])) &
+                           (np.minimum(others[:, 3], window[3]) > np.maximum(others[:, 1], window[1])))
+                extra[overlap] = -np.inf
+                j = int(np.argmin(extra))
+                if extra[j] > overhead:
+                    break
+                window = union[j]
+                pending.pop(j)
+            merged.append(window)
+        merged = np.array(merged)
+        # 窗口扩大后可能与已确定的窗口相交或满足合并条件，重复直到窗口数不再减少，
+        # 此时任意两个窗口都已比较过，互不相交
+        if len(merged) == len(windows):
+            return [tuple(float(v) for v in w) for w in merged]
+        windows = merged
+
+
+def get_aoi_windows(shp_path, raster_path, x_res=10, y_res=10, margin=60, overhead=65536):
+    """
+    计算分散地块在影像中的读取窗口：各要素范围外扩边距、对齐到影像网格后按代价模型合并，
+    对齐后相交的窗口一并合并，各窗口互不重叠，每个要素完整位于一个窗口中
+
+    :param shp_path: 矢量文件路径
+    :param raster_path: 参考影像路径（jp2或tif，本地路径或/vsizip/路径）
+    :param x_res: 输出网格的x方向分辨率
+    :param y_res: 输出网格的y方向分辨率
+    :param margin: 外扩的边距（坐标单位）
+    :param overhead: 每个窗口的固定开销（像元数）
+    :return: 互不重叠的窗口范围列表[(minX, minY, maxX, maxY), ...]，按从上到下、从左到右排序
+    """
+    geotrans, projection, raster_bounds = get_raster_bounds(raster_path)
+    windows = []
+    for extent in get_feature_extents(shp_path, projection):
+        bounds = align_bounds(extent, geotrans, raster_bounds, x_res, y_res, margin)
+        if bounds is not None:
+            windows.append(bounds)
+    if not windows:
+        return []
+    windows = coalesce_windows(windows, x_res, y_res, overhead)
+    return sorted(windows, key=lambda w: (-w[3], w[0]))
 
 
 def stretch(band, lower_percent=2, higher_percent=98):  # 2和98表示分位数
@@ -292,6 +805,85 @@ def rgb(img_data, iftran=True):
     return img_data
 
 
+# -------------------------------------------------------------#
+#   快视图快速拉伸：
+#   由uint16直方图（np.bincount）计算2%和98%分位数，可以在抽稀后的影像上统计；
+#   再通过65536项的uint8查找表完成拉伸，不生成整景影像的float32副本。
+# -------------------------------------------------------------#
+def histogram_percentile(band, lower_percent=2, higher_percent=98, sample_step=1):
+    """
+    由uint16直方图计算波段的分位数，不抽稀时与np.percentile（线性插值）相同
+
+    :param band: 输入uint16波段
+    :param lower_percent: 波段值频率分布的最低可信百分数
+    :param higher_percent: 波段值频率分布的最高可信百分数
+    :param sample_step: 统计直方图时行列方向的抽稀步长
+    :return: 最低、最高分位数对应的波段值
+    """
+    sample = band[::sample_step, ::sample_step]
+    cdf = np.cumsum(np.bincount(sample.ravel(), minlength=65536))
+    rank_max = cdf[-1] - 1
+    cuts = []
+    for percent in (lower_percent, higher_percent):
+        # 与np.percentile一致：分位数位于第floor(rank)与第floor(rank)+1个（从0开始）排序值之间，按小数部分线性插值，
+        # 第k个排序值v满足 cdf[v-1] <= k < cdf[v]
+        rank = rank_max * percent / 100.0
+        k = int(np.floor(rank))
+        low, high = np.searchsorted(cdf, [k, min(k + 1, rank_max)], side='right')
+        cuts.append(float(low + (rank - k) * (high - low)))
+    return cuts[0], cuts[1]
+
+
+def stretch_lut(c, d):
+    """
+    生成uint16到uint8的线性拉伸查找表，小于c的值为0，大于d的值为255
+
+    :param c: 拉伸下限
+    :param d: 拉伸上限
+    :return: 65536项的uint8查找表
+    """
+    if d <= c:
+        d = c + 1
+    values = np.arange(65536, dtype=np.float32)
+    out = np.clip((values - c) / np.float32(d - c), 0.0, 1.0)
+    return np.uint8(out * 255)
+
+
+def stretch_uint8(band, lower_percent=2, higher_percent=98, sample_step=4):
+    """
+    对uint16波段做快速拉伸，输出0-255的uint8波段
+
+    :param band: 输入uint16波段
+    :param lower_percent: 波段值频率分布的最低可信百分数
+    :param higher_percent: 波段值频率分布的最高可信百分数
+    :param sample_step: 统计直方图时行列方向的抽稀步长
+    :return: uint8波段
+    """
+    c, d = histogram_percentile(band, lower_percent, higher_percent, sample_step)
+    return stretch_lut(c, d)[band]
+
+
+def quick_rgb(img_data, iftran=True, sample_step=4):
+    """
+    由B02,B03,B04生成0-255的真彩色快视图
+
+    :param img_data: 输入影像数组（前三个波段为B02,B03,B04）
+    :param iftran: 判断是否做波段顺序调换的标志
+    :param sample_step: 统计直方图时行列方向的抽稀步长
+    :return: C,H,W顺序的uint8数组
+    """
+    img_data_3b = img_data[:3, :, :]  # 取前三个波段 B02,B03,B04
+    if iftran:
+        img_data_3b = img_data_3b[::-1, :, :]  # 将B02,B03,B04转成B04,B03,B02 (BGR转RGB)
+    if img_data_3b.dtype != np.uint16:
+        # 非uint16数据无法使用查找表，按原方法拉伸
+        return np.uint8(stretch_n(img_data_3b.transpose(1, 2, 0).copy()) * 255).transpose(2, 0, 1)
+    out = np.empty(img_data_3b.shape, dtype=np.uint8)
+    for k in range(3):
+        out[k] = stretch_uint8(img_data_3b[k], sample_step=sample_step)
+    return out
+
+
 def compress(path, target_path, method="LZW"):
     """
     使用gdal进行文件压缩，LZW方法属于无损压缩
@@ -500,3 +1092,41 @@ def remove_cloud_shp(shp_path, tif_path, output_path):
               format="GTiff",  # 输出影像的格式
               cropToCutline=True)  # 将目标图像的范围指定为cutline矢量图像的范围
 
+
+# -------------------------------------------------------------#
+#   去云函数：
+#   （4）栅格云掩膜：直接由场景分类图（SCL）和/或云概率（MSK_CLDPRB）按块生成，
+#   每个产品只计算一次，供各输出（波段叠加、植被指数、重投影及裁剪）共用。
+# -------------------------------------------------------------#
+def create_cloud_mask(src_path, out_path, scl_band=None, mask_classes=SCL_MASK_CLASSES, cldprb_band=None,
+                      cldprb_threshold=None, block_size=1024):
+    """
+    生成云掩膜tif文件，1为无效像元（云、无数据），0为有效像元
+
+    :param src_path: 与波段叠加网格一致的场景分类图/云概率影像（VRT）路径
+    :param out_path: 云掩膜tif文件保存路径
+    :param scl_band: 场景分类图在输入影像中的波段序号，None表示不使用
+    :param mask_classes: 作为无效值掩膜的场景分类类别
+    :param cldprb_band: 云概率在输入影像中的波段序号，None表示不使用
+    :param cldprb_threshold: 云概率阈值（0-100），大于该值的像元为无效像元
+    :param block_size: 块的边长（像元）
+    :return: 云掩膜中无效像元的比例
+    """
+    dataset = gdal.Open(src_path)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    out_dataset = create_tiff(out_path, width, height, 1, gdal.GDT_Byte, dataset.GetGeoTransform(),
+                              dataset.GetProjection(), 'deflate')
+    mask_classes = np.array(mask_classes, dtype=np.uint8)
+    masked = 0
+    for xoff, yoff, xsize, ysize in iter_blocks(width, height, block_size):
+        mask = np.zeros((ysize, xsize), dtype=bool)
+        if scl_band is not None:
+            mask |= np.isin(dataset.GetRasterBand(scl_band).ReadAsArray(xoff, yoff, xsize, ysize), mask_classes)
+        if cldprb_band is not None:
+            mask |= dataset.GetRasterBand(cldprb_band).ReadAsArray(xoff, yoff, xsize, ysize) > cldprb_threshold
+        out_dataset.GetRasterBand(1).WriteArray(mask.astype(np.uint8), xoff, yoff)
+        masked += int(mask.sum())
+    finish_tiff(out_dataset, out_path, 'deflate')
+    del dataset
+    return masked / float(width * height)
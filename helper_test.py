@@ -0,0 +1,78 @@
+import unittest
+import numpy as np
+import helper
+
+
+# -------------------------------------------------------------#
+#   helper中数组计算的测试，不需要影像数据：
+#   直方图分位数与np.percentile比较；读取窗口合并后互不重叠并覆盖原窗口。
+#   运行：python -m unittest helper_test
+# -------------------------------------------------------------#
+class HistogramPercentileTest(unittest.TestCase):
+
+    def test_equals_np_percentile(self):
+        rng = np.random.default_rng(0)
+        for shape in [(1, 1), (1, 7), (13, 17), (200, 300)]:
+            band = rng.integers(0, 12000, size=shape).astype(np.uint16)
+            for lower, higher in [(2, 98), (0, 100), (0.5, 99.5), (25, 75), (50, 50)]:
+                cuts = helper.histogram_percentile(band, lower, higher)
+                np.testing.assert_allclose(cuts, np.percentile(band, [lower, higher]), rtol=0, atol=1e-9)
+
+    def test_repeated_values(self):
+        # 大量重复值及uint16最大值
+        band = np.array([[0, 0, 0, 5], [5, 5, 65535, 65535]], dtype=np.uint16)
+        for percent in [0, 10, 37.5, 50, 90, 100]:
+            cut = helper.histogram_percentile(band, percent, percent)[0]
+            self.assertAlmostEqual(cut, np.percentile(band, percent))
+
+    def test_sample_step(self):
+        # 抽稀后与抽稀样本的np.percentile相同
+        band = np.random.default_rng(1).integers(0, 10000, size=(101, 99)).astype(np.uint16)
+        cuts = helper.histogram_percentile(band, 2, 98, sample_step=4)
+        np.testing.assert_allclose(cuts, np.percentile(band[::4, ::4], [2, 98]), rtol=0, atol=1e-9)
+
+
+class CoalesceWindowsTest(unittest.TestCase):
+
+    def assert_disjoint_cover(self, windows, merged):
+        for i, a in enumerate(merged):
+            for b in merged[i + 1:]:
+                self.assertFalse(min(a[2], b[2]) > max(a[0], b[0]) and min(a[3], b[3]) > max(a[1], b[1]))
+        for w in windows:
+            self.assertTrue(any(m[0] <= w[0] and m[1] <= w[1] and m[2] >= w[2] and m[3] >= w[3] for m in merged))
+
+    def test_overlapping(self):
+        # 相交的窗口即使合并代价高也合并
+        merged = helper.coalesce_windows([(0, 0, 100, 100), (50, 50, 150, 150)], overhead=0)
+        self.assertEqual(merged, [(0, 0, 150, 150)])
+
+    def test_adjacent(self):
+        # 共边的窗口合并后不增加像元，合并
+        merged = helper.coalesce_windows([(0, 0, 100, 100), (100, 0, 200, 100)], overhead=0)
+        self.assertEqual(merged, [(0, 0, 200, 100)])
+        # 对角相邻的窗口合并后增加200个像元，超过固定开销时不合并
+        windows = [(0, 0, 100, 100), (100, 100, 200, 200)]
+        self.assertEqual(sorted(helper.coalesce_windows(windows, overhead=199)), windows)
+        self.assertEqual(helper.coalesce_windows(windows, overhead=200), [(0, 0, 200, 200)])
+
+    def test_far_apart(self):
+        windows = [(0, 0, 100, 100), (10000, 10000, 10100, 10100)]
+        self.assertEqual(sorted(helper.coalesce_windows(windows, overhead=65536)), windows)
+
+    def test_cascade(self):
+        # 前两个窗口合并后与第三个窗口相交，三个窗口合并为一个
+        windows = [(0, 0, 100, 100), (200, 0, 300, 100), (140, 90, 160, 200)]
+        merged = helper.coalesce_windows(windows, overhead=100)
+        self.assertEqual(merged, [(0, 0, 300, 200)])
+
+    def test_random_disjoint(self):
+        rng = np.random.default_rng(0)
+        for overhead in [0, 100, 10000]:
+            corners = rng.integers(0, 100, size=(40, 2)) * 10
+            sizes = rng.integers(1, 10, size=(40, 2)) * 10
+            windows = [tuple(float(v) for v in np.concatenate([c, c + s])) for c, s in zip(corners, sizes)]
+            self.assert_disjoint_cover(windows, helper.coalesce_windows(windows, overhead=overhead))
+
+
+if __name__ == "__main__":
+    unittest.main()
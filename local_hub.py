@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import uuid
+import hashlib
+import datetime
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# -------------------------------------------------------------#
+#   本地模拟的数据中心：
+#   以文件夹中的.zip文件（例如synthetic_safe.make_products生成的模拟产品）作为产品，
+#   提供与欧空局数据中心相同的查询（search）及OData接口（元数据、是否在线、下载），
+#   s2_download的API_URL设为serve_hub返回的地址即可在本地检查下载流程。
+#   查询不按条件筛选，返回全部产品；不检查用户名及密码。
+#   可以指定离线产品，以及每个产品前若干次下载请求返回503、或只返回部分数据后断开，用于检查重试及断点续传；
+#   还可以指定元数据请求失败（返回500）的产品。
+# -------------------------------------------------------------#
+HUB_CHUNK_SIZE = 2 ** 16
+
+
+def get_hub_products(data_path, offline=()):
+    """
+    读取文件夹中的.zip文件作为产品
+
+    :param data_path: 产品文件夹
+    :param offline: 离线产品名（不含.zip）
+    :return: {uuid: {'title', 'path', 'size', 'md5', 'online', 'date'}}，uuid由产品名生成，每次相同
+    """
+    products = {}
+    for file_name in sorted(os.listdir(data_path)):
+        if not file_name.endswith('.zip'):
+            continue
+        title = file_name[:-4]
+        file_path = os.path.join(data_path, file_name)
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(HUB_CHUNK_SIZE), b''):
+                md5.update(block)
+        # 产品名中的成像时间，例如S2A_MSIL2A_20220825T030519_...
+        match = re.search(r'_(\d{8}T\d{6})_', title)
+        date = datetime.datetime.strptime(match.group(1), '%Y%m%dT%H%M%S') if match else datetime.datetime(2022, 1, 1)
+        products[str(uuid.uuid5(uuid.NAMESPACE_URL, title))] = {'title': title, 'path': file_path,
+                                                                'size': os.path.getsize(file_path),
+                                                                'md5': md5.hexdigest(),
+                                                                'online': title not in offline,
+                                                                'date': date}
+    return products
+
+
+def get_odata_timestamp(date):
+    """
+    OData JSON的时间格式/Date(毫秒)/
+    """
+    epoch = datetime.datetime(1970, 1, 1)
+    return '/Date({})/'.format(int((date - epoch).total_seconds() * 1000))
+
+
+def get_odata_product(base_url, product_id, product):
+    """
+    产品的OData记录，字段与sentinelsat解析的字段一致
+    """
+    url = base_url + "odata/v1/Products('{}')".format(product_id)
+    return {'__metadata': {'id': url, 'uri': url, 'type': 'DHuS.Product', 'media_src': url + '/$value'},
+            'Id': product_id,
+            'Name': product['title'],
+            'ContentType': 'application/octet-stream',
+            'ContentLength': str(product['size']),
+            'Checksum': {'Algorithm': 'MD5', 'Value': product['md5'].upper()},
+            'ContentDate': {'Start': get_odata_timestamp(product['date']),
+                            'End': get_odata_timestamp(product['date'])},
+            'ContentGeometry': '<gml:Polygon srsName="http://www.opengis.net/gml/srs/epsg.xml#4326" '
+                               'xmlns:gml="http://www.opengis.net/gml"><gml:outerBoundaryIs><gml:LinearRing>'
+                               '<gml:coordinates>40.2,115.5 40.2,116.0 40.5,116.0 40.5,115.5 40.2,115.5'
+                               '</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs></gml:Polygon>',
+            'CreationDate': get_odata_timestamp(product['date']),
+            'IngestionDate': get_odata_timestamp(product['date']),
+            'Online': product['online'],
+            'Attributes': {'results': []}}
+
+
+def get_search_entry(base_url, product_id, product):
+    """
+    产品的查询（OpenSearch JSON）记录
+    """
+    url = base_url + "odata/v1/Products('{}')".format(product_id)
+    date = product['date'].strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return {'id': product_id,
+            'title': product['title'],
+            'link': [{'href': url + '/$value'},
+                     {'rel': 'alternative', 'href': url + '/'},
+                     {'rel': 'icon', 'href': url + "/Products('Quicklook')/$value"}],
+            'summary': 'Date: {}, Size: {} bytes'.format(date, product['size']),
+            'date': [{'name': 'beginposition', 'content': date}, {'name': 'endposition', 'content': date}],
+            'double': {'name': 'cloudcoverpercentage', 'content': '0.0'},
+            'str': [{'name': 'platformname', 'content': 'Sentinel-2'},
+                    {'name': 'size', 'content': '{:.2f} MB'.format(product['size'] / 1024 ** 2)},
+                    {'name': 'uuid', 'content': product_id}]}
+
+
+class HubRequestHandler(BaseHTTPRequestHandler):
+    """
+    模拟数据中心的请求处理，产品及故障设置保存在self.server上（见serve_hub）
+    """
+
+    def log_message(self, format, *args):
+        # 不打印每个请求
+        pass
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = urllib.parse.unquote(url.path)
+        base_url = 'http://{}:{}/'.format(*self.server.server_address[:2])
+        products = self.server.products
+        with self.server.lock:
+            self.server.requests.append(path)
+
+        if path == '/search':
+            rows = int(query.get('rows', ['100'])[0])
+            start = int(query.get('start', ['0'])[0])
+            product_ids = list(products)[start:start + rows]
+            self.send_json({'feed': {'opensearch:totalResults': str(len(products)),
+                                     'entry': [get_search_entry(base_url, product_id, products[product_id])
+                                               for product_id in product_ids]}})
+            return
+
+        if path == '/odata/v1/Products':
+            product_ids = re.findall(r"Id eq '([^']+)'", query.get('$filter', [''])[0])
+            self.send_json({'d': {'results': [get_odata_product(base_url, product_id, products[product_id])
+                                              for product_id in product_ids if product_id in products and
+                                              product_id not in self.server.broken_metadata]}})
+            return
+
+        match = re.match(r"^/odata/v1/Products\('([^']+)'\)(/Online)?(/\$value)?$", path)
+        if match is None or match.group(1) not in products:
+            self.send_json({'error': {'message': {'value': 'Not found: ' + path}}}, 404)
+            return
+        product_id = match.group(1)
+        product = products[product_id]
+        if match.group(2):
+            body = str(product['online']).lower().encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif match.group(3):
+            self.send_product(product_id, product)
+        elif product_id in self.server.broken_metadata:
+            self.send_json({'error': {'message': {'value': 'Internal server error'}}}, 500)
+        else:
+            self.send_json({'d': get_odata_product(base_url, product_id, product)})
+
+    def send_product(self, product_id, product):
+        if not product['online']:
+            self.send_json({'error': {'message': {'value': 'Product is offline'}}}, 403)
+            return
+        with self.server.lock:
+            count = self.server.download_counts.get(product_id, 0) + 1
+            self.server.download_counts[product_id] = count
+        if count <= self.server.failures:
+            self.send_json({'error': {'message': {'value': 'Service unavailable'}}}, 503)
+            return
+
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match is not None:
+            start = int(match.group(1))
+            with self.server.lock:
+                self.server.ranges.append((product_id, start))
+            if start >= product['size']:
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        length = product['size'] - start
+        # 前truncations次下载只返回一半数据后断开
+        truncated = count <= self.server.failures + self.server.truncations
+        self.send_response(200 if match is None else 206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        if match is not None:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, product['size'] - 1, product['size']))
+        self.end_headers()
+        with open(product['path'], 'rb') as f:
+            f.seek(start)
+            remaining = length // 2 if truncated else length
+            while remaining > 0:
+                block = f.read(min(HUB_CHUNK_SIZE, remaining))
+                self.wfile.write(block)
+                remaining -= len(block)
+        if truncated:
+            self.close_connection = True
+
+
+def serve_hub(data_path, host='127.0.0.1', port=0, offline=(), failures=0, truncations=0, broken_metadata=()):
+    """
+    在后台线程中启动模拟数据中心
+
+    :param data_path: 产品文件夹（.zip文件）
+    :param host: 监听地址
+    :param port: 监听端口，0为任意空闲端口
+    :param offline: 离线产品名（不含.zip）
+    :param failures: 每个产品前failures次下载请求返回503
+    :param truncations: 之后truncations次下载请求只返回一半数据后断开
+    :param broken_metadata: 元数据请求失败的产品名（不含.zip）：批量请求不返回，逐个请求返回500
+    :return: (server, API地址)，用server.shutdown()停止；server.requests为收到的请求路径，
+             server.ranges为断点续传请求的(产品uuid, 起始字节)
+    """
+    server = ThreadingHTTPServer((host, port), HubRequestHandler)
+    server.daemon_threads = True
+    server.products = get_hub_products(data_path, offline)
+    server.failures = failures
+    server.truncations = truncations
+    server.broken_metadata = set(product_id for product_id in server.products
+                                 if server.products[product_id]['title'] in broken_metadata)
+    server.download_counts = {}
+    server.requests = []
+    server.ranges = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}/'.format(*server.server_address[:2])
+
+
+local_hub_parameter = {'DATA_PATH': 'G:/s2_processing/benchmark/products',
+                       'SAVE_DIR': 'G:/s2_processing/hub_download',
+                       'FAILURES': 1,
+                       'TRUNCATIONS': 1
+                       }
+
+
+if __name__ == "__main__":
+    import sentinel2_download as s2d
+
+    server, api_url = serve_hub(local_hub_parameter['DATA_PATH'], failures=local_hub_parameter['FAILURES'],
+                                truncations=local_hub_parameter['TRUNCATIONS'])
+    print('Local hub serving {} products at {}'.format(len(server.products), api_url))
+    try:
+        s2d.s2_download({'USER_NAME': 'user',
+                         'PASSWORD': 'password',
+                         'FOOTPRINT': 'POLYGON((115.5 40.2, 116.0 40.2, 116.0 40.5, 115.5 40.5, 115.5 40.2))',
+                         'START_DATE': '20220801',
+                         'END_DATE': '20220901',
+                         'PRODUCT_TYPE': 'S2MSI2A',
+                         'CLOUD_COVER_PERCENTAGE': 30,
+                         'SAVE_DIR': local_hub_parameter['SAVE_DIR'],
+                         'API_URL': api_url,
+                         'RETRY_DELAY': 0.1})
+    finally:
+        server.shutdown()
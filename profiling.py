@@ -0,0 +1,192 @@
+import os
+import csv
+import json
+import time
+import datetime
+import threading
+import contextlib
+
+# psutil为可选依赖：安装后记录各阶段的内存峰值及读写字节数，否则只记录时间
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# -------------------------------------------------------------#
+#   分阶段性能记录：
+#   处理流程的各阶段（解压、波段叠加、植被指数、快视图、重投影、裁剪、大气校正等）
+#   记录墙钟时间、CPU时间（含GDAL等库的内部线程及Sen2Cor子进程）、内存峰值及读写字节数，
+#   每个阶段一行JSON追加到记录文件中，批次完成后可以汇总为按阶段统计的表格。
+#   记录文件在多次运行之间累积，每条记录带有批次编号（run），汇总时只统计指定批次的记录。
+#   内存峰值由后台线程按PROFILE_INTERVAL间隔采样常驻内存（RSS）得到。
+#   记录文件、批次编号及当前产品为进程内的全局设置，由set_profile在每个（子）进程中设置。
+# -------------------------------------------------------------#
+PROFILE_FILE_NAME = "profile.jsonl"
+# 内存采样间隔（秒）
+PROFILE_INTERVAL = 0.05
+
+# 当前进程的记录文件路径、批次编号及产品名，记录文件为None时不记录
+PROFILE_STATE = {'path': None, 'run': None, 'product': None}
+
+
+def new_run_id():
+    """
+    生成批次编号：批次开始时间及进程号，例如20221018T153000-12345
+
+    :return: 批次编号
+    """
+    return '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid())
+
+
+def set_profile(profile_path, product=None, run=None):
+    """
+    设置当前进程的记录文件、批次编号及正在处理的产品
+
+    :param profile_path: JSON-lines记录文件路径，None为不记录
+    :param product: 产品名，写入各条记录
+    :param run: 批次编号（见new_run_id），写入各条记录
+    """
+    PROFILE_STATE['path'] = profile_path
+    PROFILE_STATE['run'] = run
+    PROFILE_STATE['product'] = product
+
+
+def get_io_counters(process):
+    """
+    进程累计的读写字节数
+
+    :param process: psutil.Process
+    :return: (读字节数, 写字节数)，无法获取时为(None, None)
+    """
+    try:
+        counters = process.io_counters()
+    except (AttributeError, psutil.Error):
+        # macOS不支持io_counters
+        return None, None
+    return counters.read_bytes, counters.write_bytes
+
+
+def get_cpu_time():
+    """
+    进程及已结束的子进程（例如Sen2Cor）的CPU时间之和，Windows下不含子进程
+
+    :return: CPU时间（秒）
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def sample_memory(process, peak, stopped):
+    """
+    后台线程：按PROFILE_INTERVAL间隔采样进程的常驻内存，直至stopped被设置
+
+    :param process: psutil.Process
+    :param peak: 保存峰值的字典{'rss': 字节数}
+    :param stopped: threading.Event
+    """
+    while not stopped.wait(PROFILE_INTERVAL):
+        peak['rss'] = max(peak['rss'], process.memory_info().rss)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    记录一个处理阶段，用法：with profiling.stage('quicklook'): ...
+    阶段出错时同样记录，并标记failed
+
+    :param name: 阶段名
+    :param fields: 写入记录的其他字段，例如window、indices
+    """
+    profile_path = PROFILE_STATE['path']
+    if profile_path is None:
+        yield
+        return
+
+    process = psutil.Process() if psutil is not None else None
+    sampler = None
+    read_bytes = write_bytes = None
+    if process is not None:
+        read_bytes, write_bytes = get_io_counters(process)
+        peak = {'rss': process.memory_info().rss}
+        stopped = threading.Event()
+        sampler = threading.Thread(target=sample_memory, args=(process, peak, stopped), daemon=True)
+        sampler.start()
+    wall_start = time.perf_counter()
+    cpu_start = get_cpu_time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        record = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'run': PROFILE_STATE['run'],
+                  'product': PROFILE_STATE['product'],
+                  'stage': name,
+                  'wall': round(time.perf_counter() - wall_start, 3),
+                  'cpu': round(get_cpu_time() - cpu_start, 3),
+                  'peak_rss': None, 'read_bytes': None, 'write_bytes': None,
+                  'pid': os.getpid()}
+        if sampler is not None:
+            stopped.set()
+            sampler.join()
+            record['peak_rss'] = max(peak['rss'], process.memory_info().rss)
+            if read_bytes is not None:
+                read_end, write_end = get_io_counters(process)
+                record['read_bytes'] = read_end - read_bytes
+                record['write_bytes'] = write_end - write_bytes
+        record.update(fields)
+        if failed:
+            record['failed'] = True
+        # 每条记录一次写入一行，多个进程可以同时追加
+        with open(profile_path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+def summarize_profile(profile_path, summary_path=None, run=None):
+    """
+    按阶段汇总记录文件：次数、总时间及平均时间、CPU时间、内存峰值、读写字节数，打印并可保存为CSV
+
+    :param profile_path: JSON-lines记录文件路径
+    :param summary_path: 汇总表保存路径（.csv），默认只打印
+    :param run: 只汇总该批次的记录，None为汇总全部记录
+    :return: 汇总表各行{列名: 值}
+    """
+    stages = {}
+    with open(profile_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if run is not None and record.get('run') != run:
+                continue
+            stages.setdefault(record['stage'], []).append(record)
+
+    columns = ['stage', 'count', 'wall_total', 'wall_mean', 'wall_max', 'cpu_total', 'peak_rss_max_mb',
+               'read_mb', 'write_mb']
+    rows = []
+    for name in stages:
+        records = stages[name]
+        walls = [record['wall'] for record in records]
+        peaks = [record['peak_rss'] for record in records if record.get('peak_rss') is not None]
+        reads = [record['read_bytes'] for record in records if record.get('read_bytes') is not None]
+        writes = [record['write_bytes'] for record in records if record.get('write_bytes') is not None]
+        rows.append({'stage': name,
+                     'count': len(records),
+                     'wall_total': round(sum(walls), 3),
+                     'wall_mean': round(sum(walls) / len(walls), 3),
+                     'wall_max': round(max(walls), 3),
+                     'cpu_total': round(sum(record['cpu'] for record in records), 3),
+                     'peak_rss_max_mb': round(max(peaks) / 1024 ** 2, 1) if peaks else None,
+                     'read_mb': round(sum(reads) / 1024 ** 2, 1) if reads else None,
+                     'write_mb': round(sum(writes) / 1024 ** 2, 1) if writes else None})
+    rows.sort(key=lambda row: row['wall_total'], reverse=True)
+
+    print(' '.join('{:>16}'.format(column) for column in columns))
+    for row in rows:
+        print(' '.join('{:>16}'.format('-' if row[column] is None else str(row[column])) for column in columns))
+    if summary_path is not None:
+        with open(summary_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(summary_path + " has been created")
+    return rows
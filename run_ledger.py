@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+import sqlite3
+import datetime
+import cal_index as ci
+
+
+# -------------------------------------------------------------#
+#   运行记录（断点续跑）：
+#   OUTPUT_PATH下的SQLite数据库记录每景产品已完成的各个输出及其指纹，
+#   指纹由输入产品（文件名、大小、修改时间）及影响该输出的参数计算，
+#   重新运行时只处理缺失、参数或输入已改变、或文件已被删除的输出，
+#   例如在已完成的批次中增加CAL_OSAVI只计算OSAVI（增加需要新波段的指数时还重新生成波段叠加）。
+#   输出名为输出文件名去掉产品编号后的部分，例如ndvi、merge、proj_ndvi、clip；
+#   地块统计表按植被指数记录为zonal_ndvi等。
+# -------------------------------------------------------------#
+LEDGER_FILE_NAME = "run_ledger.sqlite"
+
+
+def get_file_fingerprint(file_path):
+    """
+    文件的指纹：文件名、大小及修改时间，不读取文件内容
+
+    :param file_path: 文件路径
+    :return: [文件名, 大小, 修改时间]
+    """
+    stat = os.stat(file_path)
+    return [os.path.basename(file_path), stat.st_size, int(stat.st_mtime)]
+
+
+def get_dbf_path(shp_path):
+    """
+    Shapefile的属性表（.dbf）路径
+
+    :param shp_path: .shp文件路径
+    :return: .dbf文件路径
+    """
+    base_path = os.path.splitext(shp_path)[0]
+    for extension in ('.dbf', '.DBF'):
+        if os.path.exists(base_path + extension):
+            return base_path + extension
+    raise ValueError("ERROR!!! The attribute table (.dbf) of " + shp_path + " not found")
+
+
+def get_output_params(params):
+    """
+    批次中各输出名及影响该输出的参数
+
+    :param params: 检查后的数据处理参数
+    :return: {输出名: 参数}
+    """
+    # 影响全部输出的参数：研究区窗口、云掩膜及输出格式
+    common = {name: params.get(name) for name in ('AOI_FIRST', 'AOI_SPARSE', 'AOI_WINDOW_OVERHEAD', 'CLOUD_MASK',
+                                                  'CLOUD_MASK_CLASSES', 'CLOUD_PROB_THRESHOLD', 'TIFF_PROFILE')}
+    if params['AOI_FIRST'] or params['AOI_SPARSE'] or params['ZONAL_STATS'] or params['CLIP_TO_SHP']:
+        common['SHP_FILE_PATH'] = get_file_fingerprint(params['SHP_FILE_PATH'])
+    indices = params['INDICES']
+    # 波段叠加的波段由植被指数及快视图确定，指纹只包括波段，增减不需要新波段的植被指数时不重新计算波段叠加
+    stack = dict(common, BANDS=ci.get_stack_bands(indices, params['QUICK_IMG'], params['STACK_ALL_BANDS']))
+
+    output_params = {}
+    for index_name in indices:
+        output_params[index_name] = dict(common, INDEX=indices[index_name])
+    if params['SAVE_MERGE']:
+        output_params['merge'] = stack
+    if params['QUICK_IMG']:
+        output_params['quickimg'] = dict(common, QUICK_IMG_SIZE=params.get('QUICK_IMG_SIZE'))
+    if params['SAVE_SCL']:
+        output_params['scl'] = dict(common)
+    if params['REPROJECT']:
+        for index_name in indices:
+            output_params['proj_' + index_name] = dict(output_params[index_name], CRS=params['CRS'])
+        if params['SAVE_PROJECTED']:
+            output_params['projected'] = dict(stack, CRS=params['CRS'])
+    if params['CLIP_TO_SHP']:
+        for index_name in indices:
+            output_params['clip_' + index_name] = dict(output_params[index_name])
+        if params['SAVE_CLIP']:
+            output_params['clip'] = stack
+    if params['ZONAL_STATS']:
+        zonal = {'ZONAL_ID_FIELD': params.get('ZONAL_ID_FIELD'), 'ZONAL_FORMAT': params['ZONAL_FORMAT'],
+                 'ZONAL_PERCENTILES': params['ZONAL_PERCENTILES']}
+        if params.get('ZONAL_ID_FIELD') is not None:
+            # 地块编号取自属性表，修改属性表（.dbf）后重新统计
+            zonal['SHP_DBF'] = get_file_fingerprint(get_dbf_path(params['SHP_FILE_PATH']))
+        for index_name in indices:
+            output_params['zonal_' + index_name] = dict(output_params[index_name], **zonal)
+    return output_params
+
+
+def get_fingerprints(zip_file_path, params):
+    """
+    计算产品各输出的指纹
+
+    :param zip_file_path: 产品的.zip文件路径
+    :param params: 检查后的数据处理参数
+    :return: {输出名: 指纹}
+    """
+    product = get_file_fingerprint(zip_file_path)
+    output_params = get_output_params(params)
+    return {name: hashlib.sha1(json.dumps([product, name, output_params[name]], sort_keys=True,
+                                          default=str).encode()).hexdigest()
+            for name in output_params}
+
+
+def open_ledger(output_path):
+    """
+    打开（不存在时创建）输出文件夹下的运行记录数据库，多个进程可以同时打开，写入时由SQLite加锁
+
+    :param output_path: 输出文件夹
+    :return: 数据库连接
+    """
+    connection = sqlite3.connect(os.path.join(output_path, LEDGER_FILE_NAME), timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS outputs (product TEXT, name TEXT, fingerprint TEXT, path TEXT, "
+                       "finished TEXT, PRIMARY KEY (product, name))")
+    return connection
+
+
+def get_pending_outputs(output_path, product, fingerprints):
+    """
+    获取产品尚未完成的输出：没有记录、指纹不一致或记录的文件已不存在
+
+    :param output_path: 输出文件夹
+    :param product: 产品名（.zip文件名）
+    :param fingerprints: get_fingerprints返回的{输出名: 指纹}
+    :return: 尚未完成的输出名集合
+    """
+    connection = open_ledger(output_path)
+    try:
+        records = {name: (fingerprint, path) for name, fingerprint, path in connection.execute(
+            "SELECT name, fingerprint, path FROM outputs WHERE product = ?", (product,))}
+    finally:
+        connection.close()
+    pending = set()
+    for name in fingerprints:
+        if name not in records or records[name][0] != fingerprints[name]:
+            pending.add(name)
+        elif records[name][1] and not os.path.exists(records[name][1]):
+            pending.add(name)
+    return pending
+
+
+def record_outputs(output_path, product, fingerprints, outputs):
+    """
+    记录产品已完成的输出，未生成文件的输出（例如产品与研究区不相交）记录为空路径，同样视为已完成
+
+    :param output_path: 输出文件夹
+    :param product: 产品名（.zip文件名）
+    :param fingerprints: 本次完成的{输出名: 指纹}
+    :param outputs: 本次生成的{输出名: 文件路径}
+    """
+    finished = datetime.datetime.now().isoformat(timespec='seconds')
+    connection = open_ledger(output_path)
+    try:
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)",
+                                   [(product, name, fingerprints[name], outputs.get(name, ''), finished)
+                                    for name in fingerprints])
+    finally:
+        connection.close()
+
+
+def is_pending(params, name):
+    """
+    输出是否需要在本次运行中生成
+
+    :param params: 数据处理参数，PENDING_OUTPUTS为None时生成全部输出
+    :param name: 输出名
+    :return: 是否需要生成
+    """
+    return params.get('PENDING_OUTPUTS') is None or name in params['PENDING_OUTPUTS']
+
+
+def get_pending_indices(params, prefixes=('',)):
+    """
+    本次运行中需要计算的植被指数：带任一前缀的输出尚未完成的指数
+
+    :param params: 数据处理参数
+    :param prefixes: 输出名前缀，例如''、'proj_'、'zonal_'
+    :return: {植被指数名: (表达式, 值域)}
+    """
+    indices = params['INDICES']
+    return {index_name: indices[index_name] for index_name in indices
+            if any(is_pending(params, prefix + index_name) for prefix in prefixes)}
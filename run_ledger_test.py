@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+import run_ledger as rl
+import sentinel2_process as s2p
+
+
+# -------------------------------------------------------------#
+#   运行记录的测试，不需要影像数据：
+#   在临时文件夹中检查尚未完成的输出：没有记录、指纹改变（参数或输入产品改变）、记录的文件已被删除。
+#   运行：python -m unittest run_ledger_test
+# -------------------------------------------------------------#
+PRODUCT_NAME = 'S2A_MSIL2A_20220825T030519_N0400_R075_T50TLK_20220825T080000.zip'
+
+
+class RunLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.work_path, 'raw')
+        self.output_path = os.path.join(self.work_path, 'export')
+        os.makedirs(self.input_path)
+        os.makedirs(self.output_path)
+        self.zip_path = os.path.join(self.input_path, PRODUCT_NAME)
+        with open(self.zip_path, 'wb') as f:
+            f.write(b'product')
+        self.params = {'INPUT_PATH': self.input_path, 'OUTPUT_PATH': self.output_path, 'CAL_NDVI': True}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path, ignore_errors=True)
+
+    def get_fingerprints(self, **params):
+        return rl.get_fingerprints(self.zip_path, s2p.check_process_params(dict(self.params, **params)))
+
+    def finish(self, fingerprints):
+        # 模拟处理完成：生成各输出文件并记录
+        outputs = {}
+        for name in fingerprints:
+            outputs[name] = os.path.join(self.output_path, name + '.tif')
+            with open(outputs[name], 'w') as f:
+                f.write(name)
+        rl.record_outputs(self.output_path, PRODUCT_NAME, fingerprints, outputs)
+        return outputs
+
+    def test_pending(self):
+        fingerprints = self.get_fingerprints()
+        self.assertIn('ndvi', fingerprints)
+        # 没有记录时全部输出尚未完成
+        self.assertEqual(rl.get_pending_outputs(self.output_path, PRODUCT_NAME, fingerprints), set(fingerprints))
+        self.finish(fingerprints)
+        self.assertEqual(rl.get_pending_outputs(self.output_path, PRODUCT_NAME, fingerprints), set())
+        self.assertTrue(os.path.exists(os.path.join(self.output_path, rl.LEDGER_FILE_NAME)))
+        # 其他产品没有记录
+        self.assertEqual(rl.get_pending_outputs(self.output_path, 'other.zip', fingerprints), set(fingerprints))
+
+    def test_changed_fingerprint(self):
+        self.finish(self.get_fingerprints())
+        # 增加植被指数只计算新的指数，需要新波段（B11）时重新生成波段叠加
+        fingerprints = self.get_fingerprints(CAL_OSAVI=True)
+        self.assertEqual(rl.get_pending_outputs(self.output_path, PRODUCT_NAME, fingerprints), {'osavi'})
+        fingerprints = self.get_fingerprints(CAL_NDMI=True)
+        self.assertEqual(rl.get_pending_outputs(self.output_path, PRODUCT_NAME, fingerprints), {'ndmi', 'merge'})
+        # 影响全部输出的参数改变
+        fingerprints = self.get_fingerprints(TIFF_PROFILE='zstd')
+        self.assertEqual(rl.get_pending_outputs(self.output_path, PRODUCT_NAME, fingerprints), set(fingerprints))
+        # 输入产品改变（大小不同）
+        with open(self.zip_path, 'ab') as f:
+            f.write(b'more')
+        fingerprints = self.get_fingerprints()
+        self.assertEqual(rl.get_pending_outputs(self.output_path, PRODUCT_NAME, fingerprints), set(fingerprints))
+
+    def test_deleted_file(self):
+        fingerprints = self.get_fingerprints()
+        outputs = self.finish(fingerprints)
+        os.remove(outputs['ndvi'])
+        self.assertEqual(rl.get_pending_outputs(self.output_path, PRODUCT_NAME, fingerprints), {'ndvi'})
+        # 记录为空路径的输出（例如产品与研究区不相交）不因文件不存在而重新计算
+        rl.record_outputs(self.output_path, PRODUCT_NAME, {'ndvi': fingerprints['ndvi']}, {})
+        self.assertEqual(rl.get_pending_outputs(self.output_path, PRODUCT_NAME, fingerprints), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
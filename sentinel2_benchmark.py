@@ -0,0 +1,334 @@
+import os
+import json
+import time
+import shutil
+import platform
+import datetime
+from osgeo import gdal
+import helper
+import cal_index as ci
+import sentinel2_process as s2p
+import synthetic_safe as ss
+
+
+# -------------------------------------------------------------#
+#   性能基准：
+#   生成模拟的Sentinel-2产品（见synthetic_safe），分别计时helper、cal_index的各处理阶段
+#   以及s2_l2a_process的完整流程，每项重复REPEAT次取最短时间，与保存的基准结果比较，
+#   慢于基准超过TOLERANCE的项标记为slower。模拟产品按SIZE缓存在WORK_PATH中，重复运行时不再生成。
+#   基准结果与机器相关，记录生成基准时的机器信息，机器不同时给出提示。
+# -------------------------------------------------------------#
+# 基准项名称，按此顺序计时
+BENCHMARKS = ['helper.build_stack_vrt', 'helper.read_img_parallel', 'helper.create_cloud_mask', 'helper.quick_rgb',
+              'helper.write_tiff', 'cal_index.cal_indices', 'cal_index.cal_indices_masked', 's2_l2a_process',
+              's2_l2a_process_zip']
+
+
+# ---------------------------------------------------#
+#   Checking benchmark parameters
+# ---------------------------------------------------#
+def check_benchmark_params(params):
+    """
+    Checking benchmark parameters and filling in the default values.
+
+    :param params: These parameters determine the benchmark parameters.
+    :return: The checked parameters.
+    """
+    params = dict(params)
+
+    if params.get('WORK_PATH') is None:
+        raise ValueError("ERROR!!! Parameter WORK_PATH not correctly defined")
+    if params.get('SIZE') is None:
+        # 十分之一图幅（10980/10）
+        params['SIZE'] = 1098
+    if params['SIZE'] < 6 or params['SIZE'] % 6 != 0:
+        raise ValueError("ERROR!!! Parameter SIZE not correctly defined")
+    if params.get('PRODUCTS') is None:
+        params['PRODUCTS'] = 2
+    if params['PRODUCTS'] < 1:
+        raise ValueError("ERROR!!! Parameter PRODUCTS not correctly defined")
+    if params.get('REPEAT') is None:
+        params['REPEAT'] = 3
+    if params['REPEAT'] < 1:
+        raise ValueError("ERROR!!! Parameter REPEAT not correctly defined")
+    if params.get('BENCHMARKS') is None:
+        params['BENCHMARKS'] = BENCHMARKS
+    for name in params['BENCHMARKS']:
+        if name not in BENCHMARKS:
+            raise ValueError("ERROR!!! Benchmark {} not correctly defined".format(name))
+    if params.get('BASELINE_PATH') is None:
+        params['BASELINE_PATH'] = os.path.join(params['WORK_PATH'], "benchmark_baseline.json")
+    if params.get('UPDATE_BASELINE') is None:
+        params['UPDATE_BASELINE'] = False
+    if params.get('TOLERANCE') is None:
+        params['TOLERANCE'] = 0.2
+    if params.get('WORKERS') is None:
+        params['WORKERS'] = 1
+    if params['WORKERS'] < 1:
+        raise ValueError("ERROR!!! Parameter WORKERS not correctly defined")
+    if params.get('THREADS') is None:
+        params['THREADS'] = max(1, (os.cpu_count() or 1) // params['WORKERS'])
+    if params.get('BLOCK_SIZE') is None:
+        params['BLOCK_SIZE'] = 1024
+    if params.get('TIFF_PROFILE') not in helper.TIFF_PROFILES:
+        raise ValueError("ERROR!!! Parameter TIFF_PROFILE not correctly defined")
+
+    return params
+
+
+def get_machine_info():
+    """
+    机器信息，基准结果只在相同的机器上可比
+
+    :return: {名称: 值}
+    """
+    return {'node': platform.node(), 'machine': platform.machine(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+            'gdal': gdal.__version__}
+
+
+def prepare_products(params):
+    """
+    生成（已存在时复用）模拟产品：.zip文件用于完整流程，第一景的.SAFE文件夹用于分阶段计时
+
+    :param params: 检查后的基准参数
+    :return: 准备好的数据字典
+    """
+    WORK_PATH = params['WORK_PATH']
+    SIZE = params['SIZE']
+    PRODUCTS = params['PRODUCTS']
+
+    product_path = os.path.join(WORK_PATH, "products_{}".format(SIZE))
+    zip_path_list = sorted(os.path.join(product_path, file_name) for file_name in os.listdir(product_path)
+                           if file_name.endswith('.zip')) if os.path.exists(product_path) else []
+    if len(zip_path_list) != PRODUCTS:
+        print("Generating {} synthetic L2A products of {}×{} pixels".format(PRODUCTS, SIZE, SIZE))
+        if os.path.exists(product_path):
+            shutil.rmtree(product_path)
+        zip_path_list = ss.make_products(product_path, 'L2A', PRODUCTS, SIZE)
+    safe_path = os.path.join(WORK_PATH, "safe_{}".format(SIZE))
+    if not os.path.exists(safe_path):
+        helper.unzip_file(zip_path_list[0], safe_path)
+    safe_file_path = os.path.join(safe_path, [name for name in os.listdir(safe_path) if name.endswith('.SAFE')][0])
+
+    IMG_DATA_path = helper.get_img_data_path(safe_file_path)
+    img_identifier = helper.get_image_name(IMG_DATA_path)
+    band_names = list(helper.STACK_BANDS)
+    scratch_path = os.path.join(WORK_PATH, "scratch")
+    if os.path.exists(scratch_path):
+        shutil.rmtree(scratch_path)
+    os.makedirs(scratch_path)
+    return {'zip_path_list': zip_path_list,
+            'band_names': band_names,
+            'jp2_path_list': [helper.get_band_path(IMG_DATA_path, img_identifier, band_name,
+                                                   helper.BAND_RESOLUTION[band_name]) for band_name in band_names],
+            'scl_path': helper.get_band_path(IMG_DATA_path, img_identifier, 'SCL', '20m'),
+            'cldprb_path': helper.join_path(helper.get_qi_data_path(IMG_DATA_path), helper.CLDPRB_FILE_NAME),
+            'scratch_path': scratch_path}
+
+
+def get_benchmark_function(name, data, params):
+    """
+    基准项的计时函数
+
+    :param name: 基准项名称，见BENCHMARKS
+    :param data: prepare_products返回的数据字典
+    :param params: 检查后的基准参数
+    :return: 无参数的函数
+    """
+    scratch_path = data['scratch_path']
+    band_names = data['band_names']
+    stack_vrt = os.path.join(scratch_path, "stack.vrt")
+    mask_vrt = os.path.join(scratch_path, "mask_src.vrt")
+    mask_tif = os.path.join(scratch_path, "mask.tif")
+    THREADS = params['THREADS']
+    BLOCK_SIZE = params['BLOCK_SIZE']
+    TIFF_PROFILE = params.get('TIFF_PROFILE')
+    indices = {index_name: ci.INDEX_REGISTRY[index_name] for index_name in ci.INDEX_REGISTRY}
+
+    def build_stack_vrt():
+        helper.build_stack_vrt(data['jp2_path_list'], stack_vrt, band_names)
+
+    def read_img_parallel():
+        data['stack'] = helper.read_img_parallel(stack_vrt, min(THREADS, len(band_names)))
+
+    def create_cloud_mask():
+        helper.build_stack_vrt([data['scl_path'], data['cldprb_path']], mask_vrt, ['SCL', 'CLDPRB'],
+                               resample_alg='nearest')
+        helper.create_cloud_mask(mask_vrt, mask_tif, 1, helper.SCL_MASK_CLASSES, 2, 50, BLOCK_SIZE)
+
+    def quick_rgb():
+        img_data = data['stack'][2]
+        helper.quick_rgb(img_data[[band_names.index(band_name) for band_name in ci.QUICK_IMG_BANDS]])
+
+    def write_tiff():
+        proj, geotrans, img_data = data['stack'][:3]
+        helper.write_tiff(img_data, geotrans, proj, os.path.join(scratch_path, "write.tif"), TIFF_PROFILE)
+
+    def cal_indices():
+        ci.cal_indices(stack_vrt, os.path.join(scratch_path, "index"), indices, band_names, BLOCK_SIZE,
+                       TIFF_PROFILE)
+
+    def cal_indices_masked():
+        ci.cal_indices(stack_vrt, os.path.join(scratch_path, "masked"), indices, band_names, BLOCK_SIZE,
+                       TIFF_PROFILE, os.path.join(scratch_path, "merge.tif"), mask_tif)
+
+    def s2_l2a_process(read_from_zip=False):
+        input_path = os.path.dirname(data['zip_path_list'][0])
+        output_path = os.path.join(scratch_path, "export")
+        if os.path.exists(output_path):
+            shutil.rmtree(output_path)
+        os.makedirs(output_path)
+        process_params = {'INPUT_PATH': input_path, 'OUTPUT_PATH': output_path, 'QUICK_IMG': True,
+                          'QUICK_IMG_SIZE': 1024, 'CLOUD_MASK': True, 'READ_FROM_ZIP': read_from_zip,
+                          'RESUME': False, 'WORKERS': params['WORKERS'], 'THREADS': THREADS,
+                          'BLOCK_SIZE': BLOCK_SIZE, 'TIFF_PROFILE': TIFF_PROFILE, 'CRS': None, 'SHP_FILE_PATH': None}
+        for index_name in indices:
+            process_params['CAL_' + index_name.upper()] = True
+        failed_dict = s2p.s2_l2a_process(process_params)
+        if failed_dict:
+            raise ValueError("ERROR!!! {} products failed in the benchmark".format(len(failed_dict)))
+
+    functions = {'helper.build_stack_vrt': build_stack_vrt,
+                 'helper.read_img_parallel': read_img_parallel,
+                 'helper.create_cloud_mask': create_cloud_mask,
+                 'helper.quick_rgb': quick_rgb,
+                 'helper.write_tiff': write_tiff,
+                 'cal_index.cal_indices': cal_indices,
+                 'cal_index.cal_indices_masked': cal_indices_masked,
+                 's2_l2a_process': s2_l2a_process,
+                 's2_l2a_process_zip': lambda: s2_l2a_process(read_from_zip=True)}
+    return functions[name]
+
+
+def time_function(function, repeat):
+    """
+    重复执行并计时，取最短时间（受其他进程干扰最小）
+
+    :param function: 无参数的函数
+    :param repeat: 重复次数
+    :return: 最短时间（秒）
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def load_baseline(baseline_path):
+    """
+    读取基准结果
+
+    :param baseline_path: 基准结果文件路径（.json）
+    :return: {'machine': 机器信息, 'results': {基准项@SIZE: 秒}}
+    """
+    if not os.path.exists(baseline_path):
+        return {'machine': None, 'results': {}}
+    with open(baseline_path) as f:
+        return json.load(f)
+
+
+# ---------------------------------------------------#
+#   Running the benchmarks
+# ---------------------------------------------------#
+def s2_benchmark(params):
+    """
+    Running the benchmarks on synthetic Sentinel-2 products and comparing them with the stored baseline.
+
+    :param params: These parameters determine the benchmark parameters.
+    :return: The benchmark results {name: {'seconds', 'baseline', 'ratio', 'status'}}.
+    """
+    ###########################################
+    # 0. CHECK PARAMETERS
+    ###########################################
+    params = check_benchmark_params(params)
+    WORK_PATH = params['WORK_PATH']
+    SIZE = params['SIZE']
+    REPEAT = params['REPEAT']
+    BASELINE_PATH = params['BASELINE_PATH']
+    TOLERANCE = params['TOLERANCE']
+
+    if not os.path.exists(WORK_PATH):
+        os.makedirs(WORK_PATH)
+    helper.set_gdal_threads(params['THREADS'])
+    ci.set_index_threads(params['THREADS'])
+
+    ###########################################
+    #   Step 1: 生成模拟产品
+    ###########################################
+    data = prepare_products(params)
+
+    ###########################################
+    #   Step 2: 逐项计时（按BENCHMARKS的顺序，后面的项使用前面的项生成的数据）
+    ###########################################
+    baseline = load_baseline(BASELINE_PATH)
+    machine = get_machine_info()
+    if baseline['machine'] is not None and baseline['machine'] != machine:
+        print("The baseline was created on another machine, the comparison may not be meaningful")
+    names = [name for name in BENCHMARKS if name in params['BENCHMARKS']]
+    if 'helper.read_img_parallel' not in names and ('helper.quick_rgb' in names or 'helper.write_tiff' in names):
+        names.insert(0, 'helper.read_img_parallel')
+    if 'helper.build_stack_vrt' not in names:
+        names.insert(0, 'helper.build_stack_vrt')
+    if 'cal_index.cal_indices_masked' in names and 'helper.create_cloud_mask' not in names:
+        names.insert(names.index('cal_index.cal_indices_masked'), 'helper.create_cloud_mask')
+
+    results = {}
+    for name in names:
+        seconds = time_function(get_benchmark_function(name, data, params), REPEAT)
+        key = "{}@{}".format(name, SIZE)
+        baseline_seconds = baseline['results'].get(key)
+        result = {'seconds': round(seconds, 4), 'baseline': baseline_seconds, 'ratio': None, 'status': 'new'}
+        if baseline_seconds:
+            result['ratio'] = round(seconds / baseline_seconds, 3)
+            if result['ratio'] > 1 + TOLERANCE:
+                result['status'] = 'slower'
+            elif result['ratio'] < 1 - TOLERANCE:
+                result['status'] = 'faster'
+            else:
+                result['status'] = 'ok'
+        results[name] = result
+        print("{}: {:.3f} s ({})".format(name, seconds, result['status']))
+    del data
+
+    ###########################################
+    #   Step 3: 输出结果，按需更新基准结果
+    ###########################################
+    print("{:<32}{:>12}{:>12}{:>10}{:>10}".format('benchmark', 'seconds', 'baseline', 'ratio', 'status'))
+    for name in results:
+        result = results[name]
+        print("{:<32}{:>12}{:>12}{:>10}{:>10}".format(name, result['seconds'],
+                                                      '-' if result['baseline'] is None else result['baseline'],
+                                                      '-' if result['ratio'] is None else result['ratio'],
+                                                      result['status']))
+    with open(os.path.join(WORK_PATH, "benchmark_results.jsonl"), 'a') as f:
+        f.write(json.dumps({'time': datetime.datetime.now().isoformat(timespec='seconds'), 'size': SIZE,
+                            'machine': machine, 'results': results}) + '\n')
+    if params['UPDATE_BASELINE']:
+        baseline['machine'] = machine
+        for name in results:
+            baseline['results']["{}@{}".format(name, SIZE)] = results[name]['seconds']
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(BASELINE_PATH + " has been updated")
+    shutil.rmtree(os.path.join(WORK_PATH, "scratch"), ignore_errors=True)
+    return results
+
+
+# Parameters
+s2_benchmark_parameter = {'WORK_PATH': 'G:/s2_processing/benchmark',
+                          'SIZE': 1098,
+                          'PRODUCTS': 2,
+                          'REPEAT': 3,
+                          'UPDATE_BASELINE': False,
+                          'TOLERANCE': 0.2,
+                          'TIFF_PROFILE': 'zstd'
+                          }
+
+# /***************************/
+# // MAIN
+# /***************************/
+if __name__ == "__main__":
+    s2_benchmark(s2_benchmark_parameter)
@@ -0,0 +1,274 @@
+import os
+import re
+import warnings
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from osgeo import gdal
+import helper
+import cal_index as ci
+
+
+# -------------------------------------------------------------#
+#   多时相合成：
+#   按块读取同一图幅各日期的波段叠加影像（<编号>_merge.tif），逐块合成后写出，
+#   内存占用只与块大小×日期数有关；各块相互独立，可以使用进程池并行计算。
+#   median     - 各波段有效像元的中值
+#   max_ndvi   - NDVI最大的日期的全部波段
+#   best_pixel - 场景分类图（<编号>_scl.tif）质量最好的日期的全部波段，质量相同时取NDVI最大的日期
+#   各日期中波段值全为0的像元（无数据、云掩膜）不参与合成。
+# -------------------------------------------------------------#
+COMPOSITE_METHODS = ['median', 'max_ndvi', 'best_pixel']
+
+# 场景分类类别的质量得分，类别说明见helper.remove_cloud_shp
+SCL_SCORES = np.zeros(256, dtype=np.float32)
+SCL_SCORES[[4, 5, 6]] = 6  # 植被、裸地、水体
+SCL_SCORES[[7, 11]] = 5  # 未分类、雪
+SCL_SCORES[2] = 4  # 暗像元
+SCL_SCORES[10] = 3  # 薄卷云
+SCL_SCORES[3] = 2  # 云阴影
+SCL_SCORES[8] = 1  # 中概率云
+# 0无数据、1饱和或坏像元、9高概率云的得分为0
+
+
+# ---------------------------------------------------#
+#   Checking compositing parameters
+# ---------------------------------------------------#
+def check_composite_params(params):
+    """
+    Checking compositing parameters and filling in the default values.
+
+    :param params: These parameters determine the compositing parameters.
+    :return: The checked parameters.
+    """
+    params = dict(params)
+
+    if params.get('INPUT_PATH') is None:
+        raise ValueError("ERROR!!! Parameter INPUT_PATH not correctly defined")
+    if params.get('OUTPUT_PATH') is None:
+        raise ValueError("ERROR!!! Parameter OUTPUT_PATH not correctly defined")
+    if params.get('START_DATE') is None:
+        raise ValueError("ERROR!!! Parameter START_DATE not correctly defined")
+    if params.get('END_DATE') is None:
+        raise ValueError("ERROR!!! Parameter END_DATE not correctly defined")
+    if params.get('METHOD') is None:
+        params['METHOD'] = 'median'
+    if params['METHOD'] not in COMPOSITE_METHODS:
+        raise ValueError("ERROR!!! Parameter METHOD not correctly defined")
+    for index_name in ci.INDEX_REGISTRY:
+        if params.get('CAL_' + index_name.upper()) is None:
+            params['CAL_' + index_name.upper()] = False
+    # 合成影像需要计算的植被指数
+    params['INDICES'] = ci.get_indices(params)
+    if params.get('WORKERS') is None:
+        params['WORKERS'] = 1
+    if params['WORKERS'] < 1:
+        raise ValueError("ERROR!!! Parameter WORKERS not correctly defined")
+    if params.get('BLOCK_SIZE') is None:
+        # 内存占用为块大小×日期数，默认块比单景处理时小
+        params['BLOCK_SIZE'] = 512
+    if params.get('TIFF_PROFILE') not in helper.TIFF_PROFILES:
+        raise ValueError("ERROR!!! Parameter TIFF_PROFILE not correctly defined")
+
+    return params
+
+
+# ---------------------------------------------------#
+#   Compositing one block
+# ---------------------------------------------------#
+def composite_block(tif_path_list, scl_path_list, method, ndvi_bands, xoff, yoff, xsize, ysize):
+    """
+    合成一个块：读取各日期的该块并按合成方法计算
+
+    :param tif_path_list: 各日期的波段叠加影像路径
+    :param scl_path_list: 各日期的场景分类图路径（best_pixel）
+    :param method: 合成方法，见COMPOSITE_METHODS
+    :param ndvi_bands: 波段叠加影像中B04、B08的波段序号（从0开始）
+    :param xoff: 块左上角的列号
+    :param yoff: 块左上角的行号
+    :param xsize: 块的列数
+    :param ysize: 块的行数
+    :return: 块左上角的列号、行号，以及合成后的块（波段×行×列）
+    """
+    # 日期×波段×行×列
+    stack = np.stack([gdal.Open(tif_path).ReadAsArray(xoff, yoff, xsize, ysize).reshape(-1, ysize, xsize)
+                      for tif_path in tif_path_list])
+    valid = np.any(stack != 0, axis=1)
+
+    if method == 'median':
+        data = stack.astype(np.float32)
+        data[~valid[:, None].repeat(stack.shape[1], axis=1)] = np.nan
+        with warnings.catch_warnings():
+            # 全部日期均无效的像元输出0
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(data, axis=0)
+        return xoff, yoff, np.nan_to_num(np.round(median), nan=0).astype(stack.dtype)
+
+    red = stack[:, ndvi_bands[0]].astype(np.float32)
+    nir = stack[:, ndvi_bands[1]].astype(np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.nan_to_num((nir - red) / (nir + red), nan=-1.0, posinf=-1.0, neginf=-1.0)
+    if method == 'best_pixel':
+        scl = np.stack([gdal.Open(scl_path).ReadAsArray(xoff, yoff, xsize, ysize) for scl_path in scl_path_list])
+        # 质量得分优先，NDVI（换算至0~0.5）只用于区分质量相同的日期
+        score = SCL_SCORES[scl] + (score + 1.0) / 4.0
+    score[~valid] = -np.inf
+    best = np.argmax(score, axis=0)
+    out = np.take_along_axis(stack, best[None, None], axis=0)[0]
+    out[:, ~valid.any(axis=0)] = 0
+    return xoff, yoff, out
+
+
+def check_composite_inputs(tif_path_list, scl_path_list=None):
+    """
+    检查各日期的波段叠加影像能否逐像元合成：波段（波段描述）、行列数及仿射变换参数必须一致，
+    场景分类图的行列数及仿射变换参数必须与波段叠加影像一致。
+    各产品的波段叠加只包含处理参数（INDICES、QUICK_IMG、STACK_ALL_BANDS）需要的波段，参数不同时波段不同
+
+    :param tif_path_list: 各日期的波段叠加影像路径
+    :param scl_path_list: 各日期的场景分类图路径，None为不检查
+    """
+    reference = None
+    for tif_path in tif_path_list:
+        dataset = gdal.Open(tif_path)
+        band_names = [dataset.GetRasterBand(i + 1).GetDescription() for i in range(dataset.RasterCount)]
+        grid = (dataset.RasterXSize, dataset.RasterYSize, dataset.GetGeoTransform())
+        del dataset
+        if reference is None:
+            reference = (tif_path, band_names, grid)
+        elif band_names != reference[1]:
+            raise ValueError("ERROR!!! The bands of {} {} do not match the bands of {} {}".format(
+                tif_path, band_names, reference[0], reference[1]))
+        elif grid != reference[2]:
+            raise ValueError("ERROR!!! The grid of {} does not match the grid of {}".format(tif_path, reference[0]))
+    for scl_path in scl_path_list or []:
+        dataset = gdal.Open(scl_path)
+        grid = (dataset.RasterXSize, dataset.RasterYSize, dataset.GetGeoTransform())
+        del dataset
+        if grid != reference[2]:
+            raise ValueError("ERROR!!! The grid of {} does not match the grid of {}".format(scl_path, reference[0]))
+
+
+def composite(tif_path_list, out_path, method='median', scl_path_list=None, block_size=512, workers=1,
+              profile=None):
+    """
+    按块合成多个日期的波段叠加影像，各日期的波段及影像网格必须一致（见check_composite_inputs）
+
+    :param tif_path_list: 各日期的波段叠加影像路径
+    :param out_path: 合成影像保存路径
+    :param method: 合成方法，见COMPOSITE_METHODS
+    :param scl_path_list: 各日期的场景分类图路径，best_pixel合成时必须提供
+    :param block_size: 块的边长（像元）
+    :param workers: 并行计算的进程数
+    :param profile: 输出影像的创建参数配置名，见helper.TIFF_PROFILES
+    :return: 合成影像各波段的波段名
+    """
+    check_composite_inputs(tif_path_list, scl_path_list)
+    dataset = gdal.Open(tif_path_list[0])
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    band_names = [dataset.GetRasterBand(i + 1).GetDescription() for i in range(dataset.RasterCount)]
+    out_dataset = helper.create_tiff(out_path, width, height, dataset.RasterCount,
+                                     dataset.GetRasterBand(1).DataType, dataset.GetGeoTransform(),
+                                     dataset.GetProjection(), profile)
+    del dataset
+    for i, band_name in enumerate(band_names):
+        out_dataset.GetRasterBand(i + 1).SetDescription(band_name)
+        out_dataset.GetRasterBand(i + 1).SetNoDataValue(0)
+
+    ndvi_bands = None
+    if method != 'median':
+        if 'B04' not in band_names or 'B08' not in band_names:
+            raise ValueError("ERROR!!! Compositing by " + method + " requires bands B04 and B08")
+        ndvi_bands = (band_names.index('B04'), band_names.index('B08'))
+
+    def write_block(result):
+        xoff, yoff, block = result
+        for i in range(block.shape[0]):
+            out_dataset.GetRasterBand(i + 1).WriteArray(block[i], xoff, yoff)
+
+    blocks = helper.iter_blocks(width, height, block_size)
+    if workers > 1:
+        # 各块相互独立，子进程读取并合成，主进程写出。最多同时提交2×workers个块，每完成一个块写出后
+        # 即释放其结果并提交下一个块，主进程的内存占用只与块大小有关，不随影像大小增加
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            running = set()
+            for block in blocks:
+                running.add(executor.submit(composite_block, tif_path_list, scl_path_list, method, ndvi_bands,
+                                            *block))
+                if len(running) >= 2 * workers:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    while done:
+                        write_block(done.pop().result())
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                while done:
+                    write_block(done.pop().result())
+    else:
+        for block in blocks:
+            write_block(composite_block(tif_path_list, scl_path_list, method, ndvi_bands, *block))
+
+    helper.finish_tiff(out_dataset, out_path, profile)
+    return band_names
+
+
+# ---------------------------------------------------#
+#   Compositing the processed Sentinel-2 products
+# ---------------------------------------------------#
+def s2_composite(params):
+    """
+    Compositing the band stacks (<id>_merge.tif) of the processed products between START_DATE and END_DATE,
+    one composite per tile, and calculating the vegetation indices of the composites.
+
+    :param params: These parameters determine the compositing parameters.
+    :return: The composite files.
+    """
+    ###########################################
+    # 0. CHECK PARAMETERS
+    ###########################################
+    params = check_composite_params(params)
+    INPUT_PATH = params['INPUT_PATH']
+    OUTPUT_PATH = params['OUTPUT_PATH']
+    START_DATE = params['START_DATE']
+    END_DATE = params['END_DATE']
+    METHOD = params['METHOD']
+    WORKERS = params['WORKERS']
+    BLOCK_SIZE = params['BLOCK_SIZE']
+    TIFF_PROFILE = params.get('TIFF_PROFILE')
+
+    if not os.path.exists(OUTPUT_PATH):
+        os.makedirs(OUTPUT_PATH)
+
+    ###########################################
+    #   Step 1: 按图幅查找日期范围内的波段叠加影像
+    ###########################################
+    pattern = re.compile(r'^((T\d{2}[A-Z]{3})_(\d{8})T\d{6})_merge\.tif$')
+    tile_dict = {}
+    for file_name in sorted(os.listdir(INPUT_PATH)):
+        match = pattern.match(file_name)
+        if match and START_DATE <= match.group(3) <= END_DATE:
+            tile_dict.setdefault(match.group(2), []).append(match.group(1))
+
+    ###########################################
+    #   Step 2: 逐图幅按块合成，并计算合成影像的植被指数
+    ###########################################
+    composite_list = []
+    for tile in tile_dict:
+        img_identifiers = tile_dict[tile]
+        tif_path_list = [os.path.join(INPUT_PATH, identifier + "_merge.tif") for identifier in img_identifiers]
+        scl_path_list = None
+        if METHOD == 'best_pixel':
+            # 由处理参数SAVE_SCL输出的场景分类图
+            scl_path_list = [os.path.join(INPUT_PATH, identifier + "_scl.tif") for identifier in img_identifiers]
+            for scl_path in scl_path_list:
+                if not os.path.exists(scl_path):
+                    raise ValueError("ERROR!!! " + scl_path + " not found, process the products with SAVE_SCL")
+
+        out_identifier = "{}_{}_{}_{}".format(tile, START_DATE, END_DATE, METHOD)
+        out_path = os.path.join(OUTPUT_PATH, out_identifier + ".tif")
+        print("Compositing {} products of {}".format(len(tif_path_list), tile))
+        band_names = composite(tif_path_list, out_path, METHOD, scl_path_list, BLOCK_SIZE, WORKERS, TIFF_PROFILE)
+        ci.cal_indices(out_path, os.path.join(OUTPUT_PATH, out_identifier), params['INDICES'], band_names,
+                       BLOCK_SIZE, TIFF_PROFILE)
+        composite_list.append(out_path)
+        print(out_path + " has been created")
+    return composite_list
@@ -1,5 +1,248 @@
 from sentinelsat import SentinelAPI
 import os
+import json
+import time
+import random
+import hashlib
+import datetime
+import concurrent.futures
+import requests
+
+
+# -------------------------------------------------------------#
+#   下载管理：
+#   一次查询得到全部产品后，按ODATA_BATCH_SIZE个产品一批用OData批量获取元数据（是否在线、大小、校验和），
+#   在线产品由WORKERS个线程并行下载（下载受网络限制，线程即可），失败时按RETRY_DELAY、2倍递增的间隔重试，
+#   未下载完的部分保存为.incomplete文件，重试时从断点继续，下载完成后校验MD5再重命名为.zip。
+#   每个产品的下载状态写入<SAVE_DIR>/download_ledger.json，重新运行时跳过已下载的产品。
+#   API_URL可以指向本地模拟的数据中心（local_hub.py），不连接欧空局即可检查下载流程。
+# -------------------------------------------------------------#
+API_URL = 'https://apihub.copernicus.eu/apihub/'
+DOWNLOAD_LEDGER_NAME = "download_ledger.json"
+# 每次OData请求获取元数据的产品数，过多时URL过长
+ODATA_BATCH_SIZE = 20
+# 下载时每次写入的字节数
+DOWNLOAD_CHUNK_SIZE = 2 ** 20
+# 重试也不会成功的HTTP状态码（参数错误、未登录、无权限、产品不存在）
+FATAL_STATUS_CODES = (400, 401, 403, 404)
+
+
+def check_download_params(params):
+    """
+    Checking download parameters and filling in the default values.
+
+    :param params: These parameters determine the data selection and image saving parameters.
+    :return: The checked parameters.
+    """
+    params = dict(params)
+
+    if params.get('USER_NAME') is None:
+        raise ValueError("ERROR!!! Parameter USER_NAME is none")
+    if params.get('PASSWORD') is None:
+        raise ValueError("ERROR!!! Parameter PASSWORD is none")
+    if params.get('START_DATE') is None:
+        raise ValueError("ERROR!!! Parameter START_DATE not correctly defined")
+    if params.get('END_DATE') is None:
+        raise ValueError("ERROR!!! Parameter END_DATE not correctly defined")
+    if params.get('SAVE_DIR') is None:
+        raise ValueError("ERROR!!! Parameter SAVE_DIR is none")
+
+    product_type_required = ['S2MSI2A', 'S2MSI1C', 'S2MS2Ap']
+    if params.get('PRODUCT_TYPE') not in product_type_required:
+        raise ValueError("ERROR!!! Parameter PRODUCT_TYPE not correctly defined")
+
+    if params.get('API_URL') is None:
+        params['API_URL'] = API_URL
+    if not params['API_URL'].endswith('/'):
+        params['API_URL'] += '/'
+    if params.get('WORKERS') is None:
+        params['WORKERS'] = 4
+    if params['WORKERS'] < 1:
+        raise ValueError("ERROR!!! Parameter WORKERS not correctly defined")
+    if params.get('RETRIES') is None:
+        params['RETRIES'] = 3
+    if params['RETRIES'] < 0:
+        raise ValueError("ERROR!!! Parameter RETRIES not correctly defined")
+    if params.get('RETRY_DELAY') is None:
+        params['RETRY_DELAY'] = 2
+    if params['RETRY_DELAY'] < 0:
+        raise ValueError("ERROR!!! Parameter RETRY_DELAY not correctly defined")
+
+    return params
+
+
+def get_session(user_name, password):
+    """
+    创建带登录信息的HTTP会话，每个下载线程使用各自的会话
+
+    :param user_name: 用户名
+    :param password: 密码
+    :return: requests.Session
+    """
+    session = requests.Session()
+    session.auth = (user_name, password)
+    return session
+
+
+def parse_odata_product(product):
+    """
+    从OData返回的产品记录中提取下载所需的元数据
+
+    :param product: OData产品记录（JSON）
+    :return: {'id', 'title', 'size', 'md5', 'online'}
+    """
+    checksum = product.get('Checksum') or {}
+    return {'id': product['Id'],
+            'title': product['Name'],
+            'size': int(product['ContentLength']),
+            'md5': checksum['Value'].lower() if checksum.get('Algorithm', '').lower() == 'md5' else None,
+            'online': product.get('Online', True)}
+
+
+def get_products_odata(session, api_url, product_ids):
+    """
+    用OData批量获取产品元数据，每ODATA_BATCH_SIZE个产品一次请求，
+    批量请求未返回的产品（部分数据中心不支持按Id筛选）再逐个获取，逐个获取失败的产品不影响其他产品
+
+    :param session: HTTP会话
+    :param api_url: 数据中心API地址（以/结尾）
+    :param product_ids: 产品uuid列表
+    :return: {uuid: 元数据}，以及获取失败的产品{uuid: 错误信息}
+    """
+    product_infos = {}
+    failed = {}
+    for i in range(0, len(product_ids), ODATA_BATCH_SIZE):
+        batch = product_ids[i:i + ODATA_BATCH_SIZE]
+        odata_filter = ' or '.join("Id eq '{}'".format(product_id) for product_id in batch)
+        try:
+            response = session.get(api_url + 'odata/v1/Products',
+                                   params={'$filter': odata_filter, '$format': 'json', '$top': len(batch)})
+            response.raise_for_status()
+            results = response.json()['d']['results']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print("Batch metadata request failed ({}), requesting products one by one".format(e))
+            continue
+        for product in results:
+            product_infos[product['Id']] = parse_odata_product(product)
+
+    for product_id in product_ids:
+        if product_id not in product_infos:
+            try:
+                response = session.get(api_url + "odata/v1/Products('{}')".format(product_id),
+                                       params={'$format': 'json'})
+                response.raise_for_status()
+                product_infos[product_id] = parse_odata_product(response.json()['d'])
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print("Metadata request of {} failed ({})".format(product_id, e))
+                failed[product_id] = str(e)
+    return product_infos, failed
+
+
+def get_file_md5(file_path):
+    """
+    计算文件的MD5
+
+    :param file_path: 文件路径
+    :return: MD5（小写十六进制）
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def download_file(session, url, file_path):
+    """
+    下载文件，file_path已存在时从断点继续（Range请求）
+
+    :param session: HTTP会话
+    :param url: 下载地址
+    :param file_path: 保存路径
+    """
+    offset = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+    with session.get(url, stream=True, headers=headers, timeout=60) as response:
+        # 已下载完整，服务器不再返回数据
+        if offset > 0 and response.status_code == 416:
+            return
+        response.raise_for_status()
+        # 服务器不支持断点续传时重新下载
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        with open(file_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+
+
+def download_product(session, api_url, product_info, save_dir, retries=3, retry_delay=2):
+    """
+    下载单个产品，失败时按retry_delay、2倍递增的间隔（加随机抖动，避免多个线程同时重试）重试
+
+    :param session: HTTP会话
+    :param api_url: 数据中心API地址（以/结尾）
+    :param product_info: 产品元数据，见parse_odata_product
+    :param save_dir: 保存文件夹
+    :param retries: 最大重试次数
+    :param retry_delay: 第一次重试前的等待时间（秒）
+    :return: 下载记录{'status', 'attempts', 'path', 'error'}
+    """
+    zip_path = os.path.join(save_dir, product_info['title'] + '.zip')
+    incomplete_path = zip_path + '.incomplete'
+    url = api_url + "odata/v1/Products('{}')/$value".format(product_info['id'])
+    error = None
+    attempt = 0
+    for attempt in range(1, retries + 2):
+        try:
+            download_file(session, url, incomplete_path)
+            size = os.path.getsize(incomplete_path)
+            if size > product_info['size']:
+                # 其他版本产品遗留的未完成文件，或服务器忽略了Range请求，不能断点续传（否则每次重试都返回416）
+                os.remove(incomplete_path)
+            if size != product_info['size']:
+                raise IOError("size {} does not match {}".format(size, product_info['size']))
+            if product_info['md5'] is not None and get_file_md5(incomplete_path) != product_info['md5']:
+                # 文件已损坏，不能断点续传
+                os.remove(incomplete_path)
+                raise IOError("MD5 checksum does not match")
+            os.replace(incomplete_path, zip_path)
+            return {'status': 'downloaded', 'attempts': attempt, 'path': zip_path, 'error': None}
+        except (requests.RequestException, IOError) as e:
+            error = str(e)
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code in FATAL_STATUS_CODES:
+                break
+            if attempt <= retries:
+                delay = retry_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                print("Download of {} failed ({}), retrying in {:.1f}s".format(product_info['title'], error, delay))
+                time.sleep(delay)
+    return {'status': 'failed', 'attempts': attempt, 'path': None, 'error': error}
+
+
+def read_download_ledger(ledger_path):
+    """
+    读取下载记录文件
+
+    :param ledger_path: 下载记录文件路径
+    :return: {uuid: 下载记录}
+    """
+    if not os.path.exists(ledger_path):
+        return {}
+    with open(ledger_path) as f:
+        return json.load(f)
+
+
+def write_download_ledger(ledger_path, ledger):
+    """
+    写入下载记录文件，先写临时文件再替换，中断时不会损坏原记录
+
+    :param ledger_path: 下载记录文件路径
+    :param ledger: {uuid: 下载记录}
+    """
+    temp_path = ledger_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(ledger, f, indent=2, ensure_ascii=False)
+    os.replace(temp_path, ledger_path)
 
 
 # ---------------------------------------------------#
@@ -11,7 +254,14 @@ def s2_download(params):
 
     param: params
         These parameters determine the data selection and image saving parameters.
+    :return: The download records of the products that were not downloaded, {uuid: record}.
     """
+
+    ###########################################
+    # 0. CHECK PARAMETERS
+    ###########################################
+
+    params = check_download_params(params)
     USER_NAME = params['USER_NAME']
     PASSWORD = params['PASSWORD']
     FOOTPRINT = params['FOOTPRINT']
@@ -20,32 +270,17 @@ def s2_download(params):
     PRODUCT_TYPE = params['PRODUCT_TYPE']
     CLOUD_COVER_PERCENTAGE = params['CLOUD_COVER_PERCENTAGE']
     SAVE_DIR = params['SAVE_DIR']
-
-    ###########################################
-    # 0. CHECK PARAMETERS
-    ###########################################
-
-    if USER_NAME is None:
-        raise ValueError("ERROR!!! Parameter USER_NAME is none")
-    if PASSWORD is None:
-        raise ValueError("ERROR!!! Parameter PASSWORD is none")
-    if START_DATE is None:
-        raise ValueError("ERROR!!! Parameter START_DATE not correctly defined")
-    if END_DATE is None:
-        raise ValueError("ERROR!!! Parameter END_DATE not correctly defined")
-    if SAVE_DIR is None:
-        raise ValueError("ERROR!!! Parameter SAVE_DIR is none")
-
-    product_type_required = ['S2MSI2A', 'S2MSI1C', 'S2MS2Ap']
-    if PRODUCT_TYPE not in product_type_required:
-        raise ValueError("ERROR!!! Parameter PRODUCT_TYPE not correctly defined")
+    API_URL = params['API_URL']
+    WORKERS = params['WORKERS']
+    RETRIES = params['RETRIES']
+    RETRY_DELAY = params['RETRY_DELAY']
 
     ###########################################
     # 1. DATA SELECTION
     ###########################################
 
     # 登录ESA API
-    api = SentinelAPI(USER_NAME, PASSWORD, 'https://apihub.copernicus.eu/apihub')
+    api = SentinelAPI(USER_NAME, PASSWORD, API_URL)
 
     # 使用API接口查询
     products = api.query(FOOTPRINT,
@@ -55,10 +290,11 @@ def s2_download(params):
                          cloudcoverpercentage=(0, CLOUD_COVER_PERCENTAGE))
 
     print(f"一共检索到{len(products)}景符合条件的数据\n")
-    for product in enumerate(products):
-        product_info = api.get_product_odata(str(product))
+    # 批量获取元数据，每个产品只请求一次
+    product_infos, metadata_failed = get_products_odata(api.session, API_URL, list(products))
+    for product_id in products:
         # 打印下载的产品数据文件名
-        print(product_info['title'])
+        print(products[product_id]['title'])
 
     ###########################################
     # 2. DOWNLOAD DATA
@@ -68,14 +304,61 @@ def s2_download(params):
     if not os.path.exists(SAVE_DIR):
         os.makedirs(SAVE_DIR)
 
+    ledger_path = os.path.join(SAVE_DIR, DOWNLOAD_LEDGER_NAME)
+    ledger = read_download_ledger(ledger_path)
+
     # 下载检索数据，对于长期存档的数据（3-6个月以上），会出现offline情况，在下载的时候，需要先请求，后台将数据调档至在线，时间大概是半个小时，才能下载
-    for i, product in enumerate(products):
-        # 通过OData API获取单一产品数据的主要元数据信息
-        product_info = api.get_product_odata(product)
-        # 判断数据可以在线下载
-        if product_info['Online']:
-            print('Product {} is online.Starting download...'.format(product_info['title']))  # 打印产品文件名
-            api.download(product_info['id'], SAVE_DIR)
+    pending = []
+    for product_id in products:
+        if product_id in metadata_failed:
+            # 元数据获取失败的产品记录为下载失败，重新运行时再次获取
+            ledger[product_id] = {'title': products[product_id]['title'], 'size': None, 'status': 'failed',
+                                  'attempts': 0, 'path': None, 'error': metadata_failed[product_id],
+                                  'time': datetime.datetime.now().isoformat(timespec='seconds')}
+            continue
+        product_info = product_infos[product_id]
+        record = ledger.get(product_id, {})
+        zip_path = os.path.join(SAVE_DIR, product_info['title'] + '.zip')
+        if os.path.exists(zip_path) and os.path.getsize(zip_path) == product_info['size']:
+            print('Product {} has been downloaded, skipping.'.format(product_info['title']))
+            if record.get('status') != 'downloaded':
+                ledger[product_id] = {'title': product_info['title'], 'size': product_info['size'],
+                                      'status': 'downloaded', 'attempts': record.get('attempts', 0),
+                                      'path': zip_path, 'error': None,
+                                      'time': datetime.datetime.now().isoformat(timespec='seconds')}
         # 历史存档数据(“Offine”的情况)，暂时不下载和触发LAT标记
+        elif not product_info['online']:
+            print('Product {} is not online.'.format(product_info['title']))
+            ledger[product_id] = {'title': product_info['title'], 'size': product_info['size'],
+                                  'status': 'offline', 'attempts': 0, 'path': None, 'error': None,
+                                  'time': datetime.datetime.now().isoformat(timespec='seconds')}
         else:
-            print('Product {} is not online.'.format(product_info['date']))
+            pending.append(product_info)
+    write_download_ledger(ledger_path, ledger)
+
+    print('Downloading {} products with {} workers...'.format(len(pending), WORKERS))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        futures = {}
+        for product_info in pending:
+            future = executor.submit(download_product, get_session(USER_NAME, PASSWORD), API_URL, product_info,
+                                     SAVE_DIR, RETRIES, RETRY_DELAY)
+            futures[future] = product_info
+        # 下载记录只由主线程写入
+        for future in concurrent.futures.as_completed(futures):
+            product_info = futures[future]
+            record = future.result()
+            record.update({'title': product_info['title'], 'size': product_info['size'],
+                           'time': datetime.datetime.now().isoformat(timespec='seconds')})
+            ledger[product_info['id']] = record
+            write_download_ledger(ledger_path, ledger)
+            if record['status'] == 'downloaded':
+                print('Product {} has been downloaded ({} attempts).'.format(product_info['title'],
+                                                                           record['attempts']))
+            else:
+                print('Product {} failed: {}'.format(product_info['title'], record['error']))
+
+    not_downloaded = {product_id: ledger[product_id] for product_id in products
+                      if ledger[product_id]['status'] != 'downloaded'}
+    print('{} products downloaded, {} not downloaded, see {}'.format(len(products) - len(not_downloaded),
+                                                                    len(not_downloaded), ledger_path))
+    return not_downloaded
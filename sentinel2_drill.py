@@ -0,0 +1,270 @@
+import os
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from osgeo import gdal, ogr, osr
+import helper
+import cal_index as ci
+import zonal_stats as zs
+
+
+# -------------------------------------------------------------#
+#   点位时间序列提取：
+#   不处理整景影像，直接从各产品（.zip内的jp2）读取点位所在的k×k窗口。
+#   点位按jp2的块排序后逐点读取，同一块内的点位连续读取，GDAL块缓存保证每个块最多解码一次；
+#   20m波段按10m网格的亚像元窗口读取，由GDAL双线性插值，与波段叠加（VRT）的重采样一致。
+#   输出为长表：每行为一个点位、一个日期的一个波段或植被指数（k×k窗口的均值）。
+# -------------------------------------------------------------#
+# 提取的分辨率（10m网格）
+DRILL_RESOLUTION = 10
+
+
+# ---------------------------------------------------#
+#   Checking drilling parameters
+# ---------------------------------------------------#
+def check_drill_params(params):
+    """
+    Checking point drilling parameters and filling in the default values.
+
+    :param params: These parameters determine the point drilling parameters.
+    :return: The checked parameters.
+    """
+    params = dict(params)
+
+    if params.get('INPUT_PATH') is None:
+        raise ValueError("ERROR!!! Parameter INPUT_PATH not correctly defined")
+    if params.get('OUTPUT_PATH') is None:
+        raise ValueError("ERROR!!! Parameter OUTPUT_PATH not correctly defined")
+    if os.path.splitext(params['OUTPUT_PATH'])[1] not in ('.csv', '.parquet'):
+        raise ValueError("ERROR!!! Parameter OUTPUT_PATH must be a .csv or .parquet file")
+    if not params.get('POINTS'):
+        raise ValueError("ERROR!!! Parameter POINTS not correctly defined")
+    if params.get('POINTS_CRS') is None:
+        params['POINTS_CRS'] = 'EPSG:4326'
+    if params.get('WINDOW_SIZE') is None:
+        params['WINDOW_SIZE'] = 1
+    if params['WINDOW_SIZE'] < 1:
+        raise ValueError("ERROR!!! Parameter WINDOW_SIZE not correctly defined")
+    if params.get('BANDS') is None:
+        params['BANDS'] = []
+    for band_name in params['BANDS']:
+        if band_name not in helper.BAND_RESOLUTION and band_name != 'SCL':
+            raise ValueError("ERROR!!! Parameter BANDS not correctly defined")
+    for index_name in ci.INDEX_REGISTRY:
+        if params.get('CAL_' + index_name.upper()) is None:
+            params['CAL_' + index_name.upper()] = False
+    # 需要计算的植被指数
+    params['INDICES'] = ci.get_indices(params)
+    if params.get('WORKERS') is None:
+        params['WORKERS'] = 1
+    if params['WORKERS'] < 1:
+        raise ValueError("ERROR!!! Parameter WORKERS not correctly defined")
+
+    return params
+
+
+def read_points(points, points_crs='EPSG:4326', id_field=None):
+    """
+    读取点位：点位列表[(编号, x, y), ...]（坐标系为points_crs），或点矢量文件路径
+
+    :param points: 点位列表或点矢量文件路径
+    :param points_crs: 点位列表的坐标系，点矢量文件没有坐标系（.prj）时也使用该坐标系
+    :param id_field: 点矢量文件中作为点位编号的字段名，默认使用要素的FID
+    :return: 点位编号列表、x坐标数组、y坐标数组、坐标系（WKT）
+    """
+    if isinstance(points, str):
+        shp_dataset = ogr.Open(points)
+        layer = shp_dataset.GetLayer(0)
+        srs = layer.GetSpatialRef()
+        points = [(feature.GetField(id_field) if id_field else feature.GetFID(),
+                   feature.GetGeometryRef().GetX(), feature.GetGeometryRef().GetY()) for feature in layer]
+        if srs is None:
+            # 缺少.prj文件
+            print("{} has no spatial reference, assuming {}".format(points, points_crs))
+            srs = osr.SpatialReference()
+            srs.SetFromUserInput(points_crs)
+        projection = srs.ExportToWkt()
+        del shp_dataset
+    else:
+        srs = osr.SpatialReference()
+        srs.SetFromUserInput(points_crs)
+        projection = srs.ExportToWkt()
+    point_ids = [point[0] for point in points]
+    xs = np.array([point[1] for point in points], dtype=np.float64)
+    ys = np.array([point[2] for point in points], dtype=np.float64)
+    return point_ids, xs, ys, projection
+
+
+def transform_points(xs, ys, src_projection, dst_projection):
+    """
+    转换点位坐标
+
+    :param xs: x坐标数组
+    :param ys: y坐标数组
+    :param src_projection: 点位的坐标系（WKT）
+    :param dst_projection: 目标坐标系（WKT）
+    :return: 目标坐标系下的x坐标数组、y坐标数组
+    """
+    src_srs = osr.SpatialReference()
+    src_srs.ImportFromWkt(src_projection)
+    src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromWkt(dst_projection)
+    dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src_srs, dst_srs)
+    points = np.array(transform.TransformPoints(np.column_stack([xs, ys]).tolist()))
+    return points[:, 0], points[:, 1]
+
+
+def read_windows(band_path, cols, rows, window_size, scale=1, resample_alg=gdal.GRIORA_Bilinear):
+    """
+    按块顺序读取各点位的窗口
+
+    :param band_path: 波段文件路径
+    :param cols: 各窗口左上角在10m网格中的列号
+    :param rows: 各窗口左上角在10m网格中的行号
+    :param window_size: 窗口边长（10m像元）
+    :param scale: 波段分辨率与10m的比值（20m波段为2）
+    :param resample_alg: 低分辨率波段的重采样方法
+    :return: 点位数×窗口边长×窗口边长的数组
+    """
+    dataset = gdal.Open(band_path)
+    band = dataset.GetRasterBand(1)
+    block_x, block_y = band.GetBlockSize()
+    out = np.empty((len(cols), window_size, window_size), dtype=np.float32)
+    # 按所在块排序，同一块内的窗口连续读取
+    order = np.lexsort(((cols // scale) // block_x, (rows // scale) // block_y))
+    for i in order:
+        out[i] = band.ReadAsArray(cols[i] / scale, rows[i] / scale, window_size / scale, window_size / scale,
+                                  window_size, window_size, resample_alg=resample_alg)
+    del dataset
+    return out
+
+
+# ---------------------------------------------------#
+#   Drilling one product
+# ---------------------------------------------------#
+def drill_product(product_path, point_ids, xs, ys, projection, params):
+    """
+    Drilling the bands and vegetation indices of one product at the points.
+
+    :param product_path: The .zip file or the .SAFE directory of the product.
+    :param point_ids: The ids of the points.
+    :param xs: The x coordinates of the points.
+    :param ys: The y coordinates of the points.
+    :param projection: The CRS (WKT) of the points.
+    :param params: The checked point drilling parameters.
+    :return: The rows of the table.
+    """
+    WINDOW_SIZE = params['WINDOW_SIZE']
+    BANDS = params['BANDS']
+    indices = params['INDICES']
+
+    safe_path = helper.get_zip_safe_path(product_path) if product_path.endswith('.zip') else product_path
+    IMG_DATA_path = helper.get_img_data_path(safe_path)
+    img_identifier = helper.get_image_name(IMG_DATA_path)
+    tile, date = img_identifier.split('_')[0], img_identifier.split('_')[1][:8]
+
+    # 点位转换至图幅坐标系，计算窗口在10m网格中的位置，只保留窗口完全在图幅内的点位
+    geotrans, tile_projection, bounds = helper.get_raster_bounds(
+        helper.get_band_path(IMG_DATA_path, img_identifier, 'B02', '10m'))
+    tile_xs, tile_ys = transform_points(xs, ys, projection, tile_projection)
+    width = int(round((bounds[2] - bounds[0]) / DRILL_RESOLUTION))
+    height = int(round((bounds[3] - bounds[1]) / DRILL_RESOLUTION))
+    cols = np.floor((tile_xs - geotrans[0]) / DRILL_RESOLUTION).astype(np.int64) - WINDOW_SIZE // 2
+    rows = np.floor((geotrans[3] - tile_ys) / DRILL_RESOLUTION).astype(np.int64) - WINDOW_SIZE // 2
+    inside = (cols >= 0) & (rows >= 0) & (cols + WINDOW_SIZE <= width) & (rows + WINDOW_SIZE <= height)
+    if not inside.any():
+        return []
+    cols, rows = cols[inside], rows[inside]
+    point_index = np.nonzero(inside)[0]
+
+    # 读取植被指数及输出所需的波段
+    band_names = ci.resolve_bands(indices, extra_bands=[band_name for band_name in BANDS if band_name != 'SCL'])
+    bands = {}
+    for band_name in band_names:
+        resolution = helper.BAND_RESOLUTION[band_name]
+        band_path = helper.get_band_path(IMG_DATA_path, img_identifier, band_name, resolution)
+        bands[band_name] = read_windows(band_path, cols, rows, WINDOW_SIZE, int(resolution[:-1]) // DRILL_RESOLUTION)
+    if 'SCL' in BANDS:
+        scl_path = helper.get_band_path(IMG_DATA_path, img_identifier, 'SCL', '20m')
+        bands['SCL'] = read_windows(scl_path, cols, rows, WINDOW_SIZE, 2, gdal.GRIORA_NearestNeighbour)
+
+    # 窗口均值（SCL取窗口中心的类别）
+    values = {}
+    for band_name in BANDS:
+        if band_name == 'SCL':
+            values[band_name] = bands[band_name][:, WINDOW_SIZE // 2, WINDOW_SIZE // 2]
+        else:
+            values[band_name] = bands[band_name].mean(axis=(1, 2))
+    for index_name in indices:
+        expression, value_range = indices[index_name]
+        index_values = ci.evaluate_index(expression, {band_name: bands[band_name] for band_name in band_names},
+                                         value_range)
+        with warnings.catch_warnings():
+            # 窗口内均为NaN时输出NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            values[index_name] = np.nanmean(index_values, axis=(1, 2))
+
+    table_rows = []
+    for i, k in enumerate(point_index):
+        for name in values:
+            table_rows.append({'point_id': point_ids[k], 'date': date, 'tile': tile, 'x': xs[k], 'y': ys[k],
+                               'variable': name, 'value': float(values[name][i])})
+    return table_rows
+
+
+# ---------------------------------------------------#
+#   Drilling Sentinel-2 products at points
+# ---------------------------------------------------#
+def s2_drill(params):
+    """
+    Drilling the band and vegetation index time series at points from the Sentinel-2 L2A products,
+    without processing the whole products.
+
+    :param params: These parameters determine the point drilling parameters.
+    :return: The rows of the table.
+    """
+    ###########################################
+    # 0. CHECK PARAMETERS
+    ###########################################
+    params = check_drill_params(params)
+    INPUT_PATH = params['INPUT_PATH']
+    OUTPUT_PATH = params['OUTPUT_PATH']
+    WORKERS = params['WORKERS']
+
+    point_ids, xs, ys, projection = read_points(params['POINTS'], params['POINTS_CRS'], params.get('POINTS_ID_FIELD'))
+    product_list = [os.path.join(INPUT_PATH, file_name) for file_name in sorted(os.listdir(INPUT_PATH))
+                    if file_name.endswith('.zip') and 'MSIL2A' in file_name]
+
+    ###########################################
+    #   Step 1: 逐景（或并行）提取点位的窗口
+    ###########################################
+    table_rows = []
+    failed_list = []
+    if WORKERS > 1 and len(product_list) > 1:
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            future_dict = {executor.submit(drill_product, product_path, point_ids, xs, ys, projection, params):
+                           product_path for product_path in product_list}
+            for future in as_completed(future_dict):
+                try:
+                    table_rows += future.result()
+                except Exception:
+                    print("{} drilling failed!\n{}".format(future_dict[future], traceback.format_exc()))
+                    failed_list.append(future_dict[future])
+    else:
+        for product_path in product_list:
+            try:
+                table_rows += drill_product(product_path, point_ids, xs, ys, projection, params)
+            except Exception:
+                print("{} drilling failed!\n{}".format(product_path, traceback.format_exc()))
+                failed_list.append(product_path)
+    print("{} of {} products drilled successfully.".format(len(product_list) - len(failed_list), len(product_list)))
+
+    ###########################################
+    #   Step 2: 输出点位时间序列表
+    ###########################################
+    table_rows.sort(key=lambda row: (str(row['point_id']), row['date'], row['tile'], row['variable']))
+    zs.write_table(['point_id', 'date', 'tile', 'x', 'y', 'variable', 'value'], table_rows, OUTPUT_PATH)
+    return table_rows
@@ -1,578 +1,723 @@
 import os
-import numpy as np
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from osgeo import gdal
 import helper
 import cal_index as ci
+import zonal_stats as zs
+import datacube as dc
+import run_ledger as rl
+import band_cache as bc
+import profiling as pf
 
 
 # ---------------------------------------------------#
-#   Processing Sentinel-2 L2A product data
+#   Checking processing parameters
 # ---------------------------------------------------#
-def s2_l2a_process(params):
+def check_process_params(params):
     """
-    Processing Sentinel-2 L2A product.
+    Checking processing parameters and filling in the default values.
 
     :param params: These parameters determine the data processing parameters.
+    :return: The checked parameters.
+    """
+    params = dict(params)
+
+    if params.get('INPUT_PATH') is None:
+        raise ValueError("ERROR!!! Parameter INPUT_PATH not correctly defined")
+    if params.get('OUTPUT_PATH') is None:
+        raise ValueError("ERROR!!! Parameter OUTPUT_PATH not correctly defined")
+    if params.get('QUICK_IMG') is None:
+        params['QUICK_IMG'] = True
+    if params.get('QUICK_IMG_SIZE') is not None and params['QUICK_IMG_SIZE'] < 1:
+        raise ValueError("ERROR!!! Parameter QUICK_IMG_SIZE not correctly defined")
+    if params.get('REPROJECT') is None:
+        params['REPROJECT'] = False
+    if params.get('CLIP_TO_SHP') is None:
+        params['CLIP_TO_SHP'] = False
+    if params.get('AOI_FIRST') is None:
+        params['AOI_FIRST'] = False
+    if params.get('AOI_SPARSE') is None:
+        params['AOI_SPARSE'] = False
+    if params.get('AOI_WINDOW_OVERHEAD') is None:
+        # 每个读取窗口的固定开销，相当于256×256个像元
+        params['AOI_WINDOW_OVERHEAD'] = 65536
+    if params.get('ZONAL_STATS') is None:
+        params['ZONAL_STATS'] = False
+    if params.get('ZONAL_FORMAT') is None:
+        params['ZONAL_FORMAT'] = 'csv'
+    if params['ZONAL_FORMAT'] not in ('csv', 'parquet'):
+        raise ValueError("ERROR!!! Parameter ZONAL_FORMAT not correctly defined")
+    if params['ZONAL_STATS'] and params['ZONAL_FORMAT'] == 'parquet' and zs.pd is None:
+        raise ValueError("ERROR!!! Parameter ZONAL_FORMAT 'parquet' requires pandas")
+    if params.get('DATACUBE') is None:
+        params['DATACUBE'] = False
+    if params['DATACUBE'] and dc.tables is None:
+        raise ValueError("ERROR!!! Parameter DATACUBE requires PyTables")
+    if params.get('DATACUBE_BANDS') is None:
+        params['DATACUBE_BANDS'] = False
+    if params.get('ZONAL_PERCENTILES') is None:
+        params['ZONAL_PERCENTILES'] = zs.ZONAL_PERCENTILES
+    if (params['AOI_FIRST'] or params['AOI_SPARSE'] or params['ZONAL_STATS']) and params.get('SHP_FILE_PATH') is None:
+        raise ValueError("ERROR!!! Parameter SHP_FILE_PATH not correctly defined")
+    for index_name in ci.INDEX_REGISTRY:
+        if params.get('CAL_' + index_name.upper()) is None:
+            params['CAL_' + index_name.upper()] = False
+    # 需要计算的植被指数{植被指数名: (表达式, 值域)}，包括CUSTOM_INDICES中自定义的指数
+    params['INDICES'] = ci.get_indices(params)
+    if params.get('READ_FROM_ZIP') is None:
+        params['READ_FROM_ZIP'] = False
+    if params.get('CLOUD_MASK') is None:
+        params['CLOUD_MASK'] = False
+    if params.get('CLOUD_MASK_CLASSES') is None:
+        params['CLOUD_MASK_CLASSES'] = helper.SCL_MASK_CLASSES
+    if params.get('SAVE_SCL') is None:
+        params['SAVE_SCL'] = False
+    if params.get('CLOUD_PROB_THRESHOLD') is not None and not 0 <= params['CLOUD_PROB_THRESHOLD'] <= 100:
+        raise ValueError("ERROR!!! Parameter CLOUD_PROB_THRESHOLD not correctly defined")
+    if params.get('STACK_ALL_BANDS') is None:
+        params['STACK_ALL_BANDS'] = False
+    if params.get('BAND_CACHE_PATH') is not None and params.get('BAND_CACHE_SIZE') is None:
+        # 波段缓存的大小上限（GB）
+        params['BAND_CACHE_SIZE'] = 50
+    if params.get('BAND_CACHE_SIZE') is not None and params['BAND_CACHE_SIZE'] <= 0:
+        raise ValueError("ERROR!!! Parameter BAND_CACHE_SIZE not correctly defined")
+    if params.get('SAVE_MERGE') is None:
+        params['SAVE_MERGE'] = True
+    if params.get('SAVE_PROJECTED') is None:
+        params['SAVE_PROJECTED'] = True
+    if params.get('SAVE_CLIP') is None:
+        params['SAVE_CLIP'] = True
+    if params.get('RESUME') is None:
+        # 跳过运行记录中已完成的输出，只处理缺失的输出
+        params['RESUME'] = True
+    if params.get('PROFILE') is None:
+        # 记录各阶段的时间、内存及读写字节数
+        params['PROFILE'] = False
+    if params.get('PROFILE_SUMMARY') is None:
+        params['PROFILE_SUMMARY'] = False
+    if params.get('PROFILE_RUN') is None:
+        # 性能记录的批次编号，汇总时只统计本批次的记录
+        params['PROFILE_RUN'] = pf.new_run_id()
+    if params.get('WORKERS') is None:
+        params['WORKERS'] = 1
+    if params['WORKERS'] < 1:
+        raise ValueError("ERROR!!! Parameter WORKERS not correctly defined")
+    if params.get('THREADS') is None:
+        # 未设置时将CPU核数平均分配给各个进程
+        params['THREADS'] = max(1, (os.cpu_count() or 1) // params['WORKERS'])
+    if params['THREADS'] < 1:
+        raise ValueError("ERROR!!! Parameter THREADS not correctly defined")
+    if params.get('BLOCK_SIZE') is None:
+        params['BLOCK_SIZE'] = 1024
+    if params.get('TIFF_PROFILE') not in helper.TIFF_PROFILES:
+        raise ValueError("ERROR!!! Parameter TIFF_PROFILE not correctly defined")
+
+    return params
+
+
+# ---------------------------------------------------#
+#   Processing one Sentinel-2 L2A .SAFE product
+# ---------------------------------------------------#
+def s2_safe_process(safe_file_path, unzip_path, params):
+    """
+    Processing one Sentinel-2 L2A .SAFE product: virtual band stacking with on-the-fly resampling,
+    vegetation indices, quick-look image, reprojection and clipping.
+
+    :param safe_file_path: The .SAFE path of the product, either on disk or a /vsizip/ path.
+    :param unzip_path: The temporary directory for intermediate files.
+    :param params: The checked data processing parameters.
+    :return: The output files {output name: path}, e.g. {'ndvi': <OUTPUT_PATH>/<id>_ndvi.tif}.
     """
-    INPUT_PATH = params['INPUT_PATH']
     OUTPUT_PATH = params['OUTPUT_PATH']
     QUICK_IMG = params['QUICK_IMG']
-    REPROJECT = params['REPROJECT']
+    SHP_FILE_PATH = params['SHP_FILE_PATH']
+    AOI_FIRST = params['AOI_FIRST']
+    AOI_SPARSE = params['AOI_SPARSE']
+    CLOUD_MASK = params['CLOUD_MASK']
+    CLOUD_PROB_THRESHOLD = params.get('CLOUD_PROB_THRESHOLD')
+    ZONAL_STATS = params['ZONAL_STATS']
+    STACK_ALL_BANDS = params['STACK_ALL_BANDS']
+    THREADS = params['THREADS']
+
+    # 需要计算的植被指数
+    indices = params['INDICES']
+    # 根据需要计算的植被指数及快视图确定最少的波段，未计算任何指数和快视图时输出全部波段
+    band_names = ci.get_stack_bands(indices, QUICK_IMG, STACK_ALL_BANDS)
+    print("Bands to be stacked: {}".format(band_names))
+
+    helper.set_gdal_threads(THREADS)
+    ci.set_index_threads(THREADS)
+
+    # 检索.SAFE文件下的所有子文件夹，找到IMG_DATA文件夹
+    IMG_DATA_path = helper.get_img_data_path(safe_file_path)
+
+    # 获得文件名
+    img_identifier = helper.get_image_name(IMG_DATA_path)
+    # 拼接成各个波段文件绝对路径，仅引用需要的波段
+    jp2_path_list = [helper.get_band_path(IMG_DATA_path, img_identifier, band_name,
+                                          helper.BAND_RESOLUTION[band_name]) for band_name in band_names]
+    # 云掩膜的数据源{名称: 路径}：场景分类图（SCL，20m）和/或云概率（MSK_CLDPRB，20m）
+    scl_path = helper.get_band_path(IMG_DATA_path, img_identifier, 'SCL', '20m')
+    mask_sources = {}
+    if CLOUD_MASK:
+        mask_sources['SCL'] = scl_path
+    if CLOUD_PROB_THRESHOLD is not None:
+        mask_sources['CLDPRB'] = helper.join_path(helper.get_qi_data_path(IMG_DATA_path), helper.CLDPRB_FILE_NAME)
+
+    # 创建VRT文件存储路径
+    vrt_save_path = unzip_path + os.sep + img_identifier
+    if not os.path.exists(vrt_save_path):
+        os.makedirs(vrt_save_path)
+
+    # 地块统计：各窗口计算植被指数时收集地块内的像元{植被指数名: [(地块编号数组, 指数值数组), ...]}
+    zonal_indices = rl.get_pending_indices(params, ('zonal_',)) if ZONAL_STATS else {}
+    zone_values = {} if zonal_indices else None
+
+    output_dict = {}
+
+    if AOI_SPARSE:
+        # 分散地块：各要素的窗口按代价模型合并为互不重叠的窗口后逐个处理，输出各窗口的影像及其VRT镶嵌
+        windows = helper.get_aoi_windows(SHP_FILE_PATH, jp2_path_list[0], overhead=params['AOI_WINDOW_OVERHEAD'])
+        if not windows:
+            print("{} does not intersect {}, skipped".format(img_identifier, SHP_FILE_PATH))
+            return output_dict
+        print("AOI windows: {}".format(len(windows)))
+        window_outputs = {}
+        for k, bounds in enumerate(windows):
+            window_identifier = img_identifier + "_w{:03d}".format(k)
+            outputs = s2_window_process(jp2_path_list, band_names, vrt_save_path, window_identifier, bounds, params,
+                                        mask_sources, zone_values, scl_path, crop_to_cutline=False)
+            for output in outputs:
+                # 按输出类型（_merge.tif、_ndvi.tif等）分组
+                window_outputs.setdefault(os.path.basename(output)[len(window_identifier):], []).append(output)
+        for suffix in window_outputs:
+            mosaic_vrt = os.path.join(OUTPUT_PATH, img_identifier + os.path.splitext(suffix)[0] + ".vrt")
+            gdal.BuildVRT(mosaic_vrt, window_outputs[suffix])
+            output_dict[os.path.splitext(suffix)[0][1:]] = mosaic_vrt
+    else:
+        # 研究区优先：只引用矢量范围（外扩重采样边距）内的窗口，后续步骤只处理该窗口
+        aoi_bounds = None
+        if AOI_FIRST:
+            aoi_bounds = helper.get_aoi_bounds(SHP_FILE_PATH, jp2_path_list[0])
+            if aoi_bounds is None:
+                print("{} does not intersect {}, skipped".format(img_identifier, SHP_FILE_PATH))
+                return output_dict
+            print("AOI window: {}".format(aoi_bounds))
+        outputs = s2_window_process(jp2_path_list, band_names, vrt_save_path, img_identifier, aoi_bounds, params,
+                                    mask_sources, zone_values, scl_path)
+        for output in outputs:
+            output_dict[os.path.splitext(os.path.basename(output))[0][len(img_identifier) + 1:]] = output
+
+    # 输出地块统计表（按地块编号、日期）
+    if zone_values is not None:
+        with pf.stage('zonal'):
+            feature_ids = zs.get_feature_ids(SHP_FILE_PATH, params.get('ZONAL_ID_FIELD'))
+            columns, rows = zs.zonal_table(zone_values, feature_ids, img_identifier, params['ZONAL_PERCENTILES'])
+        zonal_path = os.path.join(OUTPUT_PATH, img_identifier + "_zonal." + params['ZONAL_FORMAT'])
+        if params.get('PENDING_OUTPUTS') is not None and os.path.exists(zonal_path):
+            # 续跑时只重新统计了部分植被指数，保留统计表中其余指数的各行
+            recomputed = set(zonal_indices) | set(zone_values)
+            rows = [row for row in zs.read_table(zonal_path) if row['index'] not in recomputed] + rows
+        zs.write_table(columns, rows, zonal_path)
+        for index_name in zonal_indices:
+            output_dict['zonal_' + index_name] = zonal_path
+    return output_dict
+
+
+def s2_window_process(jp2_path_list, band_names, vrt_save_path, img_identifier, bounds, params, mask_sources=None,
+                      zone_values=None, scl_path=None, crop_to_cutline=True):
+    """
+    Processing one window (or the whole tile) of a product: virtual band stacking, vegetation indices,
+    quick-look image, reprojection and clipping.
+
+    :param jp2_path_list: The band files of the product.
+    :param band_names: The band names of the band files.
+    :param vrt_save_path: The temporary directory for the VRT files.
+    :param img_identifier: The prefix of the output files.
+    :param bounds: The window (minX, minY, maxX, maxY) in the tile CRS, None for the whole tile.
+    :param params: The checked data processing parameters.
+    :param mask_sources: The cloud mask sources {'SCL': path, 'CLDPRB': path}, None for no masking.
+    :param zone_values: The dict collecting the pixels of the features for zonal statistics, None for none.
+    :param scl_path: The scene classification (SCL) band, written to <id>_scl.tif when SAVE_SCL is set.
+    :param crop_to_cutline: Whether the clipped outputs are cropped to the extent of the whole shapefile.
+    :return: The output files.
+    """
+    OUTPUT_PATH = params['OUTPUT_PATH']
+    # 只生成运行记录中尚未完成的输出（PENDING_OUTPUTS为None时生成全部输出）
+    QUICK_IMG = params['QUICK_IMG'] and rl.is_pending(params, 'quickimg')
+    QUICK_IMG_SIZE = params.get('QUICK_IMG_SIZE')
     CRS = params['CRS']
-    CLIP_TO_SHP = params['CLIP_TO_SHP']
     SHP_FILE_PATH = params['SHP_FILE_PATH']
-    CAL_NDVI = params['CAL_NDVI']
-    CAL_NDRE = params['CAL_NDRE']
-    CAL_OSAVI = params['CAL_OSAVI']
-    CAL_LCI = params['CAL_LCI']
-    CAL_GNDVI = params['CAL_GNDVI']
-    CAL_RECI = params['CAL_RECI']
-    CAL_NDMI = params['CAL_NDMI']
-    CAL_NDWI = params['CAL_NDWI']
+    SAVE_MERGE = params['SAVE_MERGE'] and rl.is_pending(params, 'merge')
+    SAVE_PROJECTED = params['SAVE_PROJECTED'] and rl.is_pending(params, 'projected')
+    SAVE_CLIP = params['SAVE_CLIP'] and rl.is_pending(params, 'clip')
+    SAVE_SCL = params['SAVE_SCL'] and rl.is_pending(params, 'scl')
+    CLOUD_MASK_CLASSES = params['CLOUD_MASK_CLASSES']
+    CLOUD_PROB_THRESHOLD = params.get('CLOUD_PROB_THRESHOLD')
+    BAND_CACHE_PATH = params.get('BAND_CACHE_PATH')
+    THREADS = params['THREADS']
+    BLOCK_SIZE = params['BLOCK_SIZE']
+    TIFF_PROFILE = params.get('TIFF_PROFILE')
+
+    # 需要计算的植被指数（地块统计在计算植被指数的同一次遍历中收集像元），以及重投影、裁剪后需要计算的植被指数
+    indices = rl.get_pending_indices(params, ('', 'zonal_'))
+    proj_indices = rl.get_pending_indices(params, ('proj_',))
+    clip_indices = rl.get_pending_indices(params, ('clip_',))
+    REPROJECT = params['REPROJECT'] and bool(proj_indices or SAVE_PROJECTED)
+    CLIP_TO_SHP = params['CLIP_TO_SHP'] and bool(clip_indices or SAVE_CLIP)
+    # 按波段并行读取的线程数（快视图），其余步骤的线程全部用于GDAL内部的jp2解码及重投影
+    band_threads = min(THREADS, len(band_names))
+    outputs = []
 
     ###########################################
-    # 0. CHECK PARAMETERS
+    #   Step 2: 构建虚拟波段叠加（VRT）
+    #   直接引用jp2波段，20m波段在读取时按双线性插值重采样至10m分辨率，不生成中间tif文件；
+    #   设置BAND_CACHE_PATH时引用波段缓存中已解码并重采样的波段，缓存中没有时解码后写入缓存
     ###########################################
+    def get_band_sources(band_path_list, resample_alg):
+        if BAND_CACHE_PATH is None:
+            return band_path_list
+        return bc.get_cached_bands(BAND_CACHE_PATH, band_path_list, bounds, resample_alg)
+
+    with pf.stage('stack', window=img_identifier, cached=BAND_CACHE_PATH is not None):
+        stack_vrt = os.path.join(vrt_save_path, img_identifier + "_stack.vrt")
+        helper.build_stack_vrt(get_band_sources(jp2_path_list, 'bilinear'), stack_vrt, band_names, output_bounds=bounds)
+    # 云掩膜：场景分类图、云概率按最邻近法重采样至相同的10m网格，只生成一次，
+    # 各输出（波段叠加、植被指数、重投影及裁剪）按块计算时共用
+    mask_tif = None
+    if mask_sources and (indices or SAVE_MERGE or REPROJECT or CLIP_TO_SHP):
+        with pf.stage('mask', window=img_identifier):
+            mask_names = list(mask_sources)
+            mask_vrt = os.path.join(vrt_save_path, img_identifier + "_mask_src.vrt")
+            helper.build_stack_vrt(get_band_sources([mask_sources[name] for name in mask_names], 'nearest'), mask_vrt,
+                                   mask_names, resample_alg='nearest', output_bounds=bounds)
+            mask_tif = os.path.join(vrt_save_path, img_identifier + "_mask.tif")
+            masked = helper.create_cloud_mask(mask_vrt, mask_tif,
+                                              mask_names.index('SCL') + 1 if 'SCL' in mask_names else None,
+                                              CLOUD_MASK_CLASSES,
+                                              mask_names.index('CLDPRB') + 1 if 'CLDPRB' in mask_names else None,
+                                              CLOUD_PROB_THRESHOLD, BLOCK_SIZE)
+        print("Cloud mask: {:.1%} of the pixels masked".format(masked))
+    # 地块统计：矢量要素按波段叠加的网格栅格化一次，在计算植被指数的同一次遍历中收集地块像元
+    zone_tif = None
+    if zone_values is not None:
+        zone_tif = os.path.join(vrt_save_path, img_identifier + "_zones.tif")
+        with pf.stage('zones', window=img_identifier):
+            zs.rasterize_features(SHP_FILE_PATH, stack_vrt, zone_tif)
 
-    if INPUT_PATH is None:
-        raise ValueError("ERROR!!! Parameter INPUT_PATH not correctly defined")
-    if OUTPUT_PATH is None:
-        raise ValueError("ERROR!!! Parameter OUTPUT_PATH not correctly defined")
-    if QUICK_IMG is None:
-        QUICK_IMG = True
-    if CLIP_TO_SHP is None:
-        CLIP_TO_SHP = False
-    if CAL_NDVI is None:
-        CAL_NDVI = False
-    if CAL_NDRE is None:
-        CAL_NDRE = False
-    if CAL_OSAVI is None:
-        CAL_OSAVI = False
-    if CAL_LCI is None:
-        CAL_LCI = False
-    if CAL_GNDVI is None:
-        CAL_GNDVI = False
-    if CAL_RECI is None:
-        CAL_RECI = False
-    if CAL_NDMI is None:
-        CAL_NDMI = False
-    if CAL_NDWI is None:
-        CAL_NDWI = False
+    ###########################################
+    #   Step 3: 波段叠加输出及植被指数计算
+    #   按块读取虚拟波段叠加，同一次遍历中计算植被指数，并仅在需要时写出多波段TIF文件
+    ###########################################
+    merge_out = os.path.join(OUTPUT_PATH, img_identifier + "_merge.tif")
+    # jp2解码、重采样、波段叠加输出及各植被指数在同一次遍历中完成，记录为一个阶段
+    with pf.stage('indices', window=img_identifier, indices=sorted(indices), merge=SAVE_MERGE):
+        ci.cal_indices(stack_vrt, os.path.join(OUTPUT_PATH, img_identifier), indices, band_names, BLOCK_SIZE,
+                       TIFF_PROFILE, merge_out if SAVE_MERGE else None, mask_tif, zone_tif, zone_values)
+    outputs += [os.path.join(OUTPUT_PATH, img_identifier + '_' + index_name + '.tif') for index_name in indices]
+    if SAVE_MERGE:
+        outputs.append(merge_out)
+    # 后续步骤优先读取已解码的波段叠加影像
+    stack_src = merge_out if SAVE_MERGE else stack_vrt
+
+    # 输出与波段叠加网格一致的场景分类图（最邻近法重采样至10m），用于多时相合成时选择最佳像元
+    if SAVE_SCL and scl_path is not None:
+        with pf.stage('scl', window=img_identifier):
+            scl_vrt = os.path.join(vrt_save_path, img_identifier + "_scl.vrt")
+            helper.build_stack_vrt(get_band_sources([scl_path], 'nearest'), scl_vrt, ['SCL'], resample_alg='nearest',
+                                   output_bounds=bounds)
+            scl_out = os.path.join(OUTPUT_PATH, img_identifier + "_scl.tif")
+            scl_format, scl_options = helper.get_tiff_profile(TIFF_PROFILE, gdal.GDT_Byte)
+            gdal.Translate(scl_out, scl_vrt, format=scl_format, creationOptions=scl_options)
+        outputs.append(scl_out)
 
     ###########################################
-    #   Step 1: 解压缩zip文件，并打印文件相关信息
+    #   第四步：真彩色影像可视化
+    #   对图像进行拉伸显示
+    #   转换成0-255的快视图并保存
     ###########################################
-    # Create a temporary directory
-    unzip_path = OUTPUT_PATH + os.sep + "unzip"
-    if not os.path.exists(unzip_path):
-        os.makedirs(unzip_path)
+    if QUICK_IMG:
+        with pf.stage('quicklook', window=img_identifier):
+            # 只读取B02,B03,B04三个波段
+            quick_bands = [band_names.index(band_name) + 1 for band_name in ci.QUICK_IMG_BANDS]
+            # 设置QUICK_IMG_SIZE时由VRT按缩小后的尺寸读取，直接使用jp2的低分辨率级别，不解码全分辨率影像
+            quick_src = stack_vrt if QUICK_IMG_SIZE else stack_src
+            # 多线程按波段读取波段叠加数据
+            quick_threads = min(band_threads, len(quick_bands))
+            helper.set_gdal_threads(THREADS, quick_threads)
+            proj, geotrans, img_data, row, column = helper.read_img_parallel(quick_src, quick_threads, quick_bands,
+                                                                             QUICK_IMG_SIZE)
+            helper.set_gdal_threads(THREADS)
+            # 提取3波段改变rgb顺序，由直方图分位数及查找表将数据值域缩放至（0~255）
+            img_data_rgb_s = helper.quick_rgb(img_data)
+
+            quickimg = os.path.join(OUTPUT_PATH, img_identifier + "_quickimg.tif")
+            helper.write_tiff(img_data_rgb_s, geotrans, proj, quickimg, TIFF_PROFILE)
+        outputs.append(quickimg)
+        del img_data, img_data_rgb_s
+
+    ###########################################
+    #   第五步：重投影
+    #   构建重投影的虚拟影像（warped VRT），按块读取时即时重投影，
+    #   同一次遍历中计算植被指数，并仅在需要时写出重投影后的影像
+    ###########################################
+    if REPROJECT:
+        with pf.stage('reproject', window=img_identifier, indices=sorted(proj_indices)):
+            projected_vrt = os.path.join(vrt_save_path, img_identifier + "_projected.vrt")
+            gdal.Warp(projected_vrt, stack_src, format='VRT', dstSRS=CRS,  # epsg可以通过https://epsg.io/查询
+                      multithread=True)
+            # 云掩膜按相同参数重投影，与重投影后的影像网格一致，影像范围外为无效像元
+            projected_mask = None
+            if mask_tif is not None:
+                projected_mask = os.path.join(vrt_save_path, img_identifier + "_projected_mask.vrt")
+                gdal.Warp(projected_mask, mask_tif, format='VRT', dstSRS=CRS, dstNodata=1, multithread=True)
+            reprojected_img = os.path.join(OUTPUT_PATH, img_identifier + "_projected.tif")
+            ci.cal_indices(projected_vrt, os.path.join(OUTPUT_PATH, img_identifier + "_proj"), proj_indices,
+                           band_names, BLOCK_SIZE, TIFF_PROFILE, reprojected_img if SAVE_PROJECTED else None,
+                           projected_mask)
+        outputs += [os.path.join(OUTPUT_PATH, img_identifier + '_proj_' + index_name + '.tif')
+                    for index_name in proj_indices]
+        if SAVE_PROJECTED:
+            outputs.append(reprojected_img)
 
+    ###########################################
+    #   第六步：数据裁剪
+    #   构建按矢量轮廓裁剪的虚拟影像，同一次遍历中计算植被指数，并仅在需要时写出裁剪后的影像
+    ###########################################
+    if CLIP_TO_SHP:
+        with pf.stage('clip', window=img_identifier, indices=sorted(clip_indices)):
+            clip_vrt = os.path.join(vrt_save_path, img_identifier + "_clip.vrt")
+            # 按矢量轮廓裁剪
+            gdal.Warp(clip_vrt,  # 裁剪后的虚拟影像保存位置
+                      stack_src,  # 待裁剪的影像
+                      format='VRT',  # 输出虚拟影像，读取时再执行裁剪
+                      cutlineDSName=SHP_FILE_PATH,  # 矢量数据
+                      cropToCutline=crop_to_cutline,  # 将目标图像的范围指定为cutline矢量图像的范围，否则保持窗口范围
+                      multithread=True)  # 多线程重投影
+            # 云掩膜按相同参数裁剪，与裁剪后的影像网格一致，矢量轮廓外为无效像元
+            clip_mask = None
+            if mask_tif is not None:
+                clip_mask = os.path.join(vrt_save_path, img_identifier + "_clip_mask.vrt")
+                gdal.Warp(clip_mask, mask_tif, format='VRT', cutlineDSName=SHP_FILE_PATH,
+                          cropToCutline=crop_to_cutline, dstNodata=1, multithread=True)
+            clip_output = os.path.join(OUTPUT_PATH, img_identifier + "_clip.tif")
+            ci.cal_indices(clip_vrt, os.path.join(OUTPUT_PATH, img_identifier + "_clip"), clip_indices,
+                           band_names, BLOCK_SIZE, TIFF_PROFILE, clip_output if SAVE_CLIP else None,
+                           clip_mask)
+        outputs += [os.path.join(OUTPUT_PATH, img_identifier + '_clip_' + index_name + '.tif')
+                    for index_name in clip_indices]
+        if SAVE_CLIP:
+            outputs.append(clip_output)
+
+    return outputs
+
+
+# ---------------------------------------------------#
+#   Running the products of a batch
+# ---------------------------------------------------#
+def run_product(product_function, zip_file_path, unzip_path, params):
+    """
+    Running the processing of one product and reporting its failure instead of raising it,
+    so that one failed product does not stop the batch. Only the outputs not yet completed
+    in the run ledger are processed, the completed outputs are recorded in the ledger and
+    the temporary directory of the product is removed as soon as the product finishes.
+
+    :param product_function: The function processing one product, e.g. s2_l2a_product_process.
+    :param zip_file_path: The .zip file of the product.
+    :param unzip_path: The temporary directory of the batch.
+    :param params: The checked data processing parameters.
+    :return: The error message (None if the product is processed successfully) and the output files
+             {output name: path} processed in this run (empty if the product is skipped or failed).
+    """
+    OUTPUT_PATH = params['OUTPUT_PATH']
+    product = os.path.basename(zip_file_path)
+    # 在（子）进程中设置分阶段性能记录
+    pf.set_profile(os.path.join(OUTPUT_PATH, pf.PROFILE_FILE_NAME) if params['PROFILE'] else None, product,
+                   params['PROFILE_RUN'])
+
+    try:
+        fingerprints = rl.get_fingerprints(zip_file_path, params)
+        pending = None
+        if params['RESUME']:
+            pending = rl.get_pending_outputs(OUTPUT_PATH, product, fingerprints)
+            if not pending:
+                print("{} has been processed, skipped".format(zip_file_path))
+                return None, {}
+            if len(pending) < len(fingerprints):
+                print("{} resumed, outputs to be processed: {}".format(zip_file_path, sorted(pending)))
+        with pf.stage('product', outputs=sorted(pending or fingerprints)):
+            output_dict = product_function(zip_file_path, unzip_path, dict(params, PENDING_OUTPUTS=pending))
+        rl.record_outputs(OUTPUT_PATH, product, {name: fingerprints[name] for name in pending or fingerprints},
+                          output_dict)
+    except Exception:
+        error_message = traceback.format_exc()
+        print("{} processing failed!\n{}".format(zip_file_path, error_message))
+        return error_message, {}
+    finally:
+        # 每景产品完成（或失败）后立即删除其临时文件夹（不删除其他进程仍在使用的批次临时文件夹）
+        shutil.rmtree(os.path.join(unzip_path, os.path.splitext(product)[0]), ignore_errors=True)
+    return None, output_dict
+
+
+def run_products(product_function, zip_path_list, unzip_path, params):
+    """
+    Running the processing of all products, one by one or concurrently in a process pool,
+    then appending the products processed in this batch to the datacubes (DATACUBE) and
+    limiting the band cache to BAND_CACHE_SIZE.
+
+    :param product_function: The function processing one product, e.g. s2_l2a_product_process.
+    :param zip_path_list: The .zip files of the products.
+    :param unzip_path: The temporary directory of the batch.
+    :param params: The checked data processing parameters.
+    :return: A dict of the failed products and their error messages.
+    """
+    OUTPUT_PATH = params['OUTPUT_PATH']
+    WORKERS = params['WORKERS']
+
+    failed_dict = {}
+    # 本批次处理完成的产品编号（跳过及失败的产品不包括在内）
+    processed_identifiers = set()
+    if WORKERS > 1 and len(zip_path_list) > 1:
+        # 各景产品相互独立，使用进程池并行处理
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            future_dict = {}
+            for zip_file_path in zip_path_list:
+                future = executor.submit(run_product, product_function, zip_file_path, unzip_path, params)
+                future_dict[future] = zip_file_path
+            for future in as_completed(future_dict):
+                zip_file_path = future_dict[future]
+                try:
+                    error_message, output_dict = future.result()
+                except Exception:
+                    # 子进程异常退出（例如GDAL崩溃）
+                    error_message, output_dict = traceback.format_exc(), {}
+                    print("{} processing failed!\n{}".format(zip_file_path, error_message))
+                if error_message is not None:
+                    failed_dict[zip_file_path] = error_message
+                processed_identifiers.update(dc.get_output_identifiers(output_dict.values()))
+    else:
+        for zip_file_path in zip_path_list:
+            error_message, output_dict = run_product(product_function, zip_file_path, unzip_path, params)
+            if error_message is not None:
+                failed_dict[zip_file_path] = error_message
+            processed_identifiers.update(dc.get_output_identifiers(output_dict.values()))
+
+    print("{} of {} products processed successfully.".format(len(zip_path_list) - len(failed_dict),
+                                                             len(zip_path_list)))
+    for zip_file_path in failed_dict:
+        print("Failed: {}".format(zip_file_path))
+
+    # 追加时间序列数据立方体：HDF5文件不能被多个进程同时写入，由主进程逐景追加本批次处理的产品
+    if params['DATACUBE'] and processed_identifiers:
+        pf.set_profile(os.path.join(OUTPUT_PATH, pf.PROFILE_FILE_NAME) if params['PROFILE'] else None,
+                       run=params['PROFILE_RUN'])
+        with pf.stage('datacube', products=len(processed_identifiers)):
+            dc.update_cubes(OUTPUT_PATH, processed_identifiers, params['INDICES'], params['DATACUBE_BANDS'],
+                            params['BLOCK_SIZE'])
+
+    # 清理波段缓存：各产品的VRT引用缓存文件，处理过程中不能删除，全部产品完成后由主进程统一清理
+    if params.get('BAND_CACHE_PATH') is not None and os.path.exists(params['BAND_CACHE_PATH']):
+        bc.evict_cache(params['BAND_CACHE_PATH'], params['BAND_CACHE_SIZE'] * 1024 ** 3)
+    return failed_dict
+
+
+def get_zip_path_list(input_path):
+    """
+    Getting the .zip files of the products in the input directory.
+
+    :param input_path: The input directory.
+    :return: The list of .zip file paths.
+    """
     # Pattern of file mode
     pattern_zip = ".zip"
-    pattern_safe = ".SAFE"
-    for zip_file in os.listdir(INPUT_PATH):
+    zip_path_list = []
+    for zip_file in sorted(os.listdir(input_path)):
         # 判断是否是.zip文件
         if pattern_zip in zip_file:
             # 获取.zip文件的完整路径
-            zip_file_path = os.path.join(INPUT_PATH, zip_file)
-            # 解压.zip文件，产生.SAFE格式文件
-            helper.unzip_file(zip_file_path, unzip_path)
-
-            # 遍历解压缩文件夹
-            for safe_file in os.listdir(unzip_path):
-                # 判断是否是.SAFE文件
-                if pattern_safe in safe_file:
-                    # 获取.SAFE文件的完整路径
-                    safe_file_path = os.path.join(unzip_path, safe_file)
-                    # 打印.SAFE格式文件信息
-                    helper.print_s2_info(safe_file_path)
-
-                    ###########################################
-                    #   Step 2: 数据格式转换，由jp2转换为tif格式
-                    ###########################################
-                    # 检索解压目录下的所有子文件夹，找到IMG_DATA文件夹
-                    IMG_DATA_path = ""
-                    for root, _, _ in os.walk(safe_file_path):
-                        if root.endswith("IMG_DATA"):
-                            IMG_DATA_path = root
-
-                    # 获得文件名
-                    img_identifier = helper.get_image_name(IMG_DATA_path)
-                    # 拼接成各个波段文件绝对路径
-                    # 20m分辨率数据
-                    jp2_20m_list = [IMG_DATA_path + os.sep + 'R20m\\%s_B8A_20m.jp2' % img_identifier,
-                                    IMG_DATA_path + os.sep + 'R20m\\%s_B11_20m.jp2' % img_identifier,
-                                    IMG_DATA_path + os.sep + 'R20m\\%s_B12_20m.jp2' % img_identifier,
-                                    IMG_DATA_path + os.sep + 'R20m\\%s_B05_20m.jp2' % img_identifier,
-                                    IMG_DATA_path + os.sep + 'R20m\\%s_B06_20m.jp2' % img_identifier,
-                                    IMG_DATA_path + os.sep + 'R20m\\%s_B07_20m.jp2' % img_identifier]
-                    # 10m分辨率数据
-                    jp2_10m_list = [IMG_DATA_path + os.sep + 'R10m\\%s_B02_10m.jp2' % img_identifier,
-                                    IMG_DATA_path + os.sep + 'R10m\\%s_B03_10m.jp2' % img_identifier,
-                                    IMG_DATA_path + os.sep + 'R10m\\%s_B04_10m.jp2' % img_identifier,
-                                    IMG_DATA_path + os.sep + 'R10m\\%s_B08_10m.jp2' % img_identifier]
-
-                    # 仅堆叠可见波段NIR、RE和SWIR1和SWIR2（波段2、3、4、8、8A、11、12）。
-                    # 将20m波段（8A、11和12）重新采样至10m。
-                    # 创建20m分辨率数据存储路径
-                    tif_20m_save_path = unzip_path + os.sep + img_identifier + os.sep + "20m"
-                    if not os.path.exists(tif_20m_save_path):
-                        os.makedirs(tif_20m_save_path)
-
-                    # 将20m分辨率数据由jp2格式转换为tif格式，并记录地址到tif_20m_list
-                    tif_20m_list = []
-                    for jp2_path in jp2_20m_list:
-                        tif_path = helper.jp2_to_tif(jp2_path, tif_20m_save_path)
-                        tif_20m_list.append(tif_path)
-
-                    # 创建10m分辨率数据存储路径
-                    tif_10m_save_path = unzip_path + os.sep + img_identifier + os.sep + "10m"
-                    if not os.path.exists(tif_10m_save_path):
-                        os.makedirs(tif_10m_save_path)
-
-                    # 将10m分辨率数据由jp2格式转换为tif格式，并记录地址到tif_10m_list
-                    tif_10m_list = []
-                    for jp2_path in jp2_10m_list:
-                        tif_path = helper.jp2_to_tif(jp2_path, tif_10m_save_path)
-                        tif_10m_list.append(tif_path)
-
-                    ###########################################
-                    #   Step 3: 数据重采样，将20m分辨率数据重新采样至10m分辨率
-                    ###########################################
-                    # 获取一景10m分辨率影像作为参考影像
-                    reference_tif = tif_10m_list[0]
-
-                    # 将20m分辨率数据重采样至10m,并保存至 tif_10m_save_path 路径下
-                    for tif_path in tif_20m_list:
-                        file_name = os.path.basename(tif_path)[:-7]
-                        save_tif_path = tif_10m_save_path + os.sep + file_name + "10m.tif"
-                        helper.reproject_images(tif_path, save_tif_path, reference_tif)
-
-                    ###########################################
-                    #   Step 4: 波段叠加
-                    #   将多个不同波段的的TIF文件合为一个多波段TIF文件
-                    #   叠合波段为可见波段NIR、RE和SWIR1和SWIR2（波段2、3、4、8、8A、11、12）
-                    ###########################################
-                    # 数据筛选
-                    tif_list = os.listdir(tif_10m_save_path)  # 获取所有10m分辨率tif数据的名称
-                    tif_path_list = []  # 以列表的形式存储各个波段的路径
-
-                    band_names = ["B02", "B03", "B04", "B08", "B8A", "B11", "B12"]  # 需要堆叠的波段名
-
-                    for band_name in band_names:
-                        for tif_name in tif_list:
-                            if band_name == tif_name[-11:-8]:
-                                tif_path_list.append(tif_10m_save_path + os.sep + tif_name)
-
-                    # 执行叠加函数
-                    merge_out = os.path.join(OUTPUT_PATH, img_identifier + "_merge.tif")
-                    helper.merge_tif(tif_path_list, merge_out)
-
-                    # 计算植被指数
-                    proj, geotrans, img_data, row, column = helper.read_img(merge_out)
-                    if CAL_NDVI:
-                        ndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_ndvi.tif")
-                        ci.cal_ndvi(img_data, geotrans, proj, ndvi_img)
-                    if CAL_NDRE:
-                        ndre_img = os.path.join(OUTPUT_PATH, img_identifier + "_ndre.tif")
-                        ci.cal_ndre(img_data, geotrans, proj, ndre_img)
-                    if CAL_OSAVI:
-                        osavi_img = os.path.join(OUTPUT_PATH, img_identifier + "_osavi.tif")
-                        ci.cal_osavi(img_data, geotrans, proj, osavi_img)
-                    if CAL_LCI:
-                        lci_img = os.path.join(OUTPUT_PATH, img_identifier + "_lci.tif")
-                        ci.cal_lci(img_data, geotrans, proj, lci_img)
-                    if CAL_GNDVI:
-                        gndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_gndvi.tif")
-                        ci.cal_gndvi(img_data, geotrans, proj, gndvi_img)
-                    if CAL_RECI:
-                        reci_img = os.path.join(OUTPUT_PATH, img_identifier + "_reci.tif")
-                        ci.cal_reci(img_data, geotrans, proj, reci_img)
-                    if CAL_NDMI:
-                        ndmi_img = os.path.join(OUTPUT_PATH, img_identifier + "_ndmi.tif")
-                        ci.cal_ndmi(img_data, geotrans, proj, ndmi_img)
-                    if CAL_NDWI:
-                        ndwi_img = os.path.join(OUTPUT_PATH, img_identifier + "_ndwi.tif")
-                        ci.cal_ndwi(img_data, geotrans, proj, ndwi_img)
-
-                    ###########################################
-                    #   第五步：真彩色影像可视化
-                    #   对图像进行拉伸显示
-                    #   转换成0-255的快视图并保存
-                    ###########################################
-                    if QUICK_IMG:
-                        proj, geotrans, img_data, row, column = helper.read_img(merge_out)
-                        img_data_r = helper.rgb(img_data)  # 提取3波段改变rgb顺序和数据维度
-                        # 该操作将改变原始数据，因此data用.copy，不对原始数据进行更改
-                        img_data_rgb_s = np.uint8(helper.stretch_n(img_data_r.copy()) * 255)  # 数据值域缩放至（0~255）
-
-                        quickimg = os.path.join(OUTPUT_PATH, img_identifier + "_quickimg.tif")
-                        ds = gdal.Open(merge_out)  # 打开文件
-                        helper.write_tiff(img_data_rgb_s.transpose(2, 0, 1), ds.GetGeoTransform(), ds.GetProjection(),
-                                          quickimg)
-
-                    ###########################################
-                    #   第六步：重投影
-                    ###########################################
-                    if REPROJECT:
-                        ds = gdal.Open(merge_out)  # 打开文件
-                        reprojected_img = os.path.join(OUTPUT_PATH, img_identifier + "_projected.tif")
-                        gdal.Warp(reprojected_img, ds, dstSRS=CRS)  # epsg可以通过https://epsg.io/查询
-                        # 计算植被指数
-                        proj, geotrans, img_data, row, column = helper.read_img(reprojected_img)
-                        if CAL_NDVI:
-                            ndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_ndvi.tif")
-                            ci.cal_ndvi(img_data, geotrans, proj, ndvi_img)
-                        if CAL_NDRE:
-                            ndre_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_ndre.tif")
-                            ci.cal_ndre(img_data, geotrans, proj, ndre_img)
-                        if CAL_OSAVI:
-                            osavi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_osavi.tif")
-                            ci.cal_osavi(img_data, geotrans, proj, osavi_img)
-                        if CAL_LCI:
-                            lci_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_lci.tif")
-                            ci.cal_lci(img_data, geotrans, proj, lci_img)
-                        if CAL_GNDVI:
-                            gndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_gndvi.tif")
-                            ci.cal_gndvi(img_data, geotrans, proj, gndvi_img)
-                        if CAL_RECI:
-                            reci_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_reci.tif")
-                            ci.cal_reci(img_data, geotrans, proj, reci_img)
-                        if CAL_NDMI:
-                            ndmi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_ndmi.tif")
-                            ci.cal_ndmi(img_data, geotrans, proj, ndmi_img)
-                        if CAL_NDWI:
-                            ndwi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_ndwi.tif")
-                            ci.cal_ndwi(img_data, geotrans, proj, ndwi_img)
-
-                    ###########################################
-                    #   第七步：数据裁剪
-                    ###########################################
-                    if CLIP_TO_SHP:
-                        # 执行裁剪
-                        clip_output = os.path.join(OUTPUT_PATH, img_identifier + "_clip.tif")
-                        # 按矢量轮廓裁剪
-                        gdal.Warp(clip_output,  # 裁剪后影像保存位置
-                                  merge_out,  # 待裁剪的影像
-                                  cutlineDSName=SHP_FILE_PATH,  # 矢量数据
-                                  format="GTiff",  # 输出影像的格式
-                                  cropToCutline=True)  # 将目标图像的范围指定为cutline矢量图像的范围
-                        # 计算植被指数
-                        proj, geotrans, img_data, row, column = helper.read_img(clip_output)
-                        if CAL_NDVI:
-                            ndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_ndvi.tif")
-                            ci.cal_ndvi(img_data, geotrans, proj, ndvi_img)
-                        if CAL_NDRE:
-                            ndre_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_ndre.tif")
-                            ci.cal_ndre(img_data, geotrans, proj, ndre_img)
-                        if CAL_OSAVI:
-                            osavi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_osavi.tif")
-                            ci.cal_osavi(img_data, geotrans, proj, osavi_img)
-                        if CAL_LCI:
-                            lci_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_lci.tif")
-                            ci.cal_lci(img_data, geotrans, proj, lci_img)
-                        if CAL_GNDVI:
-                            gndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_gndvi.tif")
-                            ci.cal_gndvi(img_data, geotrans, proj, gndvi_img)
-                        if CAL_RECI:
-                            reci_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_reci.tif")
-                            ci.cal_reci(img_data, geotrans, proj, reci_img)
-                        if CAL_NDMI:
-                            ndmi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_ndmi.tif")
-                            ci.cal_ndmi(img_data, geotrans, proj, ndmi_img)
-                        if CAL_NDWI:
-                            ndwi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_ndwi.tif")
-                            ci.cal_ndwi(img_data, geotrans, proj, ndwi_img)
+            zip_path_list.append(os.path.join(input_path, zip_file))
+    return zip_path_list
+
+
+def get_product_unzip_path(zip_file_path, unzip_path):
+    """
+    Creating the temporary directory of one product, so that products processed concurrently
+    do not share intermediate files.
+
+    :param zip_file_path: The .zip file of the product.
+    :param unzip_path: The temporary directory of the batch.
+    :return: The temporary directory of the product.
+    """
+    product_unzip_path = os.path.join(unzip_path, os.path.splitext(os.path.basename(zip_file_path))[0])
+    if not os.path.exists(product_unzip_path):
+        os.makedirs(product_unzip_path)
+    return product_unzip_path
+
+
+# ---------------------------------------------------#
+#   Processing one Sentinel-2 L2A .zip product
+# ---------------------------------------------------#
+def s2_l2a_product_process(zip_file_path, unzip_path, params):
+    """
+    Processing one Sentinel-2 L2A .zip product.
+
+    :param zip_file_path: The .zip file of the product.
+    :param unzip_path: The temporary directory of the batch.
+    :param params: The checked data processing parameters.
+    :return: The output files {output name: path}.
+    """
+    READ_FROM_ZIP = params['READ_FROM_ZIP']
 
     ###########################################
-    #   第八步：删除临时文件夹
+    #   Step 1: 解压缩zip文件，并打印文件相关信息
     ###########################################
-    helper.del_dir(unzip_path)
+    product_unzip_path = get_product_unzip_path(zip_file_path, unzip_path)
+    pattern_safe = ".SAFE"
+    if READ_FROM_ZIP:
+        # 不解压.zip文件，通过/vsizip/路径直接读取.SAFE中的jp2波段及MTD元数据
+        safe_path_list = [helper.get_zip_safe_path(zip_file_path)]
+    else:
+        # 解压.zip文件，产生.SAFE格式文件
+        with pf.stage('unzip'):
+            helper.unzip_file(zip_file_path, product_unzip_path)
+        # 遍历解压缩文件夹，获取.SAFE文件的完整路径
+        safe_path_list = [os.path.join(product_unzip_path, safe_file)
+                          for safe_file in os.listdir(product_unzip_path) if pattern_safe in safe_file]
+
+    output_dict = {}
+    for safe_file_path in safe_path_list:
+        # 打印.SAFE格式文件信息
+        with pf.stage('info'):
+            helper.print_s2_info(safe_file_path)
+        # 波段叠加、植被指数计算、快视图、重投影及裁剪
+        output_dict.update(s2_safe_process(safe_file_path, product_unzip_path, params))
+    return output_dict
 
 
 # ---------------------------------------------------#
-#   Processing Sentinel-2 L1C product data
+#   Processing Sentinel-2 L2A product data
 # ---------------------------------------------------#
-def s2_l1c_process(params):
+def s2_l2a_process(params):
     """
-    Processing Sentinel-2 L1C product.
+    Processing Sentinel-2 L2A product.
 
     :param params: These parameters determine the data processing parameters.
+    :return: A dict of the failed products and their error messages.
     """
+    ###########################################
+    # 0. CHECK PARAMETERS
+    ###########################################
+    params = check_process_params(params)
     INPUT_PATH = params['INPUT_PATH']
     OUTPUT_PATH = params['OUTPUT_PATH']
-    QUICK_IMG = params['QUICK_IMG']
-    REPROJECT = params['REPROJECT']
-    CRS = params['CRS']
-    CLIP_TO_SHP = params['CLIP_TO_SHP']
-    SHP_FILE_PATH = params['SHP_FILE_PATH']
-    CAL_NDVI = params['CAL_NDVI']
-    CAL_NDRE = params['CAL_NDRE']
-    CAL_OSAVI = params['CAL_OSAVI']
-    CAL_LCI = params['CAL_LCI']
-    CAL_GNDVI = params['CAL_GNDVI']
-    CAL_RECI = params['CAL_RECI']
-    CAL_NDMI = params['CAL_NDMI']
-    CAL_NDWI = params['CAL_NDWI']
+
+    # Create a temporary directory
+    unzip_path = OUTPUT_PATH + os.sep + "unzip"
+    if not os.path.exists(unzip_path):
+        os.makedirs(unzip_path)
+
+    # 逐景（或并行）处理.zip文件
+    failed_dict = run_products(s2_l2a_product_process, get_zip_path_list(INPUT_PATH), unzip_path, params)
+
+    # 按阶段汇总本批次的性能记录
+    profile_path = os.path.join(OUTPUT_PATH, pf.PROFILE_FILE_NAME)
+    if params['PROFILE'] and params['PROFILE_SUMMARY'] and os.path.exists(profile_path):
+        pf.summarize_profile(profile_path, os.path.join(OUTPUT_PATH, "profile_summary.csv"), params['PROFILE_RUN'])
 
     ###########################################
-    #   Step 0: CHECK PARAMETERS
+    #   第七步：删除临时文件夹
     ###########################################
+    helper.del_dir(unzip_path)
+    return failed_dict
 
-    if INPUT_PATH is None:
-        raise ValueError("ERROR!!! Parameter INPUT_PATH not correctly defined")
-    if OUTPUT_PATH is None:
-        raise ValueError("ERROR!!! Parameter OUTPUT_PATH not correctly defined")
-    if QUICK_IMG is None:
-        QUICK_IMG = True
-    if CLIP_TO_SHP is None:
-        CLIP_TO_SHP = False
-    if CAL_NDVI is None:
-        CAL_NDVI = False
-    if CAL_NDWI is None:
-        CAL_NDWI = False
 
+# ---------------------------------------------------#
+#   Processing one Sentinel-2 L1C .zip product
+# ---------------------------------------------------#
+def s2_l1c_product_process(zip_file_path, unzip_path, params):
+    """
+    Processing one Sentinel-2 L1C .zip product.
+
+    :param zip_file_path: The .zip file of the product.
+    :param unzip_path: The temporary directory of the batch.
+    :param params: The checked data processing parameters.
+    :return: The output files {output name: path}.
+    """
     ###########################################
     #   Step 1: 解压缩zip文件，并打印文件相关信息
     ###########################################
+    product_unzip_path = get_product_unzip_path(zip_file_path, unzip_path)
+    # 解压.zip文件，产生.SAFE格式文件
+    with pf.stage('unzip'):
+        zip_in_file = helper.unzip_file(zip_file_path, product_unzip_path)
+    safe_in_file_path = os.path.join(product_unzip_path, zip_in_file)
+    print(safe_in_file_path)
+
+    ###########################################
+    #   Step 2: 大气校正
+    ###########################################
+    with pf.stage('sen2cor'):
+        helper.sen2Cor(safe_in_file_path, product_unzip_path)
+
+    # 遍历解压缩文件夹
+    for safe_file in os.listdir(product_unzip_path):
+        # 判断是否是MSIL1C文件
+        if "MSIL1C" in safe_file:
+            # 获取MSIL1C.SAFE文件的完整路径
+            unzip_file_path = os.path.join(product_unzip_path, safe_file)
+            print(unzip_file_path)
+            # 打印.SAFE格式文件信息
+            with pf.stage('info'):
+                helper.print_s2_info(unzip_file_path)
+
+    ###########################################
+    #   Step 3: 处理大气校正后的L2A级数据
+    ###########################################
+    output_dict = {}
+    for safe_l2a_file in os.listdir(product_unzip_path):
+        # 判断是否是MSIL2A.SAFE文件
+        if "MSIL2A" in safe_l2a_file:
+            # 获取MSIL2A.SAFE文件的完整路径
+            safe_file_path = os.path.join(product_unzip_path, safe_l2a_file)
+            # 波段叠加、植被指数计算、快视图、重投影及裁剪
+            output_dict.update(s2_safe_process(safe_file_path, product_unzip_path, params))
+    return output_dict
+
+
+# ---------------------------------------------------#
+#   Processing Sentinel-2 L1C product data
+# ---------------------------------------------------#
+def s2_l1c_process(params):
+    """
+    Processing Sentinel-2 L1C product.
+
+    :param params: These parameters determine the data processing parameters.
+    :return: A dict of the failed products and their error messages.
+    """
+    ###########################################
+    #   Step 0: CHECK PARAMETERS
+    ###########################################
+    params = check_process_params(params)
+    INPUT_PATH = params['INPUT_PATH']
+    OUTPUT_PATH = params['OUTPUT_PATH']
+
     # Create a temporary directory
     unzip_path = OUTPUT_PATH + os.sep + "unzip"
     if not os.path.exists(unzip_path):
         os.makedirs(unzip_path)
 
-    # Pattern of file mode
-    pattern_zip = ".zip"
-    pattern_safe = ".SAFE"
-    for zip_file in os.listdir(INPUT_PATH):
-        # 判断是否是.zip文件
-        if pattern_zip in zip_file:
-            # 获取.zip文件的完整路径
-            zip_file_path = os.path.join(INPUT_PATH, zip_file)
-            # 解压.zip文件，产生.SAFE格式文件
-            zip_in_file = helper.unzip_file(zip_file_path, unzip_path)
-            safe_in_file_path = os.path.join(unzip_path, zip_in_file)
-            print(safe_in_file_path)
-
-            ###########################################
-            #   Step 2: 大气校正
-            ###########################################
-            helper.sen2Cor(safe_in_file_path, unzip_path)
-            print(os.getcwd())
-
-            # 遍历解压缩文件夹
-            for safe_file in os.listdir(unzip_path):
-                # 判断是否是MSIL1C文件
-                if "MSIL1C" in safe_file:
-                    # 获取MSIL1C.SAFE文件的完整路径
-                    unzip_file_path = os.path.join(unzip_path, safe_file)
-                    print(unzip_file_path)
-                    # 打印.SAFE格式文件信息
-                    helper.print_s2_info(unzip_file_path)
-
-                    ###########################################
-                    #   Step 3: 数据格式转换，由jp2转换为tif格式
-                    ###########################################
-                    for safe_l2a_file in os.listdir(unzip_path):
-                        # 判断是否是MSIL2A.SAFE文件
-                        if "MSIL2A" in safe_l2a_file:
-                            # 获取MSIL2A.SAFE文件的完整路径
-                            safe_file_path = os.path.join(unzip_path, safe_l2a_file)
-
-                            # 检索解压目录下的所有子文件夹，找到IMG_DATA文件夹
-                            IMG_DATA_path = ""
-                            for root, _, _ in os.walk(safe_file_path):
-                                if root.endswith("IMG_DATA"):
-                                    IMG_DATA_path = root
-
-                            # 获得文件名
-                            img_identifier = helper.get_image_name(IMG_DATA_path)
-                            # 拼接成各个波段文件绝对路径
-                            # 20m分辨率数据
-                            jp2_20m_list = [IMG_DATA_path + os.sep + 'R20m\\%s_B8A_20m.jp2' % img_identifier,
-                                            IMG_DATA_path + os.sep + 'R20m\\%s_B11_20m.jp2' % img_identifier,
-                                            IMG_DATA_path + os.sep + 'R20m\\%s_B12_20m.jp2' % img_identifier,
-                                            IMG_DATA_path + os.sep + 'R20m\\%s_B05_20m.jp2' % img_identifier,
-                                            IMG_DATA_path + os.sep + 'R20m\\%s_B06_20m.jp2' % img_identifier,
-                                            IMG_DATA_path + os.sep + 'R20m\\%s_B07_20m.jp2' % img_identifier]
-                            # 10m分辨率数据
-                            jp2_10m_list = [IMG_DATA_path + os.sep + 'R10m\\%s_B02_10m.jp2' % img_identifier,
-                                            IMG_DATA_path + os.sep + 'R10m\\%s_B03_10m.jp2' % img_identifier,
-                                            IMG_DATA_path + os.sep + 'R10m\\%s_B04_10m.jp2' % img_identifier,
-                                            IMG_DATA_path + os.sep + 'R10m\\%s_B08_10m.jp2' % img_identifier]
-
-                            # 仅堆叠可见波段NIR、RE和SWIR1和SWIR2（波段2、3、4、8、8A、11、12）。
-                            # 将20m波段（8A、11和12）重新采样至10m。
-                            # 创建20m分辨率数据存储路径
-                            tif_20m_save_path = unzip_path + os.sep + img_identifier + os.sep + "20m"
-                            if not os.path.exists(tif_20m_save_path):
-                                os.makedirs(tif_20m_save_path)
-
-                            # 将20m分辨率数据由jp2格式转换为tif格式，并记录地址到tif_20m_list
-                            tif_20m_list = []
-                            for jp2_path in jp2_20m_list:
-                                tif_path = helper.jp2_to_tif(jp2_path, tif_20m_save_path)
-                                tif_20m_list.append(tif_path)
-
-                            # 创建10m分辨率数据存储路径
-                            tif_10m_save_path = unzip_path + os.sep + img_identifier + os.sep + "10m"
-                            if not os.path.exists(tif_10m_save_path):
-                                os.makedirs(tif_10m_save_path)
-
-                            # 将10m分辨率数据由jp2格式转换为tif格式，并记录地址到tif_10m_list
-                            tif_10m_list = []
-                            for jp2_path in jp2_10m_list:
-                                tif_path = helper.jp2_to_tif(jp2_path, tif_10m_save_path)
-                                tif_10m_list.append(tif_path)
-
-                            ###########################################
-                            #   Step 4: 数据重采样，将20m分辨率数据重新采样至10m分辨率
-                            ###########################################
-                            # 获取一景10m分辨率影像作为参考影像
-                            reference_tif = tif_10m_list[0]
-
-                            # 将20m分辨率数据重采样至10m,并保存至 tif_10m_save_path 路径下
-                            for tif_path in tif_20m_list:
-                                file_name = os.path.basename(tif_path)[:-7]
-                                save_tif_path = tif_10m_save_path + os.sep + file_name + "10m.tif"
-                                helper.reproject_images(tif_path, save_tif_path, reference_tif)
-
-                            ###########################################
-                            #   Step 5: 波段叠加
-                            #   将多个不同波段的的TIF文件合为一个多波段TIF文件
-                            #   叠合波段为可见波段NIR、RE和SWIR1和SWIR2（波段2、3、4、8、8A、11、12）
-                            ###########################################
-                            # 数据筛选
-                            tif_list = os.listdir(tif_10m_save_path)  # 获取所有10m分辨率tif数据的名称
-                            tif_path_list = []  # 以列表的形式存储各个波段的路径
-
-                            band_names = ["B02", "B03", "B04", "B08", "B8A", "B11", "B12"]  # 需要堆叠的波段名
-
-                            for band_name in band_names:
-                                for tif_name in tif_list:
-                                    if band_name == tif_name[-11:-8]:
-                                        tif_path_list.append(tif_10m_save_path + os.sep + tif_name)
-
-                            # 执行叠加函数
-                            merge_out = os.path.join(OUTPUT_PATH, img_identifier + "_merge.tif")
-                            helper.merge_tif(tif_path_list, merge_out)
-
-                            # 计算植被指数
-                            proj, geotrans, img_data, row, column = helper.read_img(merge_out)
-                            if CAL_NDVI:
-                                ndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_ndvi.tif")
-                                ci.cal_ndvi(img_data, geotrans, proj, ndvi_img)
-                            if CAL_NDRE:
-                                ndre_img = os.path.join(OUTPUT_PATH, img_identifier + "_ndre.tif")
-                                ci.cal_ndre(img_data, geotrans, proj, ndre_img)
-                            if CAL_OSAVI:
-                                osavi_img = os.path.join(OUTPUT_PATH, img_identifier + "_osavi.tif")
-                                ci.cal_osavi(img_data, geotrans, proj, osavi_img)
-                            if CAL_LCI:
-                                lci_img = os.path.join(OUTPUT_PATH, img_identifier + "_lci.tif")
-                                ci.cal_lci(img_data, geotrans, proj, lci_img)
-                            if CAL_GNDVI:
-                                gndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_gndvi.tif")
-                                ci.cal_gndvi(img_data, geotrans, proj, gndvi_img)
-                            if CAL_RECI:
-                                reci_img = os.path.join(OUTPUT_PATH, img_identifier + "_reci.tif")
-                                ci.cal_reci(img_data, geotrans, proj, reci_img)
-                            if CAL_NDMI:
-                                ndmi_img = os.path.join(OUTPUT_PATH, img_identifier + "_ndmi.tif")
-                                ci.cal_ndmi(img_data, geotrans, proj, ndmi_img)
-                            if CAL_NDWI:
-                                ndwi_img = os.path.join(OUTPUT_PATH, img_identifier + "_ndwi.tif")
-                                ci.cal_ndwi(img_data, geotrans, proj, ndwi_img)
-
-                            ###########################################
-                            #   第六步：真彩色影像可视化
-                            #   对图像进行拉伸显示
-                            #   转换成0-255的快视图并保存
-                            ###########################################
-                            if QUICK_IMG:
-                                proj, geotrans, img_data, row, column = helper.read_img(merge_out)
-                                img_data_r = helper.rgb(img_data)  # 提取3波段改变rgb顺序和数据维度
-                                # 该操作将改变原始数据，因此data用.copy，不对原始数据进行更改
-                                img_data_rgb_s = np.uint8(helper.stretch_n(img_data_r.copy()) * 255)  # 数据值域缩放至（0~255）
-
-                                quickimg = os.path.join(OUTPUT_PATH, img_identifier + "_quickimg.tif")
-                                ds = gdal.Open(merge_out)  # 打开文件
-                                helper.write_tiff(img_data_rgb_s.transpose(2, 0, 1), ds.GetGeoTransform(), ds.GetProjection(),
-                                                  quickimg)
-
-                            ###########################################
-                            #   第七步：重投影
-                            ###########################################
-                            if REPROJECT:
-                                ds = gdal.Open(merge_out)  # 打开文件
-                                reprojected_img = os.path.join(OUTPUT_PATH, img_identifier + "_projected.tif")
-                                gdal.Warp(reprojected_img, ds, dstSRS=CRS)  # epsg可以通过https://epsg.io/查询
-                                # 计算植被指数
-                                proj, geotrans, img_data, row, column = helper.read_img(reprojected_img)
-                                if CAL_NDVI:
-                                    ndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_ndvi.tif")
-                                    ci.cal_ndvi(img_data, geotrans, proj, ndvi_img)
-                                if CAL_NDRE:
-                                    ndre_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_ndre.tif")
-                                    ci.cal_ndre(img_data, geotrans, proj, ndre_img)
-                                if CAL_OSAVI:
-                                    osavi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_osavi.tif")
-                                    ci.cal_osavi(img_data, geotrans, proj, osavi_img)
-                                if CAL_LCI:
-                                    lci_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_lci.tif")
-                                    ci.cal_lci(img_data, geotrans, proj, lci_img)
-                                if CAL_GNDVI:
-                                    gndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_gndvi.tif")
-                                    ci.cal_gndvi(img_data, geotrans, proj, gndvi_img)
-                                if CAL_RECI:
-                                    reci_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_reci.tif")
-                                    ci.cal_reci(img_data, geotrans, proj, reci_img)
-                                if CAL_NDMI:
-                                    ndmi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_ndmi.tif")
-                                    ci.cal_ndmi(img_data, geotrans, proj, ndmi_img)
-                                if CAL_NDWI:
-                                    ndwi_img = os.path.join(OUTPUT_PATH, img_identifier + "_proj_ndwi.tif")
-                                    ci.cal_ndwi(img_data, geotrans, proj, ndwi_img)
-
-                            ###########################################
-                            #   第八步：数据裁剪
-                            ###########################################
-                            if CLIP_TO_SHP:
-                                # 执行裁剪
-                                clip_output = os.path.join(OUTPUT_PATH, img_identifier + "_clip.tif")
-                                # 按矢量轮廓裁剪
-                                gdal.Warp(clip_output,  # 裁剪后影像保存位置
-                                          merge_out,  # 待裁剪的影像
-                                          cutlineDSName=SHP_FILE_PATH,  # 矢量数据
-                                          format="GTiff",  # 输出影像的格式
-                                          cropToCutline=True)  # 将目标图像的范围指定为cutline矢量图像的范围
-                                # 计算植被指数
-                                proj, geotrans, img_data, row, column = helper.read_img(clip_output)
-                                if CAL_NDVI:
-                                    ndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_ndvi.tif")
-                                    ci.cal_ndvi(img_data, geotrans, proj, ndvi_img)
-                                if CAL_NDRE:
-                                    ndre_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_ndre.tif")
-                                    ci.cal_ndre(img_data, geotrans, proj, ndre_img)
-                                if CAL_OSAVI:
-                                    osavi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_osavi.tif")
-                                    ci.cal_osavi(img_data, geotrans, proj, osavi_img)
-                                if CAL_LCI:
-                                    lci_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_lci.tif")
-                                    ci.cal_lci(img_data, geotrans, proj, lci_img)
-                                if CAL_GNDVI:
-                                    gndvi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_gndvi.tif")
-                                    ci.cal_gndvi(img_data, geotrans, proj, gndvi_img)
-                                if CAL_RECI:
-                                    reci_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_reci.tif")
-                                    ci.cal_reci(img_data, geotrans, proj, reci_img)
-                                if CAL_NDMI:
-                                    ndmi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_ndmi.tif")
-                                    ci.cal_ndmi(img_data, geotrans, proj, ndmi_img)
-                                if CAL_NDWI:
-                                    ndwi_img = os.path.join(OUTPUT_PATH, img_identifier + "_clip_ndwi.tif")
-                                    ci.cal_ndwi(img_data, geotrans, proj, ndwi_img)
+    # 逐景（或并行）处理.zip文件
+    failed_dict = run_products(s2_l1c_product_process, get_zip_path_list(INPUT_PATH), unzip_path, params)
+
+    # 按阶段汇总本批次的性能记录
+    profile_path = os.path.join(OUTPUT_PATH, pf.PROFILE_FILE_NAME)
+    if params['PROFILE'] and params['PROFILE_SUMMARY'] and os.path.exists(profile_path):
+        pf.summarize_profile(profile_path, os.path.join(OUTPUT_PATH, "profile_summary.csv"), params['PROFILE_RUN'])
 
     ###########################################
-    #   第九步：删除临时文件夹
+    #   第八步：删除临时文件夹
     ###########################################
-    helper.del_dir(unzip_path)
\ No newline at end of file
+    helper.del_dir(unzip_path)
+    return failed_dict
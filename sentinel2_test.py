@@ -35,6 +35,8 @@ License: This code is distributed under the MIT License.
 import datetime
 import sentinel2_download as s2d
 import sentinel2_process as s2p
+import sentinel2_composite as s2c
+import sentinel2_drill as s2dr
 
 
 # Parameters
@@ -45,7 +47,10 @@ s2_download_parameter = {'USER_NAME': 'gongchen9369',
                          'END_DATE': '20220901',
                          'PRODUCT_TYPE': 'S2MSI2A',
                          'CLOUD_COVER_PERCENTAGE': 30,
-                         'SAVE_DIR': 'G:/s2_processing/download'
+                         'SAVE_DIR': 'G:/s2_processing/download',
+                         'WORKERS': 4,
+                         'RETRIES': 3,
+                         'RETRY_DELAY': 2
                          }
 
 s2_l2a_parameter = {'INPUT_PATH': 'G:/s2_processing/l2a/raw',
@@ -62,16 +67,33 @@ s2_l2a_parameter = {'INPUT_PATH': 'G:/s2_processing/l2a/raw',
                     'CAL_GNDVI': True,
                     'CAL_RECI': True,
                     'CAL_NDMI': True,
-                    'CAL_NDWI': True
+                    'CAL_NDWI': True,
+                    'CUSTOM_INDICES': {'cire': 'B07 / B05 - 1.0'},
+                    'READ_FROM_ZIP': True,
+                    'TIFF_PROFILE': 'zstd',
+                    'DATACUBE': True,
+                    'SAVE_SCL': True,
+                    'BAND_CACHE_PATH': 'G:/s2_processing/cache',
+                    'BAND_CACHE_SIZE': 100,
+                    'PROFILE': True,
+                    'PROFILE_SUMMARY': True,
+                    'WORKERS': 4
                     }
 
 s2_l1c_parameter = {'INPUT_PATH': 'G:/s2_processing/l1c/raw',
                     'OUTPUT_PATH': 'G:/s2_processing/l1c/export',
                     'QUICK_IMG': True,
+                    'QUICK_IMG_SIZE': 2048,
                     'REPROJECT': True,
                     'CRS': 'EPSG:4326',
                     'CLIP_TO_SHP': True,
                     'SHP_FILE_PATH': 'G:/s2_processing/l1c/shp/lingang_field.shp',
+                    'AOI_FIRST': True,
+                    'CLOUD_MASK': True,
+                    'CLOUD_MASK_CLASSES': [0, 3, 8, 9, 10],
+                    'CLOUD_PROB_THRESHOLD': 50,
+                    'ZONAL_STATS': True,
+                    'ZONAL_ID_FIELD': 'FID',
                     'CAL_NDVI': True,
                     'CAL_NDRE': True,
                     'CAL_OSAVI': True,
@@ -79,9 +101,30 @@ s2_l1c_parameter = {'INPUT_PATH': 'G:/s2_processing/l1c/raw',
                     'CAL_GNDVI': True,
                     'CAL_RECI': True,
                     'CAL_NDMI': True,
-                    'CAL_NDWI': True
+                    'CAL_NDWI': True,
+                    'WORKERS': 2
                     }
 
+s2_composite_parameter = {'INPUT_PATH': 'G:/s2_processing/l2a/export',
+                          'OUTPUT_PATH': 'G:/s2_processing/l2a/composite',
+                          'START_DATE': '20220801',
+                          'END_DATE': '20220831',
+                          'METHOD': 'best_pixel',
+                          'CAL_NDVI': True,
+                          'TIFF_PROFILE': 'zstd',
+                          'WORKERS': 4
+                          }
+
+s2_drill_parameter = {'INPUT_PATH': 'G:/s2_processing/l2a/download',
+                      'OUTPUT_PATH': 'G:/s2_processing/l2a/points.csv',
+                      'POINTS': [('p1', 115.352, 40.164), ('p2', 115.401, 40.127)],
+                      'POINTS_CRS': 'EPSG:4326',
+                      'WINDOW_SIZE': 3,
+                      'BANDS': ['B04', 'B08', 'SCL'],
+                      'CAL_NDVI': True,
+                      'WORKERS': 4
+                      }
+
 # /***************************/
 # // MAIN
 # /***************************/
@@ -97,5 +140,11 @@ if __name__ == "__main__":
     # (3) Sentinel-2 L2A格式产品数据处理
     # s2p.s2_l1c_process(s2_l1c_parameter)
 
+    # (4) Sentinel-2 多时相合成
+    # s2c.s2_composite(s2_composite_parameter)
+
+    # (5) Sentinel-2 点位时间序列提取
+    # s2dr.s2_drill(s2_drill_parameter)
+
     end_time = datetime.datetime.now()
     print("Elapsed Time:", end_time - start_time)  # 输出程序运行所需时间
@@ -0,0 +1,355 @@
+import os
+import shutil
+import zipfile
+import datetime
+import numpy as np
+from osgeo import gdal, osr
+
+
+# -------------------------------------------------------------#
+#   模拟Sentinel-2产品：
+#   按SAFE标准结构生成L2A或L1C产品（MTD元数据XML、各分辨率的jp2波段、SCL及云概率），
+#   用于离线测试及性能基准，不需要下载真实产品。
+#   地物（水体、植被、裸地）及云、云阴影由固定随机种子的平滑噪声生成，
+#   各波段按地物的典型反射率取值，场景分类图（SCL）与地物一致，结果可复现。
+#   影像边长SIZE为10m像元数（完整图幅为10980），必须能被6整除（60m波段）。
+# -------------------------------------------------------------#
+# 模拟图幅：T50TLK，UTM 50N，左上角坐标
+TILE = 'T50TLK'
+TILE_EPSG = 32650
+TILE_ORIGIN = (399960.0, 4500000.0)
+
+# 各级产品中各波段的分辨率（米）
+L2A_BANDS = {10: ['B02', 'B03', 'B04', 'B08'],
+             20: ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12'],
+             60: ['B01', 'B09']}
+L1C_BANDS = {'B01': 60, 'B02': 10, 'B03': 10, 'B04': 10, 'B05': 20, 'B06': 20, 'B07': 20, 'B08': 10, 'B8A': 20,
+             'B09': 60, 'B10': 60, 'B11': 20, 'B12': 20}
+
+# 各地物类别（SCL类别）的典型反射率
+REFLECTANCE = {
+    #  B01   B02   B03   B04   B05   B06   B07   B08   B8A   B09   B10   B11   B12
+    4: [0.03, 0.04, 0.07, 0.04, 0.10, 0.28, 0.34, 0.38, 0.40, 0.40, 0.01, 0.22, 0.11],  # 植被
+    5: [0.10, 0.12, 0.15, 0.19, 0.21, 0.23, 0.25, 0.27, 0.28, 0.28, 0.02, 0.33, 0.28],  # 裸地
+    6: [0.06, 0.07, 0.06, 0.04, 0.03, 0.02, 0.02, 0.02, 0.02, 0.01, 0.00, 0.01, 0.01],  # 水体
+    3: [0.02, 0.02, 0.03, 0.02, 0.04, 0.08, 0.10, 0.11, 0.12, 0.12, 0.00, 0.07, 0.04],  # 云阴影
+    8: [0.40, 0.45, 0.45, 0.47, 0.48, 0.50, 0.51, 0.52, 0.52, 0.40, 0.08, 0.38, 0.30],  # 中概率云
+    9: [0.55, 0.60, 0.60, 0.62, 0.62, 0.63, 0.63, 0.64, 0.64, 0.50, 0.10, 0.45, 0.35],  # 高概率云
+}
+REFLECTANCE_BANDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+
+# jp2的创建参数：与ESA产品一致的无损压缩及1024×1024分块
+JP2_OPTIONS = ['QUALITY=100', 'REVERSIBLE=YES', 'BLOCKXSIZE=1024', 'BLOCKYSIZE=1024', 'YCC=NO']
+
+
+def smooth_noise(rng, size, cell):
+    """
+    平滑噪声：随机网格按双线性插值放大
+
+    :param rng: numpy随机数生成器
+    :param size: 输出边长（像元）
+    :param cell: 随机网格的间距（像元）
+    :return: size×size的数组，值域0~1
+    """
+    n = size // cell + 2
+    grid = rng.random((n, n))
+    position = (np.arange(size) + 0.5) / cell
+    index = np.floor(position).astype(np.int64)
+    weight = (position - index)[:, None]
+    # 先沿行方向插值，再沿列方向插值
+    rows = grid[index] * (1 - weight) + grid[index + 1] * weight
+    return rows[:, index] * (1 - weight.T) + rows[:, index + 1] * weight.T
+
+
+def make_scene(size, seed=0, cloud_cover=0.2):
+    """
+    生成10m分辨率的地物类别（SCL类别）及云概率
+
+    :param size: 影像边长（10m像元）
+    :param seed: 随机种子
+    :param cloud_cover: 云覆盖比例（约）
+    :return: 地物类别数组（uint8）、云概率数组（uint8，0~100）
+    """
+    rng = np.random.default_rng(seed)
+    land = smooth_noise(rng, size, 64) * 0.7 + smooth_noise(rng, size, 8) * 0.3
+    scene = np.full((size, size), 4, dtype=np.uint8)
+    scene[land < 0.3] = 6
+    scene[land > 0.6] = 5
+
+    cloud = smooth_noise(rng, size, 128) * 0.8 + smooth_noise(rng, size, 16) * 0.2
+    threshold = np.quantile(cloud, 1 - cloud_cover) if cloud_cover > 0 else np.inf
+    cloud_prob = np.clip((cloud - threshold) / max(1 - threshold, 1e-6) * 100 + 50, 0, 100).astype(np.uint8)
+    cloud_prob[cloud < threshold - 0.05] = 0
+    # 云阴影为云区向东南方向的平移
+    shift = max(1, size // 50)
+    shadow = np.zeros_like(scene, dtype=bool)
+    shadow[shift:, shift:] = cloud[:-shift, :-shift] >= threshold
+    scene[shadow] = 3
+    scene[cloud >= threshold] = 8
+    scene[cloud_prob >= 80] = 9
+    return scene, cloud_prob
+
+
+def make_band(scene, band_name, factor, seed=0):
+    """
+    按地物类别的典型反射率生成波段（反射率×10000，uint16），并加入噪声
+
+    :param scene: 10m分辨率的地物类别
+    :param band_name: 波段名
+    :param factor: 波段分辨率与10m的比值
+    :param seed: 随机种子
+    :return: 波段数组
+    """
+    classes = scene[factor // 2::factor, factor // 2::factor]
+    lut = np.zeros(256, dtype=np.float32)
+    for scl_class in REFLECTANCE:
+        lut[scl_class] = REFLECTANCE[scl_class][REFLECTANCE_BANDS.index(band_name)] * 10000
+    rng = np.random.default_rng([seed, REFLECTANCE_BANDS.index(band_name)])
+    data = lut[classes] + rng.normal(0, 150, classes.shape).astype(np.float32)
+    return np.clip(data, 1, 65535).astype(np.uint16)
+
+
+def write_jp2(path, data, resolution):
+    """
+    将数组写出为jp2（JP2OpenJPEG驱动）
+
+    :param path: jp2文件路径
+    :param data: 数组
+    :param resolution: 分辨率（米）
+    """
+    driver = gdal.GetDriverByName('JP2OpenJPEG')
+    if driver is None:
+        raise ValueError("ERROR!!! Writing synthetic products requires the GDAL JP2OpenJPEG driver")
+    datatype = gdal.GDT_Byte if data.dtype == np.uint8 else gdal.GDT_UInt16
+    mem_dataset = gdal.GetDriverByName('MEM').Create('', data.shape[1], data.shape[0], 1, datatype)
+    mem_dataset.SetGeoTransform((TILE_ORIGIN[0], resolution, 0, TILE_ORIGIN[1], 0, -resolution))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(TILE_EPSG)
+    mem_dataset.SetProjection(srs.ExportToWkt())
+    mem_dataset.GetRasterBand(1).WriteArray(data)
+    driver.CreateCopy(path, mem_dataset, options=JP2_OPTIONS)
+    del mem_dataset
+
+
+def get_product_names(level, sensing_time):
+    """
+    产品、颗粒（granule）及文件编号的名称
+
+    :param level: 'L2A'或'L1C'
+    :param sensing_time: 成像时间（datetime）
+    :return: 产品名（.SAFE）、颗粒名、文件编号
+    """
+    sensing = sensing_time.strftime('%Y%m%dT%H%M%S')
+    generation = (sensing_time + datetime.timedelta(hours=2)).strftime('%Y%m%dT%H%M%S')
+    product_name = 'S2A_MSI{}_{}_N0301_R075_{}_{}.SAFE'.format(level, sensing, TILE, generation)
+    granule_name = '{}_{}_A000001_{}'.format(level, TILE, sensing)
+    img_identifier = '{}_{}'.format(TILE, sensing)
+    return product_name, granule_name, img_identifier
+
+
+def write_product_mtd(safe_path, level, sensing_time, granule_name, image_files):
+    """
+    写出产品元数据MTD_MSIL2A.xml或MTD_MSIL1C.xml
+
+    :param safe_path: .SAFE文件夹路径
+    :param level: 'L2A'或'L1C'
+    :param sensing_time: 成像时间（datetime）
+    :param granule_name: 颗粒名
+    :param image_files: 各波段文件相对.SAFE的路径（不含扩展名）
+    """
+    time_string = sensing_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    product_type = 'S2MSI2A' if level == 'L2A' else 'S2MSI1C'
+    root = 'Level-2A_User_Product' if level == 'L2A' else 'Level-1C_User_Product'
+    image_list = '\n'.join('            <IMAGE_FILE>{}</IMAGE_FILE>'.format(image_file) for image_file in image_files)
+    spectral = '\n'.join(
+        '      <Spectral_Information bandId="{}" physicalBand="{}"><RESOLUTION>{}</RESOLUTION></Spectral_Information>'
+        .format(i, band_name, L1C_BANDS[band_name]) for i, band_name in enumerate(REFLECTANCE_BANDS))
+    quantification = ('<BOA_QUANTIFICATION_VALUE unit="none">10000</BOA_QUANTIFICATION_VALUE>' if level == 'L2A'
+                      else '<QUANTIFICATION_VALUE unit="none">10000</QUANTIFICATION_VALUE>')
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<n1:{root} xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_{level_long}.xsd">
+  <n1:General_Info>
+    <Product_Info>
+      <PRODUCT_START_TIME>{time}</PRODUCT_START_TIME>
+      <PRODUCT_STOP_TIME>{time}</PRODUCT_STOP_TIME>
+      <PRODUCT_URI>{product}</PRODUCT_URI>
+      <PROCESSING_LEVEL>{level_long}</PROCESSING_LEVEL>
+      <PRODUCT_TYPE>{product_type}</PRODUCT_TYPE>
+      <PROCESSING_BASELINE>03.01</PROCESSING_BASELINE>
+      <GENERATION_TIME>{time}</GENERATION_TIME>
+      <Datatake datatakeIdentifier="GS2A_{sensing}_000001_N03.01">
+        <SPACECRAFT_NAME>Sentinel-2A</SPACECRAFT_NAME>
+        <DATATAKE_TYPE>INS-NOBS</DATATAKE_TYPE>
+        <DATATAKE_SENSING_START>{time}</DATATAKE_SENSING_START>
+        <SENSING_ORBIT_NUMBER>75</SENSING_ORBIT_NUMBER>
+        <SENSING_ORBIT_DIRECTION>DESCENDING</SENSING_ORBIT_DIRECTION>
+      </Datatake>
+      <Product_Organisation>
+        <Granule_List>
+          <Granule datastripIdentifier="S2A_OPER_MSI_{level}_DS_{sensing}_N03.01" granuleIdentifier="{granule}"
+                   imageFormat="JPEG2000">
+{images}
+          </Granule>
+        </Granule_List>
+      </Product_Organisation>
+    </Product_Info>
+    <Product_Image_Characteristics>
+      <QUANTIFICATION_VALUES_LIST>
+        {quantification}
+      </QUANTIFICATION_VALUES_LIST>
+      <Spectral_Information_List>
+{spectral}
+      </Spectral_Information_List>
+    </Product_Image_Characteristics>
+  </n1:General_Info>
+</n1:{root}>
+""".format(root=root, level=level, level_long='Level-2A' if level == 'L2A' else 'Level-1C', time=time_string,
+           product=os.path.basename(safe_path), product_type=product_type,
+           sensing=sensing_time.strftime('%Y%m%dT%H%M%S'), granule=granule_name, images=image_list,
+           quantification=quantification, spectral=spectral)
+    with open(os.path.join(safe_path, 'MTD_MSI{}.xml'.format(level)), 'w') as f:
+        f.write(xml)
+
+
+def write_tile_mtd(granule_path, level, sensing_time, size):
+    """
+    写出颗粒元数据MTD_TL.xml（坐标系、各分辨率的行列数及左上角坐标）
+
+    :param granule_path: 颗粒文件夹路径
+    :param level: 'L2A'或'L1C'
+    :param sensing_time: 成像时间（datetime）
+    :param size: 影像边长（10m像元）
+    """
+    geocoding = []
+    for resolution in (10, 20, 60):
+        n = size * 10 // resolution
+        geocoding.append('      <Size resolution="{0}"><NROWS>{1}</NROWS><NCOLS>{1}</NCOLS></Size>'
+                         .format(resolution, n))
+    for resolution in (10, 20, 60):
+        geocoding.append('      <Geoposition resolution="{}"><ULX>{:.0f}</ULX><ULY>{:.0f}</ULY>'
+                         '<XDIM>{}</XDIM><YDIM>-{}</YDIM></Geoposition>'
+                         .format(resolution, TILE_ORIGIN[0], TILE_ORIGIN[1], resolution, resolution))
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-{level_number}_Tile_ID
+    xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-{level_number}_Tile_Metadata.xsd">
+  <n1:General_Info>
+    <TILE_ID>{granule}</TILE_ID>
+    <SENSING_TIME>{time}</SENSING_TIME>
+  </n1:General_Info>
+  <n1:Geometric_Info>
+    <Tile_Geocoding metadataLevel="Brief">
+      <HORIZONTAL_CS_NAME>WGS84 / UTM zone 50N</HORIZONTAL_CS_NAME>
+      <HORIZONTAL_CS_CODE>EPSG:{epsg}</HORIZONTAL_CS_CODE>
+{geocoding}
+    </Tile_Geocoding>
+  </n1:Geometric_Info>
+</n1:Level-{level_number}_Tile_ID>
+""".format(level_number=level[1:], granule=os.path.basename(granule_path),
+           time=sensing_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'), epsg=TILE_EPSG, geocoding='\n'.join(geocoding))
+    with open(os.path.join(granule_path, 'MTD_TL.xml'), 'w') as f:
+        f.write(xml)
+
+
+def make_safe(output_path, level='L2A', sensing_time=None, size=1098, seed=0, cloud_cover=0.2):
+    """
+    生成一景模拟产品的.SAFE文件夹
+
+    :param output_path: 输出文件夹
+    :param level: 'L2A'或'L1C'
+    :param sensing_time: 成像时间（datetime），默认为2022-08-25 03:05:19
+    :param size: 影像边长（10m像元），必须能被6整除
+    :param seed: 随机种子
+    :param cloud_cover: 云覆盖比例（约）
+    :return: .SAFE文件夹路径
+    """
+    if level not in ('L2A', 'L1C'):
+        raise ValueError("ERROR!!! Product level {} not correctly defined".format(level))
+    if size % 6 != 0:
+        raise ValueError("ERROR!!! The size of synthetic products must be a multiple of 6")
+    if sensing_time is None:
+        sensing_time = datetime.datetime(2022, 8, 25, 3, 5, 19)
+    product_name, granule_name, img_identifier = get_product_names(level, sensing_time)
+    safe_path = os.path.join(output_path, product_name)
+    granule_path = os.path.join(safe_path, 'GRANULE', granule_name)
+    img_data_path = os.path.join(granule_path, 'IMG_DATA')
+    qi_data_path = os.path.join(granule_path, 'QI_DATA')
+    for dir_path in (img_data_path, qi_data_path, os.path.join(safe_path, 'AUX_DATA'),
+                     os.path.join(safe_path, 'DATASTRIP'), os.path.join(safe_path, 'HTML')):
+        os.makedirs(dir_path, exist_ok=True)
+
+    scene, cloud_prob = make_scene(size, seed, cloud_cover)
+    image_files = []
+    if level == 'L2A':
+        for resolution in L2A_BANDS:
+            resolution_path = os.path.join(img_data_path, 'R{}m'.format(resolution))
+            os.makedirs(resolution_path, exist_ok=True)
+            factor = resolution // 10
+            band_list = [(band_name, make_band(scene, band_name, factor, seed)) for band_name in L2A_BANDS[resolution]]
+            if resolution == 20:
+                band_list.append(('SCL', scene[1::2, 1::2]))
+            for band_name, data in band_list:
+                file_name = '{}_{}_{}m'.format(img_identifier, band_name, resolution)
+                write_jp2(os.path.join(resolution_path, file_name + '.jp2'), data, resolution)
+                image_files.append('GRANULE/{}/IMG_DATA/R{}m/{}'.format(granule_name, resolution, file_name))
+        write_jp2(os.path.join(qi_data_path, 'MSK_CLDPRB_20m.jp2'), cloud_prob[1::2, 1::2], 20)
+    else:
+        for band_name in REFLECTANCE_BANDS:
+            resolution = L1C_BANDS[band_name]
+            file_name = '{}_{}'.format(img_identifier, band_name)
+            write_jp2(os.path.join(img_data_path, file_name + '.jp2'),
+                      make_band(scene, band_name, resolution // 10, seed), resolution)
+            image_files.append('GRANULE/{}/IMG_DATA/{}'.format(granule_name, file_name))
+
+    write_product_mtd(safe_path, level, sensing_time, granule_name, image_files)
+    write_tile_mtd(granule_path, level, sensing_time, size)
+    return safe_path
+
+
+def zip_safe(safe_path, zip_path=None):
+    """
+    将.SAFE文件夹打包为.zip（与下载的产品一致，第一个成员为.SAFE目录）
+
+    :param safe_path: .SAFE文件夹路径
+    :param zip_path: .zip文件路径，默认与.SAFE同名
+    :return: .zip文件路径
+    """
+    safe_path = safe_path.rstrip('/\\')
+    if zip_path is None:
+        zip_path = os.path.splitext(safe_path)[0] + '.zip'
+    root_path = os.path.dirname(safe_path)
+    # jp2已经压缩，不再压缩
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
+        for dir_path, dir_names, file_names in os.walk(safe_path):
+            dir_names.sort()
+            zip_file.write(dir_path, os.path.relpath(dir_path, root_path))
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                zip_file.write(file_path, os.path.relpath(file_path, root_path))
+    return zip_path
+
+
+def make_products(output_path, level='L2A', count=1, size=1098, start_time=None, interval_days=5, keep_safe=False):
+    """
+    生成多景（不同日期）模拟产品的.zip文件
+
+    :param output_path: 输出文件夹
+    :param level: 'L2A'或'L1C'
+    :param count: 产品数
+    :param size: 影像边长（10m像元）
+    :param start_time: 第一景的成像时间（datetime）
+    :param interval_days: 相邻两景的间隔天数
+    :param keep_safe: 是否保留.SAFE文件夹
+    :return: .zip文件路径列表
+    """
+    if start_time is None:
+        start_time = datetime.datetime(2022, 8, 25, 3, 5, 19)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    zip_path_list = []
+    for i in range(count):
+        safe_path = make_safe(output_path, level, start_time + datetime.timedelta(days=interval_days * i), size,
+                              seed=i)
+        zip_path_list.append(zip_safe(safe_path))
+        if not keep_safe:
+            shutil.rmtree(safe_path)
+    return zip_path_list
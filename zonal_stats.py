@@ -0,0 +1,162 @@
+import csv
+import numpy as np
+from osgeo import gdal, ogr
+import helper
+
+# pandas（及pyarrow）为可选依赖：安装后可以输出Parquet格式的统计表，否则只能输出CSV
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+# -------------------------------------------------------------#
+#   地块统计：
+#   矢量要素按影像网格栅格化为编号影像（第i个要素的像元值为i+1，背景为0），
+#   计算植被指数时按块收集地块内有效像元的编号及指数值，
+#   最后用np.bincount及排序后的分组索引一次计算全部地块的统计量。
+# -------------------------------------------------------------#
+# 默认输出的分位数（50为中位数）
+ZONAL_PERCENTILES = [10, 25, 50, 75, 90]
+
+
+def get_feature_ids(shp_path, id_field=None):
+    """
+    读取矢量文件各要素的编号，顺序与rasterize_features的像元值一致
+
+    :param shp_path: 矢量文件路径
+    :param id_field: 作为地块编号的字段名，默认使用要素的FID
+    :return: 各要素的编号列表
+    """
+    shp_dataset = ogr.Open(shp_path)
+    layer = shp_dataset.GetLayer(0)
+    feature_ids = [feature.GetField(id_field) if id_field else feature.GetFID() for feature in layer]
+    del shp_dataset
+    return feature_ids
+
+
+def rasterize_features(shp_path, raster_path, out_path):
+    """
+    将矢量要素栅格化为与参考影像网格一致的编号影像，第i个要素（从0开始）的像元值为i+1，背景为0。
+    矢量与影像坐标系不同时由GDAL在栅格化时转换
+
+    :param shp_path: 矢量文件路径
+    :param raster_path: 参考影像路径（tif或vrt）
+    :param out_path: 编号影像保存路径
+    :return: 编号影像路径
+    """
+    dataset = gdal.Open(raster_path)
+    out_dataset = helper.create_tiff(out_path, dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_UInt32,
+                                     dataset.GetGeoTransform(), dataset.GetProjection(), 'deflate')
+    del dataset
+
+    shp_dataset = ogr.Open(shp_path)
+    layer = shp_dataset.GetLayer(0)
+    # 复制要素至内存图层，以要素顺序作为栅格化的像元值
+    mem_dataset = ogr.GetDriverByName('Memory').CreateDataSource('')
+    mem_layer = mem_dataset.CreateLayer('zones', srs=layer.GetSpatialRef(), geom_type=layer.GetGeomType())
+    mem_layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    for i, feature in enumerate(layer):
+        mem_feature = ogr.Feature(mem_layer.GetLayerDefn())
+        mem_feature.SetGeometry(feature.GetGeometryRef())
+        mem_feature.SetField('label', i + 1)
+        mem_layer.CreateFeature(mem_feature)
+
+    gdal.RasterizeLayer(out_dataset, [1], mem_layer, options=['ATTRIBUTE=label'])
+    helper.finish_tiff(out_dataset, out_path, 'deflate')
+    del mem_dataset, shp_dataset
+    return out_path
+
+
+def zonal_statistics(labels, values, n_zones, percentiles=ZONAL_PERCENTILES):
+    """
+    分组计算各地块的统计量
+
+    :param labels: 像元的地块编号（1 ~ n_zones）
+    :param values: 像元的指数值（不含NaN）
+    :param n_zones: 地块数
+    :param percentiles: 需要计算的分位数
+    :return: {统计量名: 长度为n_zones+1的数组}，下标为地块编号，下标0为背景
+    """
+    values = values.astype(np.float64)
+    count = np.bincount(labels, minlength=n_zones + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(labels, weights=values, minlength=n_zones + 1) / count
+        var = np.bincount(labels, weights=values * values, minlength=n_zones + 1) / count - mean * mean
+    stats = {'count': count, 'mean': mean, 'std': np.sqrt(np.maximum(var, 0))}
+
+    # 按地块编号、指数值排序，每个地块的像元值连续且有序，分位数由组内位置线性插值（与np.percentile一致）
+    sorted_values = values[np.lexsort((values, labels))]
+    starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+    has_values = count > 0
+    for name, p in [('min', 0)] + [('p%d' % p, p) for p in percentiles] + [('max', 100)]:
+        position = starts + (count - 1) * p / 100.0
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        stat = np.full(n_zones + 1, np.nan)
+        stat[has_values] = (sorted_values[lower[has_values]] + (sorted_values[upper[has_values]] -
+                            sorted_values[lower[has_values]]) * (position - lower)[has_values])
+        stats[name] = stat
+    return stats
+
+
+def zonal_table(zone_values, feature_ids, img_identifier, percentiles=ZONAL_PERCENTILES):
+    """
+    生成地块统计表，每行为一个地块、一个植被指数的统计量
+
+    :param zone_values: {植被指数名: [(地块编号数组, 指数值数组), ...]}，由cal_index.cal_indices按块收集
+    :param feature_ids: 各要素的编号列表
+    :param img_identifier: Sentinel-2文件的编号，例如T50TLK_20220825T030519
+    :param percentiles: 需要计算的分位数
+    :return: 统计表的列名及各行{列名: 值}
+    """
+    tile, date = img_identifier.split('_')[0], img_identifier.split('_')[1][:8]
+    stat_names = ['count', 'mean', 'std', 'min'] + ['p%d' % p for p in percentiles] + ['max']
+    columns = ['feature_id', 'date', 'tile', 'index'] + stat_names
+    rows = []
+    for index_name in zone_values:
+        chunks = zone_values[index_name]
+        labels = np.concatenate([chunk[0] for chunk in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+        values = np.concatenate([chunk[1] for chunk in chunks]) if chunks else np.zeros(0, dtype=np.float32)
+        stats = zonal_statistics(labels.astype(np.int64), values, len(feature_ids), percentiles)
+        for label in np.nonzero(stats['count'][1:])[0] + 1:
+            row = {'feature_id': feature_ids[label - 1], 'date': date, 'tile': tile, 'index': index_name}
+            for stat_name in stat_names:
+                row[stat_name] = stats[stat_name][label].item()
+            rows.append(row)
+    return columns, rows
+
+
+def read_table(table_path):
+    """
+    读取write_table输出的统计表
+
+    :param table_path: 统计表路径（.csv或.parquet）
+    :return: 各行{列名: 值}
+    """
+    if table_path.endswith('.parquet'):
+        if pd is None:
+            raise ValueError("ERROR!!! Reading .parquet tables requires pandas and pyarrow")
+        return pd.read_parquet(table_path).to_dict('records')
+    with open(table_path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def write_table(columns, rows, out_path):
+    """
+    输出统计表，按文件扩展名输出CSV或Parquet格式
+
+    :param columns: 列名
+    :param rows: 各行{列名: 值}
+    :param out_path: 统计表保存路径（.csv或.parquet）
+    """
+    if out_path.endswith('.parquet'):
+        if pd is None:
+            raise ValueError("ERROR!!! Writing .parquet tables requires pandas and pyarrow")
+        pd.DataFrame(rows, columns=columns).to_parquet(out_path, index=False)
+    else:
+        with open(out_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    print(out_path + " has been created")
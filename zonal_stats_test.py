@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import zonal_stats as zs
+
+
+# -------------------------------------------------------------#
+#   地块统计的测试，不需要影像数据：
+#   在小的地块编号数组上，将各地块的统计量与numpy逐个地块计算的结果比较。
+#   运行：python -m unittest zonal_stats_test
+# -------------------------------------------------------------#
+class ZonalStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # 地块4没有像元，地块3只有一个像元
+        self.n_zones = 5
+        self.labels = np.concatenate([np.full(37, 1), np.full(8, 2), [3], np.full(20, 5), np.zeros(10, dtype=int)])
+        self.values = rng.normal(0.5, 0.2, size=self.labels.size).astype(np.float32)
+        order = rng.permutation(self.labels.size)
+        self.labels, self.values = self.labels[order], self.values[order]
+
+    def test_against_numpy(self):
+        percentiles = [5, 10, 25, 50, 75, 90, 99]
+        stats = zs.zonal_statistics(self.labels, self.values, self.n_zones, percentiles)
+        for label in range(self.n_zones + 1):
+            zone = self.values[self.labels == label].astype(np.float64)
+            self.assertEqual(stats['count'][label], zone.size)
+            if zone.size == 0:
+                for name in ['mean', 'min', 'max'] + ['p%d' % p for p in percentiles]:
+                    self.assertTrue(np.isnan(stats[name][label]))
+                continue
+            self.assertAlmostEqual(stats['mean'][label], zone.mean(), places=12)
+            self.assertAlmostEqual(stats['std'][label], zone.std(), places=6)
+            self.assertAlmostEqual(stats['min'][label], zone.min(), places=12)
+            self.assertAlmostEqual(stats['max'][label], zone.max(), places=12)
+            for p in percentiles:
+                self.assertAlmostEqual(stats['p%d' % p][label], np.percentile(zone, p), places=12)
+
+    def test_zonal_table(self):
+        # 按块收集的数据与整体计算结果相同，没有像元的地块及背景不输出
+        chunks = [(self.labels[:30], self.values[:30]), (self.labels[30:], self.values[30:])]
+        feature_ids = ['a', 'b', 'c', 'd', 'e']
+        columns, rows = zs.zonal_table({'ndvi': chunks}, feature_ids, 'T50TLK_20220825T030519')
+        self.assertEqual(columns[:4], ['feature_id', 'date', 'tile', 'index'])
+        self.assertEqual([row['feature_id'] for row in rows], ['a', 'b', 'c', 'e'])
+        for row in rows:
+            zone = self.values[self.labels == feature_ids.index(row['feature_id']) + 1].astype(np.float64)
+            self.assertEqual((row['date'], row['tile'], row['index']), ('20220825', 'T50TLK', 'ndvi'))
+            self.assertEqual(row['count'], zone.size)
+            self.assertAlmostEqual(row['mean'], zone.mean(), places=12)
+            self.assertAlmostEqual(row['p50'], np.median(zone), places=12)
+
+    def test_csv_table(self):
+        work_path = tempfile.mkdtemp()
+        try:
+            columns, rows = zs.zonal_table({'ndvi': [(self.labels, self.values)]}, ['a', 'b', 'c', 'd', 'e'],
+                                           'T50TLK_20220825T030519')
+            table_path = os.path.join(work_path, 'zonal.csv')
+            zs.write_table(columns, rows, table_path)
+            table = zs.read_table(table_path)
+            self.assertEqual([row['feature_id'] for row in table], [row['feature_id'] for row in rows])
+            self.assertEqual([float(row['mean']) for row in table], [row['mean'] for row in rows])
+        finally:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()